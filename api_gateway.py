@@ -0,0 +1,385 @@
+"""
+Client-side gateway for Google API calls (Gemini, Document AI, Vision).
+
+Every call goes through the gateway for its service, which combines:
+  * an AIMD concurrency limit: +1 slot per window of successes, halved on
+    429/503 so threads stop hammering an exhausted quota,
+  * jittered exponential backoff retries (tenacity) for transient errors,
+  * a circuit breaker that fails fast while a service keeps failing,
+  * a per-call deadline covering queueing, attempts and backoff sleeps.
+
+HedgePolicy optionally sends a duplicate request when a call runs past a
+percentile of recent latency and returns whichever finishes first.
+"""
+import os
+import time
+import threading
+import contextlib
+import contextvars
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from google.api_core import exceptions as google_exceptions
+from tenacity import (
+    Retrying,
+    retry_if_exception,
+    stop_after_attempt,
+    stop_before_delay,
+    wait_random_exponential,
+)
+
+# --- CONFIGURATION ---
+GATEWAY_MAX_ATTEMPTS = int(os.getenv("GATEWAY_MAX_ATTEMPTS", "4"))
+GATEWAY_BACKOFF_BASE = float(os.getenv("GATEWAY_BACKOFF_BASE", "0.5"))   # seconds
+GATEWAY_BACKOFF_MAX = float(os.getenv("GATEWAY_BACKOFF_MAX", "8"))       # seconds
+# Consecutive failures that open the breaker, and how long it stays open
+BREAKER_FAILURE_THRESHOLD = int(os.getenv("BREAKER_FAILURE_THRESHOLD", "5"))
+BREAKER_RESET_SECONDS = float(os.getenv("BREAKER_RESET_SECONDS", "30"))
+# Hedging (opt-in): comma-separated operations, e.g. "summarize_text,analyze_risks"
+HEDGE_OPERATIONS = {op.strip() for op in os.getenv("HEDGE_OPERATIONS", "").split(",") if op.strip()}
+HEDGE_PERCENTILE = float(os.getenv("HEDGE_PERCENTILE", "95"))
+# Hedges allowed per call on average; 0.1 caps extra load at ~10%
+HEDGE_MAX_EXTRA_RATIO = float(os.getenv("HEDGE_MAX_EXTRA_RATIO", "0.1"))
+HEDGE_MIN_SAMPLES = int(os.getenv("HEDGE_MIN_SAMPLES", "20"))
+HEDGE_WINDOW = 200
+
+# Quota and overload signals: retried, and they shrink the concurrency limit
+OVERLOAD_ERRORS = (
+    google_exceptions.TooManyRequests,      # 429, includes ResourceExhausted
+    google_exceptions.ServiceUnavailable,   # 503
+)
+# Transient errors that are retried but say nothing about load
+TRANSIENT_ERRORS = OVERLOAD_ERRORS + (
+    google_exceptions.InternalServerError,
+    google_exceptions.GatewayTimeout,
+    google_exceptions.DeadlineExceeded,
+    google_exceptions.Aborted,
+    ConnectionError,
+)
+
+
+# Absolute time.monotonic() deadline set by the request stage making the call
+_stage_deadline = contextvars.ContextVar("stage_deadline", default=None)
+
+
+@contextlib.contextmanager
+def deadline_scope(expires_at: float):
+    """Cap every gateway call made inside the block at expires_at (time.monotonic())."""
+    current = _stage_deadline.get()
+    token = _stage_deadline.set(expires_at if current is None else min(current, expires_at))
+    try:
+        yield
+    finally:
+        _stage_deadline.reset(token)
+
+
+def remaining_time(default: float) -> float:
+    """Seconds left before the current stage deadline, at most default; default outside a deadline scope."""
+    expires_at = _stage_deadline.get()
+    if expires_at is None:
+        return default
+    return min(default, expires_at - time.monotonic())
+
+
+class CircuitOpen(RuntimeError):
+    """Raised without calling the service while its breaker is open."""
+
+
+class GatewayDeadlineExceeded(TimeoutError):
+    """Raised when the call's deadline passes before a concurrency slot frees up."""
+
+
+class AdaptiveLimiter:
+    """Additive-increase / multiplicative-decrease concurrency limit."""
+
+    def __init__(self, initial: int, minimum: int, maximum: int):
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.in_flight = 0
+        self._cond = threading.Condition()
+
+    def acquire(self, timeout: float) -> bool:
+        with self._cond:
+            acquired = self._cond.wait_for(lambda: self.in_flight < int(self.limit), timeout=max(0.0, timeout))
+            if acquired:
+                self.in_flight += 1
+            return acquired
+
+    def release(self, overloaded: bool = False, succeeded: bool = False) -> None:
+        with self._cond:
+            self.in_flight -= 1
+            if overloaded:
+                self.limit = max(self.minimum, self.limit / 2)
+            elif succeeded:
+                # Roughly +1 per limit's worth of successes
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            self._cond.notify_all()
+
+
+class CircuitBreaker:
+    """Closed -> open after repeated failures -> half-open single probe -> closed."""
+
+    def __init__(self, failure_threshold: int, reset_seconds: float):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self._probe_in_flight = False
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.state == "closed":
+                return True
+            if self.state == "open" and time.monotonic() - self.opened_at >= self.reset_seconds:
+                self.state = "half_open"
+            if self.state == "half_open" and not self._probe_in_flight:
+                self._probe_in_flight = True
+                return True
+            return False
+
+    def record_success(self) -> None:
+        with self._lock:
+            self.state = "closed"
+            self.failures = 0
+            self._probe_in_flight = False
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self.failures += 1
+            if self.state == "half_open" or self.failures >= self.failure_threshold:
+                self.state = "open"
+                self.opened_at = time.monotonic()
+            self._probe_in_flight = False
+
+    def record_ignored(self) -> None:
+        """Release a half-open probe whose outcome says nothing about service health."""
+        with self._lock:
+            self._probe_in_flight = False
+
+
+class ServiceGateway:
+    """Limiter, breaker and retry policy for one Google service."""
+
+    def __init__(self, name: str, initial_limit: int, max_limit: int, deadline: float, timeout_kwarg: str = None):
+        self.name = name
+        self.deadline = deadline
+        # Keyword the client method accepts for its own RPC timeout, if any
+        self.timeout_kwarg = timeout_kwarg
+        self.limiter = AdaptiveLimiter(initial_limit, 1, max_limit)
+        self.breaker = CircuitBreaker(BREAKER_FAILURE_THRESHOLD, BREAKER_RESET_SECONDS)
+        self._stats_lock = threading.Lock()
+        self._stats = {"calls": 0, "attempts": 0, "retries": 0, "succeeded": 0, "failed": 0,
+                       "throttled": 0, "short_circuited": 0, "deadline_exceeded": 0}
+
+    def _count(self, key: str) -> None:
+        with self._stats_lock:
+            self._stats[key] += 1
+
+    def stats(self) -> dict:
+        with self._stats_lock:
+            stats = dict(self._stats)
+        stats.update(limit=round(self.limiter.limit, 2), in_flight=self.limiter.in_flight, breaker=self.breaker.state)
+        return stats
+
+    def _attempt(self, fn, args, kwargs, expires_at: float):
+        self._count("attempts")
+        if not self.breaker.allow():
+            self._count("short_circuited")
+            raise CircuitOpen(f"{self.name} circuit is open; failing fast.")
+        if not self.limiter.acquire(expires_at - time.monotonic()):
+            self.breaker.record_ignored()
+            self._count("deadline_exceeded")
+            raise GatewayDeadlineExceeded(f"{self.name} call waited past its deadline for a slot.")
+
+        if self.timeout_kwarg:
+            kwargs = dict(kwargs, **{self.timeout_kwarg: max(1.0, expires_at - time.monotonic())})
+        try:
+            result = fn(*args, **kwargs)
+        except google_exceptions.TooManyRequests:
+            # Quota pressure, not an outage: back off without tripping the breaker
+            self._count("throttled")
+            self.limiter.release(overloaded=True)
+            self.breaker.record_ignored()
+            raise
+        except OVERLOAD_ERRORS:
+            self._count("throttled")
+            self.limiter.release(overloaded=True)
+            self.breaker.record_failure()
+            raise
+        except TRANSIENT_ERRORS:
+            self.limiter.release()
+            self.breaker.record_failure()
+            raise
+        except BaseException:
+            # Caller errors (bad request, auth) are not a sign the service is down
+            self.limiter.release()
+            self.breaker.record_ignored()
+            raise
+        self.limiter.release(succeeded=True)
+        self.breaker.record_success()
+        return result
+
+    def call(self, fn, *args, deadline: float = None, **kwargs):
+        """
+        Call fn(*args, **kwargs) under this service's limiter, breaker and retry
+        policy. Raises the last error once attempts or the deadline run out.
+        """
+        self._count("calls")
+        budget = self.deadline if deadline is None else deadline
+        expires_at = time.monotonic() + budget
+        stage_deadline = _stage_deadline.get()
+        if stage_deadline is not None and stage_deadline < expires_at:
+            # The request stage gave up earlier; don't start work nobody will read
+            if stage_deadline <= time.monotonic():
+                self._count("deadline_exceeded")
+                raise GatewayDeadlineExceeded(f"{self.name} call made after its stage deadline.")
+            expires_at = stage_deadline
+            budget = expires_at - time.monotonic()
+
+        def before_sleep(retry_state):
+            self._count("retries")
+            print(f"{self.name} call failed ({retry_state.outcome.exception()!r}); retry {retry_state.attempt_number}")
+
+        retrying = Retrying(
+            retry=retry_if_exception(lambda e: isinstance(e, TRANSIENT_ERRORS)),
+            wait=wait_random_exponential(multiplier=GATEWAY_BACKOFF_BASE, max=GATEWAY_BACKOFF_MAX),
+            stop=stop_after_attempt(GATEWAY_MAX_ATTEMPTS) | stop_before_delay(budget),
+            before_sleep=before_sleep,
+            reraise=True,
+        )
+        try:
+            result = retrying(self._attempt, fn, args, kwargs, expires_at)
+        except Exception:
+            self._count("failed")
+            raise
+        self._count("succeeded")
+        return result
+
+
+class HedgePolicy:
+    """
+    Latency hedging for idempotent calls. Once an operation has
+    HEDGE_MIN_SAMPLES latencies, a call still running after the
+    HEDGE_PERCENTILE latency gets one duplicate, and the first success wins.
+    A token bucket refilled by HEDGE_MAX_EXTRA_RATIO per call caps the extra load.
+    """
+
+    def __init__(self, operations: set, percentile: float, max_extra_ratio: float, min_samples: int, max_workers: int = 32):
+        self.operations = operations
+        self.percentile = percentile
+        self.max_extra_ratio = max_extra_ratio
+        self.min_samples = min_samples
+        self._latencies: dict[str, deque] = {}
+        self._tokens = 1.0
+        self._lock = threading.Lock()
+        self._executor = None
+        self._max_workers = max_workers
+        self._stats = {"calls": 0, "hedged": 0, "hedge_won": 0, "primary_won": 0, "budget_exhausted": 0}
+
+    def stats(self) -> dict:
+        with self._lock:
+            delays = {op: self._delay_locked(op) for op in self._latencies}
+            return dict(self._stats, delay_s={op: round(d, 3) for op, d in delays.items() if d is not None})
+
+    def _record(self, operation: str, started: float, future) -> None:
+        if future.cancelled() or future.exception() is not None:
+            return
+        with self._lock:
+            self._latencies.setdefault(operation, deque(maxlen=HEDGE_WINDOW)).append(time.monotonic() - started)
+
+    def _delay_locked(self, operation: str) -> float:
+        samples = self._latencies.get(operation)
+        if not samples or len(samples) < self.min_samples:
+            return None
+        ordered = sorted(samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * self.percentile / 100))]
+
+    def _submit(self, operation: str, fn, args, kwargs):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self._max_workers, thread_name_prefix="hedge")
+            executor = self._executor
+        started = time.monotonic()
+        # Carry the caller's stage deadline into the hedge thread
+        future = executor.submit(contextvars.copy_context().run, fn, *args, **kwargs)
+        future.add_done_callback(lambda f: self._record(operation, started, f))
+        return future
+
+    def call(self, operation: str, fn, *args, **kwargs):
+        """Run fn(*args, **kwargs), hedging it if operation is opted in and slow."""
+        if operation not in self.operations:
+            return fn(*args, **kwargs)
+        with self._lock:
+            self._stats["calls"] += 1
+            self._tokens = min(10.0, self._tokens + self.max_extra_ratio)
+            delay = self._delay_locked(operation)
+
+        primary = self._submit(operation, fn, args, kwargs)
+        if delay is None:
+            return primary.result()
+        done, _ = wait([primary], timeout=delay)
+        if done:
+            return primary.result()
+
+        with self._lock:
+            allowed = self._tokens >= 1.0
+            if allowed:
+                self._tokens -= 1.0
+                self._stats["hedged"] += 1
+            else:
+                self._stats["budget_exhausted"] += 1
+        if not allowed:
+            return primary.result()
+
+        hedge = self._submit(operation, fn, args, kwargs)
+        pending = {primary, hedge}
+        while True:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            # Any successful attempt wins; a failed one falls through to the other
+            for future in done:
+                if future.exception() is None:
+                    with self._lock:
+                        self._stats["hedge_won" if future is hedge else "primary_won"] += 1
+                    return future.result()
+            if not pending:
+                # Both attempts failed: report the primary's error
+                return primary.result()
+
+
+# --- GATEWAYS ---
+# Vertex generate_content takes no timeout argument, so Gemini deadlines bound
+# queueing and retries only; Document AI and Vision also get the remaining time
+# as their RPC timeout.
+GEMINI = ServiceGateway(
+    "gemini",
+    initial_limit=int(os.getenv("GEMINI_CONCURRENCY", "8")),
+    max_limit=int(os.getenv("GEMINI_MAX_CONCURRENCY", "32")),
+    deadline=float(os.getenv("GEMINI_DEADLINE_SECONDS", "120")),
+)
+DOCAI = ServiceGateway(
+    "docai",
+    initial_limit=int(os.getenv("DOCAI_CONCURRENCY", "4")),
+    max_limit=int(os.getenv("DOCAI_MAX_CONCURRENCY", "16")),
+    deadline=float(os.getenv("DOCAI_DEADLINE_SECONDS", "120")),
+    timeout_kwarg="timeout",
+)
+VISION = ServiceGateway(
+    "vision",
+    initial_limit=int(os.getenv("VISION_CONCURRENCY", "8")),
+    max_limit=int(os.getenv("VISION_MAX_CONCURRENCY", "32")),
+    deadline=float(os.getenv("VISION_DEADLINE_SECONDS", "30")),
+    timeout_kwarg="timeout",
+)
+
+
+GEMINI_HEDGING = HedgePolicy(HEDGE_OPERATIONS, HEDGE_PERCENTILE, HEDGE_MAX_EXTRA_RATIO, HEDGE_MIN_SAMPLES)
+
+
+def gateway_stats() -> dict:
+    """Per-service counters plus the current limit, in-flight calls and breaker state."""
+    stats = {gateway.name: gateway.stats() for gateway in (GEMINI, DOCAI, VISION)}
+    stats["gemini"]["hedging"] = GEMINI_HEDGING.stats()
+    return stats
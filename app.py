@@ -1,10 +1,14 @@
 from flask import Flask, render_template, request, jsonify, Response, session
 import os
 import json
-from google.oauth2 import service_account
-from google.auth import default as google_auth_default
-from google.cloud import documentai
-from concurrent.futures import ThreadPoolExecutor
+import time
+import uuid
+import hashlib
+import threading
+from collections import OrderedDict
+from datetime import datetime, timezone
+from werkzeug.http import is_resource_modified
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FuturesTimeoutError
 
 from legal_analyzer import (
     summarize_text,
@@ -13,73 +17,307 @@ from legal_analyzer import (
     render_risks_html,
     compute_risk_stats,
     rewrite_clause,
-    risks_to_csv,
+    rewrite_clauses,
+    prewarm_rewrites,
+    iter_risks_csv,
     risks_to_html,
     risks_to_pdf_bytes,
     is_legal_document,  # pyright: ignore[reportUnusedImport]
+    analyze_document_fused,
+    localized_summary,
+    localized_risks,
+    prewarm_translations,
+    preliminary_risks,
+    analyze_revision,
+    document_id,
+    PRESET_LANGUAGES,
     check_document_authenticity,
     check_page_limit,
     check_document_logos,
-    check_document_blur
+    check_document_blur,
+    get_metrics,
+    record_metric,
 )
+from text_normalizer import normalize_ocr_text, PAGE_SEPARATOR
+import cpu_pool
+import api_gateway
+import google_clients
+import llm_backends
+import single_flight
+import uploads
 
-# --- NEW, MORE ROBUST CREDENTIALS LOGIC ---
-# This new section can handle credentials from a local file OR a secure environment variable.
-credentials = None
-
-# 1. First, try to load credentials from the environment variable (for Render)
-creds_json_str = os.environ.get('GOOGLE_APPLICATION_CREDENTIALS_JSON')
-if creds_json_str:
-    try:
-        creds_info = json.loads(creds_json_str)
-        credentials = service_account.Credentials.from_service_account_info(creds_info)
-        print("Successfully loaded credentials from environment variable.")
-    except Exception as e:
-        print(f"Error loading credentials from environment variable: {e}")
-
-# 2. If that fails, try loading from the local credentials.json file (for local development)
-if not credentials:
-    try:
-        credentials = service_account.Credentials.from_service_account_file("credentials.json")
-        print("Successfully loaded credentials from local file.")
-    except Exception:
-        pass
-
-# 3. As a final fallback, try Application Default Credentials (for Google Cloud Run)
-if not credentials:
-    try:
-        credentials, _ = google_auth_default()
-        print("Successfully loaded credentials using Application Default Credentials.")
-    except Exception:
-        print("Could not load credentials from any source.")
-# --------------------------------------------------------------------------
+# Credentials and Google clients are loaded on first use by google_clients,
+# shared with legal_analyzer.
 
 
 # --- Configuration ---
 PROJECT_ID = "legalease-ai-471416"
 DOCAI_LOCATION = "eu"
 DOCAI_PROCESSOR_ID = "3c22ed109a51b5e9" # Make sure this is your Document OCR Processor ID
+# "standard" = separate legal check, summary and risk calls; "fused" = one structured call.
+# Can be overridden per request with the analysis_mode form field or ?mode= query parameter.
+ANALYSIS_MODE = os.environ.get("ANALYSIS_MODE", "standard")
+# How long the page waits for analysis before rendering what has finished.
+# Unfinished stages render a placeholder the page fetches from /analysis/<job>/<stage>.
+REQUEST_BUDGET_SECONDS = float(os.environ.get("REQUEST_BUDGET_SECONDS", "45"))
+# Hard per-stage deadlines; a stage still running after this is abandoned.
+STAGE_DEADLINES = {
+    "docai": float(os.environ.get("DOCAI_STAGE_SECONDS", "60")),
+    "legal_check": float(os.environ.get("LEGAL_CHECK_STAGE_SECONDS", "20")),
+    "fused": float(os.environ.get("ANALYSIS_STAGE_SECONDS", "120")),
+    "summary": float(os.environ.get("ANALYSIS_STAGE_SECONDS", "120")),
+    "risks": float(os.environ.get("ANALYSIS_STAGE_SECONDS", "120")),
+}
+# Unfetched late results are dropped after this long
+PENDING_STAGE_TTL_SECONDS = 600
 # -----------------------------------------------
 
 app = Flask(__name__)
 app.secret_key = os.urandom(24)
-
-def process_document_with_docai(file_content, mime_type):
-    """Processes a document using Document AI."""
-    opts = {"api_endpoint": f"{DOCAI_LOCATION}-documentai.googleapis.com"}
-    client = documentai.DocumentProcessorServiceClient(client_options=opts, credentials=credentials)
+# Uploads are spooled to temp files; bodies over the limit are rejected with 413 before parsing
+app.request_class = uploads.SpoolingRequest
+app.config["MAX_CONTENT_LENGTH"] = uploads.MAX_UPLOAD_BYTES
+
+# Document AI text by file hash, so re-uploading a file (e.g. to switch language) skips OCR
+OCR_CACHE_MAX_DOCUMENTS = int(os.environ.get("OCR_CACHE_MAX_DOCUMENTS", "128"))
+_ocr_cache = OrderedDict()
+_ocr_cache_lock = threading.Lock()
+
+
+@single_flight.coalesce("process_document_with_docai")
+def process_document_with_docai(upload):
+    """Processes an uploaded document (uploads.SpooledUpload) using Document AI."""
+    cache_key = upload.sha256 + upload.mime_type
+    with _ocr_cache_lock:
+        if cache_key in _ocr_cache:
+            _ocr_cache.move_to_end(cache_key)
+            record_metric("ocr_cache.hits")
+            return _ocr_cache[cache_key]
+    text = _process_document_with_docai(upload)
+    with _ocr_cache_lock:
+        _ocr_cache[cache_key] = text
+        while len(_ocr_cache) > OCR_CACHE_MAX_DOCUMENTS:
+            _ocr_cache.popitem(last=False)
+    return text
+
+
+def _process_document_with_docai(upload):
+    from google.cloud import documentai
+    client = google_clients.documentai_client(DOCAI_LOCATION)
     name = client.processor_path(PROJECT_ID, DOCAI_LOCATION, DOCAI_PROCESSOR_ID)
-    raw_document = documentai.RawDocument(content=file_content, mime_type=mime_type)
-    
-    # --- The imageless mode logic has been removed from this section ---
-    request = documentai.ProcessRequest(
-        name=name,
-        raw_document=raw_document,
-    )
-    result = client.process_document(request=request)
-    return result.document.text
+    # Document AI takes the document inline; the read counts against the upload memory budget
+    with upload.in_memory() as content:
+        raw_document = documentai.RawDocument(content=content, mime_type=upload.mime_type)
+        
+        # --- The imageless mode logic has been removed from this section ---
+        request = documentai.ProcessRequest(
+            name=name,
+            raw_document=raw_document,
+        )
+        result = api_gateway.DOCAI.call(client.process_document, request=request)
+    document = result.document
+    # Keep page boundaries (form feeds) so repeated headers/footers can be detected
+    pages = [
+        "".join(document.text[int(seg.start_index):int(seg.end_index)] for seg in page.layout.text_anchor.text_segments)
+        for page in document.pages
+    ]
+    return PAGE_SEPARATOR.join(pages) if any(pages) else document.text
+
+
+def normalize_for_analysis(text: str) -> str:
+    """Strip OCR noise before the text reaches any prompt, and record what it saved."""
+    normalized = normalize_ocr_text(text)
+    stats = normalized["stats"]
+    record_metric("ocr_normalize.documents")
+    record_metric("ocr_normalize.chars_saved", stats["chars_saved"])
+    record_metric("ocr_normalize.tokens_saved_est", stats["tokens_saved_est"])
+    if stats["chars_saved"]:
+        print(f"OCR normalization saved {stats['chars_saved']} chars (~{stats['tokens_saved_est']} tokens), "
+              f"removed {stats['lines_removed']} lines, joined {stats['hyphenations_joined']} hyphenations.")
+    return normalized["text"]
+
+# --- STAGED ANALYSIS ---
+# Shared pool so a request never blocks on executor shutdown waiting for a slow stage
+analysis_executor = ThreadPoolExecutor(max_workers=16, thread_name_prefix="analysis")
+# Speculative prewarming (rewrites, translations) gets its own small pool so it
+# never takes threads from live analysis; work beyond PREWARM_MAX_PENDING is dropped
+PREWARM_WORKERS = int(os.environ.get("PREWARM_WORKERS", "2"))
+PREWARM_MAX_PENDING = int(os.environ.get("PREWARM_MAX_PENDING", "8"))
+prewarm_executor = ThreadPoolExecutor(max_workers=PREWARM_WORKERS, thread_name_prefix="prewarm")
+_prewarm_slots = threading.BoundedSemaphore(PREWARM_MAX_PENDING)
+# job id -> {"created", "language", "stages": {stage: (future, extract)}}
+_pending_jobs: dict[str, dict] = {}
+_pending_jobs_lock = threading.Lock()
+
+NOT_LEGAL_WARNING = "This does not appear to be a legal document. The analysis may be less accurate, but here is our best effort:"
+
+
+def _run_stage(expires_at, fn, *args):
+    # Queued past its deadline (pool saturated): drop it rather than run it late
+    if time.monotonic() >= expires_at:
+        raise api_gateway.GatewayDeadlineExceeded(f"{fn.__name__} started after its stage deadline.")
+    with api_gateway.deadline_scope(expires_at):
+        return fn(*args)
+
+
+def submit_stage(stage: str, fn, *args):
+    """Run fn(*args) on the analysis pool; its Google API calls stop at the stage deadline."""
+    expires_at = time.monotonic() + STAGE_DEADLINES[stage]
+    return analysis_executor.submit(_run_stage, expires_at, fn, *args)
+
+
+def submit_prewarm(fn, *args) -> None:
+    """Run fn(*args) on the prewarm pool, or skip it when the pool is backed up."""
+    if not _prewarm_slots.acquire(blocking=False):
+        record_metric("prewarm.dropped")
+        return
+    try:
+        future = prewarm_executor.submit(fn, *args)
+    except Exception:
+        _prewarm_slots.release()
+        raise
+    future.add_done_callback(lambda _: _prewarm_slots.release())
+
+
+def wait_stage(future, request_deadline: float) -> tuple:
+    """Return ("done", value), ("pending", None) or ("failed", error) by the request deadline."""
+    try:
+        return "done", future.result(timeout=max(0.0, request_deadline - time.monotonic()))
+    except FuturesTimeoutError:
+        return "pending", None
+    except Exception as e:
+        print(f"Analysis stage failed: {e}")
+        return "failed", e
+
+
+def _expire_pending_jobs() -> None:
+    cutoff = time.monotonic() - PENDING_STAGE_TTL_SECONDS
+    with _pending_jobs_lock:
+        for job_id in [job_id for job_id, job in _pending_jobs.items() if job["created"] < cutoff]:
+            for future, _ in _pending_jobs.pop(job_id)["stages"].values():
+                future.cancel()
+
+
+def register_pending_stages(stages: dict, language: str) -> str:
+    """Keep unfinished stages so the page can fetch them later; returns the job id."""
+    _expire_pending_jobs()
+    job_id = uuid.uuid4().hex
+    with _pending_jobs_lock:
+        _pending_jobs[job_id] = {"created": time.monotonic(), "language": language, "stages": stages}
+    return job_id
+
+
+def stage_placeholder(job_id: str, stage: str, preliminary_html: str = None) -> str:
+    label = "summary" if stage == "summary" else "risk analysis"
+    if preliminary_html:
+        # Shown until the final result replaces the whole placeholder
+        return (f"<div class='stage-pending' data-stage-url='/analysis/{job_id}/{stage}'>"
+                f"<p style='color: #ffcc00;'>⏳ Preliminary {label} from a nearly identical document; "
+                f"changed clauses are still being analyzed.</p>{preliminary_html}</div>")
+    return (f"<div class='stage-pending' data-stage-url='/analysis/{job_id}/{stage}'>"
+            f"<p style='color: #ffcc00;'>⏳ The {label} is taking longer than usual. It will appear here when ready.</p></div>")
+
+
+def stage_failed(stage: str) -> str:
+    label = "summary" if stage == "summary" else "risk analysis"
+    return f"<p style='color: #ff6b6b;'><b>Error:</b> The {label} could not be completed. Please try again.</p>"
+
+
+
+# --- EXPORT ARTIFACTS ---
+# Exports and /risks.json are built once per analysis and cached by a hash of
+# the session's risks. The hash doubles as the ETag, so a conditional GET is
+# answered with 304 before anything is rendered.
+EXPORT_CACHE_MAX_ENTRIES = int(os.environ.get("EXPORT_CACHE_MAX_ENTRIES", "256"))
+EXPORT_FORMATS = {
+    "csv": ("text/csv", "risks.csv"),
+    "html": ("text/html", "risks.html"),
+    "pdf": ("application/pdf", "risks.pdf"),
+    "json": ("application/json", None),
+}
+# (format, content hash) -> {"body": bytes, "last_modified": datetime}
+_export_cache = OrderedDict()
+_export_cache_lock = threading.Lock()
+
+
+def _export_fingerprint(kind, risks, language):
+    payload = json.dumps([kind, language, risks], sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def _cached_export(key):
+    with _export_cache_lock:
+        entry = _export_cache.get(key)
+        if entry is not None:
+            _export_cache.move_to_end(key)
+        return entry
+
+
+def _store_export(key, body, last_modified):
+    with _export_cache_lock:
+        _export_cache[key] = {"body": body, "last_modified": last_modified}
+        while len(_export_cache) > EXPORT_CACHE_MAX_ENTRIES:
+            _export_cache.popitem(last=False)
+
+
+def _build_export(kind, risks, language):
+    if kind == "html":
+        return risks_to_html(risks, target_language=language).encode("utf-8")
+    if kind == "pdf":
+        return risks_to_pdf_bytes(risks, target_language=language)
+    stats = compute_risk_stats(risks) if risks else {"severity": {}, "type": {}}
+    return json.dumps({"risks": risks, "stats": stats}, ensure_ascii=False).encode("utf-8")
+
+
+def _stream_csv(key, risks, last_modified):
+    """Stream the CSV and keep the finished file for the next download."""
+    chunks = []
+    for line in iter_risks_csv(risks):
+        chunk = line.encode("utf-8")
+        chunks.append(chunk)
+        yield chunk
+    _store_export(key, b"".join(chunks), last_modified)
+
+
+def serve_export(kind):
+    """Serve the session's risks as kind, from the artifact cache, with ETag/Last-Modified validators."""
+    risks = session.get('risks', [])
+    language = session.get('risk_language', 'English')
+    mimetype, filename = EXPORT_FORMATS[kind]
+    if kind == "pdf":
+        import pdf_report
+        if not pdf_report.supports_language(language):
+            record_metric("export.pdf.unsupported_language")
+            return Response(f"PDF export is not available in {language}; use the HTML or CSV export instead.",
+                            status=422, mimetype="text/plain")
+    etag = _export_fingerprint(kind, risks, language)
+    key = (kind, etag)
+    entry = _cached_export(key)
+    last_modified = entry["last_modified"] if entry else datetime.now(timezone.utc).replace(microsecond=0)
+
+    if not is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+        record_metric(f"export.{kind}.not_modified")
+        response = Response(status=304)
+    elif entry is not None:
+        record_metric(f"export.{kind}.hits")
+        response = Response(entry["body"], mimetype=mimetype)
+    elif kind == "csv":
+        record_metric(f"export.{kind}.misses")
+        response = Response(_stream_csv(key, risks, last_modified), mimetype=mimetype)
+    else:
+        record_metric(f"export.{kind}.misses")
+        body = _build_export(kind, risks, language)
+        _store_export(key, body, last_modified)
+        response = Response(body, mimetype=mimetype)
+
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    # Per-session content: browsers may keep it but must revalidate
+    response.headers["Cache-Control"] = "private, no-cache"
+    if filename and response.status_code == 200:
+        response.headers["Content-Disposition"] = f"attachment; filename={filename}"
+    return response
 
-# ... (The rest of your app.py file is the same) ...
 
 @app.route("/", methods=["GET", "POST"])
 @app.route("/", methods=["GET", "POST"])
@@ -91,52 +329,104 @@ def index():
 
     if request.method == "POST":
         selected_language = request.form.get("target_language", "English")
+        analysis_mode = request.form.get("analysis_mode") or request.args.get("mode") or ANALYSIS_MODE
         text_to_analyze = ""
         uploaded_file = request.files.get('pdf_file')
         pasted_text = request.form.get("legal_text", "")
 
+        started = time.monotonic()
         try:
             # Step 1: Extract text from the document (this remains sequential)
             if uploaded_file and uploaded_file.filename != '':
-                file_content = uploaded_file.read()
-                mime_type = uploaded_file.mimetype
+                upload = uploads.from_file_storage(uploaded_file)
                 
                 # Check page limit first
-                page_limit_result = check_page_limit(file_content, mime_type)
+                page_limit_result = check_page_limit(upload)
                 if page_limit_result['exceeds_limit']:
                     warning_message = f"📄 {page_limit_result['message']} {page_limit_result['recommendation']}"
                     return render_template("index.html", result=None, original_text="", risk_html=None, warning_message=warning_message)
                 
-                text_to_analyze = process_document_with_docai(file_content, mime_type)
+                # Phone photos: orientation, page crop and downscale before OCR
+                upload = uploads.normalize_image(uploaded_file, upload)
+                with api_gateway.deadline_scope(started + STAGE_DEADLINES["docai"]):
+                    text_to_analyze = process_document_with_docai(upload)
             elif pasted_text:
                 text_to_analyze = pasted_text
-            
+
+            text_to_analyze = normalize_for_analysis(text_to_analyze)
             original_text = text_to_analyze
 
             if text_to_analyze:
-                # Step 2: Run the quick legal document check first
-                if not is_legal_document(text_to_analyze):
-                    warning_message = "This does not appear to be a legal document. The analysis may be less accurate, but here is our best effort:"
-
-                # --- NEW PARALLEL EXECUTION BLOCK ---
-                # Step 3: Run the two slow AI tasks (summary and risks) at the same time
-                with ThreadPoolExecutor() as executor:
-                    # Submit both functions to the executor to run concurrently
-                    summary_future = executor.submit(summarize_text, text_to_analyze, selected_language)
-                    risks_future = executor.submit(analyze_risks, text_to_analyze, selected_language)
-
-                # Step 4: Wait for both tasks to finish and get their results
-                html_result = summary_future.result()
-                risks = risks_future.result()
-                # --- END OF PARALLEL BLOCK ---
-
-                # Step 5: Proceed with the now-completed results
-                risk_html = render_risks_html(risks, target_language=selected_language)
-                session['risks'] = risks
-                session['risk_language'] = selected_language
+                # Later revisions of this contract can be registered against it via /versions.
+                # Fused analyses keep no canonical risks to diff against, so they are not offered.
+                if analysis_mode == "fused":
+                    session.pop('document_id', None)
+                else:
+                    session['document_id'] = document_id(text_to_analyze)
+                request_deadline = started + REQUEST_BUDGET_SECONDS
+                # stage -> (future, extract) for anything that misses the budget
+                late_stages = {}
+                summary_status = risks_status = None
+
+                # Fused mode: legal check, summary and risks from a single call
+                if analysis_mode == "fused":
+                    fused_future = submit_stage("fused", analyze_document_fused, text_to_analyze, selected_language)
+                    status, fused = wait_stage(fused_future, request_deadline)
+                    if status == "done" and fused is not None:
+                        if not fused["is_legal"]:
+                            warning_message = NOT_LEGAL_WARNING
+                        summary_status, html_result = "done", fused["summary_html"]
+                        risks_status, risks = "done", fused["risks"]
+                    elif status == "pending":
+                        summary_status = risks_status = "pending"
+                        late_stages["summary"] = (fused_future, lambda r: r["summary_html"])
+                        late_stages["risks"] = (fused_future, lambda r: r["risks"])
+
+                if summary_status is None:
+                    # Step 2: The legal document check, summary and risks run at the same time
+                    legal_future = submit_stage("legal_check", is_legal_document, text_to_analyze)
+                    # Computed once per document; other languages only translate the results
+                    summary_future = submit_stage("summary", localized_summary, text_to_analyze, selected_language)
+                    risks_future = submit_stage("risks", localized_risks, text_to_analyze, selected_language)
+
+                    # Step 3: Wait for each stage until the request budget runs out
+                    legal_status, is_legal = wait_stage(legal_future, min(request_deadline, time.monotonic() + STAGE_DEADLINES["legal_check"]))
+                    if legal_status == "done" and not is_legal:
+                        warning_message = NOT_LEGAL_WARNING
+                    elif legal_status == "pending":
+                        legal_future.cancel()
+                    summary_status, html_result = wait_stage(summary_future, request_deadline)
+                    risks_status, risks = wait_stage(risks_future, request_deadline)
+                    if summary_status == "pending":
+                        late_stages["summary"] = (summary_future, None)
+                    if risks_status == "pending":
+                        late_stages["risks"] = (risks_future, None)
+
+                    if PRESET_LANGUAGES:
+                        submit_prewarm(prewarm_translations, text_to_analyze)
+
+                # Step 4: Render what finished; slow stages get a placeholder, failures an error
+                job_id = register_pending_stages(late_stages, selected_language) if late_stages else None
+                if summary_status == "pending":
+                    html_result = stage_placeholder(job_id, "summary")
+                elif summary_status != "done":
+                    html_result = stage_failed("summary")
+                if risks_status == "done":
+                    risk_html = render_risks_html(risks, target_language=selected_language)
+                    session['risks'] = risks
+                    session['risk_language'] = selected_language
+                    submit_prewarm(prewarm_rewrites, risks, selected_language)
+                elif risks_status == "pending":
+                    preliminary = preliminary_risks(text_to_analyze, selected_language) if analysis_mode != "fused" else None
+                    preliminary_html = render_risks_html(preliminary, target_language=selected_language) if preliminary else None
+                    risk_html = stage_placeholder(job_id, "risks", preliminary_html)
+                else:
+                    risk_html = stage_failed("risks")
             else:
                 html_result = "<p style='color: #ffcc00;'>Please paste text or upload a file to analyze.</p>"
 
+        except uploads.UploadMemoryBusy as e:
+            html_result = f"<p style='color: #ffcc00;'>{e}</p>"
         except Exception as e:
             html_result = f"<p style='color: #ff6b6b;'><b>Error:</b> Could not process the document. Details: {e}</p>"
 
@@ -155,11 +445,106 @@ def chat():
     bot_response = get_chatbot_response(history, document_text)
     return {"response": bot_response}
 
+@app.route("/analysis/<job_id>/<stage>")
+def analysis_stage(job_id, stage):
+    """Late result of a stage that missed the page's request budget."""
+    with _pending_jobs_lock:
+        job = _pending_jobs.get(job_id)
+        entry = job["stages"].get(stage) if job else None
+    if entry is None:
+        return jsonify({"status": "unknown"}), 404
+
+    future, extract = entry
+    if not future.done():
+        return jsonify({"status": "pending"}), 202
+
+    with _pending_jobs_lock:
+        job["stages"].pop(stage, None)
+        if not job["stages"]:
+            _pending_jobs.pop(job_id, None)
+    try:
+        value = future.result()
+        if extract is not None:
+            value = extract(value)
+    except Exception as e:
+        print(f"Late analysis stage {stage} failed: {e}")
+        return jsonify({"status": "failed", "html": stage_failed(stage)})
+
+    if stage == "risks":
+        session['risks'] = value
+        session['risk_language'] = job["language"]
+        submit_prewarm(prewarm_rewrites, value, job["language"])
+        return jsonify({"status": "done", "html": render_risks_html(value, target_language=job["language"])})
+    return jsonify({"status": "done", "html": value})
+
+
+@app.route("/versions", methods=["POST"])
+def register_version():
+    """
+    Analyze a new revision of a contract against an earlier analysis. Only
+    clauses that changed or were added are re-analyzed; the response carries
+    the merged risks and what changed in risk terms. Only standard-mode
+    analyses can be revised.
+    """
+    data = request.get_json(silent=True) or request.form
+    previous_id = data.get("previous_document_id") or session.get('document_id')
+    language = data.get("target_language", session.get('risk_language', 'English'))
+    if not previous_id:
+        return jsonify({"error": "No previous_document_id provided"}), 400
+
+    started = time.monotonic()
+    uploaded_file = request.files.get('pdf_file')
+    try:
+        if uploaded_file and uploaded_file.filename != '':
+            upload = uploads.from_file_storage(uploaded_file)
+            page_limit_result = check_page_limit(upload)
+            if page_limit_result['exceeds_limit']:
+                return jsonify({
+                    "error": f"{page_limit_result['message']} {page_limit_result['recommendation']}",
+                    "page_details": page_limit_result
+                }), 400
+            with api_gateway.deadline_scope(started + STAGE_DEADLINES["docai"]):
+                upload = uploads.normalize_image(uploaded_file, upload)
+                text = process_document_with_docai(upload)
+        else:
+            text = data.get("legal_text", "")
+        text = normalize_for_analysis(text)
+    except uploads.UploadMemoryBusy as e:
+        return jsonify({"error": str(e)}), 503
+    except Exception as e:
+        return jsonify({"error": f"Could not process the document: {e}"}), 500
+    if not text:
+        return jsonify({"error": "Please paste text or upload a file"}), 400
+
+    with api_gateway.deadline_scope(started + STAGE_DEADLINES["risks"]):
+        result = analyze_revision(text, previous_id, language)
+    if result is None:
+        return jsonify({"error": "Previous analysis not found; analyze the document in full first"}), 404
+
+    session['document_id'] = result["document_id"]
+    session['risks'] = result["risks"]
+    session['risk_language'] = language
+    submit_prewarm(prewarm_rewrites, result["risks"], language)
+    result["stats"] = compute_risk_stats(result["risks"])
+    result["risk_html"] = render_risks_html(result["risks"], target_language=language)
+    return jsonify(result)
+
+
+@app.route("/metrics")
+def metrics():
+    """Process-wide counters for the analyzer, CPU pool, API gateways, request coalescing, uploads and LLM backend."""
+    return jsonify({
+        "analyzer": get_metrics(),
+        "cpu_pool": cpu_pool.pool_stats(),
+        "gateway": api_gateway.gateway_stats(),
+        "single_flight": single_flight.flight_stats(),
+        "uploads": uploads.upload_stats(),
+        "llm": llm_backends.backend_stats(),
+    })
+
 @app.route("/risks.json")
 def risks_json():
-    risks = session.get('risks', [])
-    stats = compute_risk_stats(risks) if risks else {"severity": {}, "type": {}}
-    return jsonify({"risks": risks, "stats": stats})
+    return serve_export("json")
 
 @app.route("/rewrite", methods=["POST"])
 def rewrite():
@@ -172,37 +557,28 @@ def rewrite():
     safer = rewrite_clause(clause, target_language=language, mode=mode)
     return jsonify({"rewrite": safer})
 
+@app.route("/rewrite/batch", methods=["POST"])
+def rewrite_batch():
+    """Rewrite many clauses at once; returns rewrites in the order of the clauses."""
+    data = request.get_json(silent=True) or {}
+    clauses = data.get("clauses") or []
+    mode = data.get("mode", "plain")
+    language = data.get("language", session.get('risk_language', 'English'))
+    if not clauses or not all(isinstance(c, str) and c.strip() for c in clauses):
+        return jsonify({"error": "Provide a non-empty list of clauses"}), 400
+    return jsonify({"rewrites": rewrite_clauses(clauses, target_language=language, mode=mode)})
+
 @app.route("/export.csv")
 def export_csv():
-    risks = session.get('risks', [])
-    csv_str = risks_to_csv(risks)
-    return Response(
-        csv_str,
-        mimetype='text/csv',
-        headers={"Content-Disposition": "attachment; filename=risks.csv"}
-    )
+    return serve_export("csv")
 
 @app.route("/export.html")
 def export_html():
-    risks = session.get('risks', [])
-    language = session.get('risk_language', 'English')
-    html_doc = risks_to_html(risks, target_language=language)
-    return Response(
-        html_doc,
-        mimetype='text/html',
-        headers={"Content-Disposition": "attachment; filename=risks.html"}
-    )
+    return serve_export("html")
 
 @app.route("/export.pdf")
 def export_pdf():
-    risks = session.get('risks', [])
-    language = session.get('risk_language', 'English')
-    pdf_bytes = risks_to_pdf_bytes(risks, target_language=language)
-    return Response(
-        pdf_bytes,
-        mimetype='application/pdf',
-        headers={"Content-Disposition": "attachment; filename=risks.pdf"}
-    )
+    return serve_export("pdf")
 
 
 @app.route("/check-authenticity", methods=["POST"])
@@ -214,19 +590,17 @@ def check_authenticity():
     3. Checks Authenticity
     """
     text_to_analyze = ""
-    file_content = None
-    mime_type = None
+    upload = None
     
     uploaded_file = request.files.get('pdf_file')
     pasted_text = request.form.get("legal_text", "")
 
     try:
         if uploaded_file and uploaded_file.filename != '':
-            file_content = uploaded_file.read()
-            mime_type = uploaded_file.mimetype
+            upload = uploads.from_file_storage(uploaded_file)
             
             # --- CHECK 1: PAGE LIMIT (Existing) ---
-            page_limit_result = check_page_limit(file_content, mime_type)
+            page_limit_result = check_page_limit(upload)
             if page_limit_result['exceeds_limit']:
                 return jsonify({
                     "verdict": "PAGE_LIMIT_EXCEEDED",
@@ -236,8 +610,8 @@ def check_authenticity():
                 })
             
             # --- NEW CHECK 2: BLUR ---
-            # Run the blur check on the raw file content
-            blur_check = check_document_blur(file_content, mime_type)
+            # Run the blur check on the uploaded file
+            blur_check = check_document_blur(upload)
             if blur_check["is_blurry"]:
                 return jsonify({
                     "verdict": "BLURRY",
@@ -247,23 +621,25 @@ def check_authenticity():
                 })
             
             # --- IF CHECKS PASS, GET TEXT FOR AUTHENTICITY ---
-            text_to_analyze = process_document_with_docai(file_content, mime_type)
+            # Blur is judged on the original; OCR and logos get the normalized photo
+            upload = uploads.normalize_image(uploaded_file, upload)
+            text_to_analyze = process_document_with_docai(upload)
         
         elif pasted_text:
             text_to_analyze = pasted_text
 
         # --- CHECK 3: AUTHENTICITY (Existing) ---
+        text_to_analyze = normalize_for_analysis(text_to_analyze)
         if text_to_analyze:
-            # Pass file content for logo analysis
-            file_content_for_analysis = file_content if (uploaded_file and uploaded_file.filename != '') else None
-            mime_type_for_analysis = mime_type if (uploaded_file and uploaded_file.filename != '') else None
-            
-            report = check_document_authenticity(text_to_analyze, file_content_for_analysis, mime_type_for_analysis)
+            # Pass the uploaded file (if any) for logo analysis
+            report = check_document_authenticity(text_to_analyze, upload)
             return jsonify(report)
         else:
             # No text, return a generic "safe" report
             return jsonify({ "confidence_score": 100, "summary": "No text provided.", "findings": [] })
 
+    except uploads.UploadMemoryBusy as e:
+        return jsonify({"error": str(e)}), 503
     except Exception as e:
         print(f"Error in authenticity check endpoint: {e}")
         return jsonify({"error": "Failed to process document for authenticity check."}), 500
@@ -279,11 +655,10 @@ def check_logos():
         return jsonify({"error": "No file provided for logo analysis."}), 400
     
     try:
-        file_content = uploaded_file.read()
-        mime_type = uploaded_file.mimetype
+        upload = uploads.from_file_storage(uploaded_file)
         
         # Check page limit first
-        page_limit_result = check_page_limit(file_content, mime_type)
+        page_limit_result = check_page_limit(upload)
         if page_limit_result['exceeds_limit']:
             return jsonify({
                 "success": False,
@@ -292,13 +667,26 @@ def check_logos():
             })
         
         # Perform logo analysis
-        logo_result = check_document_logos(file_content, mime_type)
+        upload = uploads.normalize_image(uploaded_file, upload)
+        logo_result = check_document_logos(upload)
         return jsonify(logo_result)
         
     except Exception as e:
         print(f"Error in logo analysis endpoint: {e}")
         return jsonify({"error": "Failed to process document for logo analysis."}), 500
 
+
+@app.errorhandler(413)
+def upload_too_large(e):
+    """Request body over MAX_CONTENT_LENGTH; rejected before the upload is read."""
+    uploads.record_rejected()
+    limit_mb = uploads.MAX_UPLOAD_BYTES / (1024 * 1024)
+    message = f"File is too large. The maximum upload size is {limit_mb:g} MB."
+    if request.path == "/":
+        html_result = f"<p style='color: #ffcc00;'>{message} Please upload a smaller or compressed document.</p>"
+        return render_template("index.html", result=html_result, original_text="", risk_html=None, warning_message=None), 413
+    return jsonify({"error": message}), 413
+
         
 if __name__ == "__main__":
     app.run(debug=True)
@@ -0,0 +1,307 @@
+"""
+Offline batch analysis for a directory of contracts.
+
+Usage:
+    python batch_analyze.py contracts/ --out results.jsonl [--csv risks.csv]
+        [--language English] [--workers 4] [--threads 4] [--authenticity] [--batch-llm]
+        [--max-gemini 16] [--max-docai 8] [--max-vision 8]
+
+Walks the directory for PDFs, images and text files. Each file goes through the
+web app's pipeline: page limit check, OCR with Document AI (photos are
+normalized first), risk analysis and, with --authenticity, the authenticity
+check. Files are spread over a process pool. Each worker process analyzes
+--threads files at a time. The --max-* limits on concurrent external calls are
+split evenly between workers.
+
+Results are written as each file finishes: one JSONL line per file, and one
+CSV row per risk. The JSONL file is the checkpoint. A rerun skips files already
+recorded with the same path and content hash, so after a crash the run resumes
+without redoing finished files. Failed files are tried again.
+
+--batch-llm turns on llm_backends batch mode. Prompts from a worker's threads
+are then grouped into batch submissions, which helps throughput, not latency.
+"""
+import argparse
+import csv
+import json
+import mimetypes
+import os
+import queue
+import sys
+import tempfile
+import threading
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from multiprocessing import Manager, get_context
+
+# --- CONFIGURATION ---
+TEXT_EXTENSIONS = {".txt", ".md"}
+DOCUMENT_EXTENSIONS = {".pdf", ".png", ".jpg", ".jpeg", ".tif", ".tiff", ".bmp", ".gif", ".webp"}
+CSV_FIELDS = ["file", "severity", "type", "clause", "issue", "worst_case", "suggestion"]
+FILES_PER_TASK_PER_THREAD = 2  # files handed to a worker per task, per thread
+
+# Set in each worker process by _init_worker
+_results = None
+_options = None
+
+
+def find_documents(root: str) -> list[str]:
+    """Supported files under root, as sorted paths relative to it."""
+    found = []
+    for directory, _, names in os.walk(root):
+        for name in names:
+            if os.path.splitext(name)[1].lower() in TEXT_EXTENSIONS | DOCUMENT_EXTENSIONS:
+                found.append(os.path.relpath(os.path.join(directory, name), root))
+    return sorted(found)
+
+
+# --- CHECKPOINT AND OUTPUT ---
+class ResultWriter:
+    """
+    Appends one JSONL record per file and its risks to the CSV, flushed and
+    fsynced per file. Records already in the JSONL mark files as finished.
+    """
+
+    def __init__(self, jsonl_path: str, csv_path: str = None):
+        self.jsonl_path = jsonl_path
+        self.csv_path = csv_path
+        self.finished = {}  # (file, sha256) -> record
+        self._load_checkpoint()
+        self._jsonl = open(jsonl_path, "a", encoding="utf-8")
+        self._csv = None
+        if csv_path:
+            # Rebuilt from the checkpoint, dropping rows of files that did not finish
+            self._csv = open(csv_path, "w", encoding="utf-8", newline="")
+            self._csv_writer = csv.DictWriter(self._csv, fieldnames=CSV_FIELDS, extrasaction="ignore")
+            self._csv_writer.writeheader()
+            for record in self.finished.values():
+                self._write_rows(record)
+            self._sync(self._csv)
+
+    def _load_checkpoint(self) -> None:
+        if not os.path.exists(self.jsonl_path):
+            return
+        kept = []
+        with open(self.jsonl_path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue  # line cut short by a crash
+                kept.append(line if line.endswith("\n") else line + "\n")
+                if record.get("status") in ("done", "skipped"):
+                    self.finished[(record["file"], record["sha256"])] = record
+        # Rewrite without a torn last line so appends start on a fresh line
+        with open(self.jsonl_path, "w", encoding="utf-8") as f:
+            f.writelines(kept)
+
+    def is_finished(self, file: str, sha256: str) -> bool:
+        return (file, sha256) in self.finished
+
+    def _write_rows(self, record: dict) -> None:
+        for risk in record.get("risks") or []:
+            self._csv_writer.writerow(dict(risk, file=record["file"]))
+
+    @staticmethod
+    def _sync(f) -> None:
+        f.flush()
+        os.fsync(f.fileno())
+
+    def write(self, record: dict) -> None:
+        if self._csv is not None and record["status"] == "done":
+            self._write_rows(record)
+            self._sync(self._csv)
+        self._jsonl.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self._sync(self._jsonl)
+
+    def close(self) -> None:
+        self._jsonl.close()
+        if self._csv is not None:
+            self._csv.close()
+
+
+# --- WORKER ---
+def _init_worker(results, options: dict) -> None:
+    global _results, _options
+    _results, _options = results, options
+
+
+def _read_text(path: str) -> str:
+    with open(path, encoding="utf-8", errors="replace") as f:
+        return f.read()
+
+
+def _normalized(upload, tmp_dir: str):
+    """Photo normalization as in uploads.normalize_image, into tmp_dir."""
+    import cpu_pool
+    import uploads
+    if not uploads.NORMALIZE_IMAGES or not upload.mime_type.startswith("image/"):
+        return upload
+    output_path = os.path.join(tmp_dir, "normalized.jpg")
+    try:
+        result = cpu_pool.run(cpu_pool.normalize_document_image, upload.path, output_path)
+    except Exception as e:
+        print(f"Error normalizing {upload.filename}: {e}")
+        return upload
+    if not result["written"]:
+        return upload
+    size, sha256 = uploads.hash_file(output_path)
+    return uploads.SpooledUpload(output_path, size, sha256, "image/jpeg", upload.filename)
+
+
+def analyze_file(root: str, file: str, sha256: str, options: dict) -> dict:
+    """Run the analysis pipeline on one file and return its result record."""
+    import uploads
+    from app import normalize_for_analysis, process_document_with_docai
+    from legal_analyzer import check_document_authenticity, check_page_limit, compute_risk_stats, localized_risks
+
+    path = os.path.join(root, file)
+    started = time.monotonic()
+    record = {"file": file, "sha256": sha256, "bytes": os.path.getsize(path)}
+    try:
+        extension = os.path.splitext(file)[1].lower()
+        upload = None
+        with tempfile.TemporaryDirectory(prefix="batch-") as tmp_dir:
+            if extension in TEXT_EXTENSIONS:
+                record["mime_type"] = "text/plain"
+                text = _read_text(path)
+            else:
+                mime_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+                record["mime_type"] = mime_type
+                upload = uploads.SpooledUpload(path, record["bytes"], sha256, mime_type, file)
+                page_limit = check_page_limit(upload, options["max_pages"])
+                record["pages"] = page_limit["page_count"]
+                if page_limit["exceeds_limit"]:
+                    record.update(status="skipped", reason=page_limit["message"])
+                    return record
+                upload = _normalized(upload, tmp_dir)
+                text = process_document_with_docai(upload)
+
+            text = normalize_for_analysis(text)
+            record["chars"] = len(text)
+            if not text:
+                record.update(status="skipped", reason="No text found")
+                return record
+            risks = localized_risks(text, options["language"])
+            record["risk_stats"] = compute_risk_stats(risks)
+            record["risks"] = risks
+            if options["authenticity"]:
+                report = check_document_authenticity(text, upload)
+                record["authenticity"] = {key: report.get(key) for key in ("verdict", "confidence_score", "document_type", "summary")}
+        record["status"] = "done"
+    except Exception as e:
+        record.update(status="failed", error=f"{type(e).__name__}: {e}")
+        traceback.print_exc()
+    finally:
+        record["seconds"] = round(time.monotonic() - started, 2)
+    return record
+
+
+def _analyze_files(root: str, files: list) -> int:
+    """Analyze (file, sha256) pairs on the worker's threads, reporting each record as it finishes."""
+    def run(item):
+        _results.put(analyze_file(root, item[0], item[1], _options))
+
+    with ThreadPoolExecutor(max_workers=_options["threads"], thread_name_prefix="batch") as pool:
+        list(pool.map(run, files))
+    return len(files)
+
+
+# --- DRIVER ---
+def _limit_external_concurrency(workers: int, limits: dict) -> None:
+    """Split each service's concurrency limit between workers (inherited by spawned processes)."""
+    for service, total in limits.items():
+        per_worker = str(max(1, total // workers))
+        os.environ[f"{service}_CONCURRENCY"] = per_worker
+        os.environ[f"{service}_MAX_CONCURRENCY"] = per_worker
+
+
+def run_batch(args) -> dict:
+    import uploads
+
+    files = find_documents(args.directory)
+    writer = ResultWriter(args.out, args.csv)
+    todo = []
+    for file in files:
+        _, sha256 = uploads.hash_file(os.path.join(args.directory, file))
+        if not writer.is_finished(file, sha256):
+            todo.append((file, sha256))
+    print(f"{len(files)} files found, {len(files) - len(todo)} already finished, {len(todo)} to analyze.")
+
+    counts = {"done": 0, "skipped": 0, "failed": 0}
+    if not todo:
+        writer.close()
+        return counts
+
+    _limit_external_concurrency(args.workers, {"GEMINI": args.max_gemini, "DOCAI": args.max_docai, "VISION": args.max_vision})
+    # Workers are already separate processes; CPU tasks run inline in them
+    os.environ["CPU_POOL_WORKERS"] = "0"
+    if args.batch_llm:
+        os.environ["LLM_BATCH_MODE"] = "1"
+    options = {
+        "language": args.language,
+        "authenticity": args.authenticity,
+        "threads": args.threads,
+        "max_pages": args.max_pages,
+    }
+    task_size = args.threads * FILES_PER_TASK_PER_THREAD
+    tasks = [todo[i:i + task_size] for i in range(0, len(todo), task_size)]
+
+    started = time.monotonic()
+    with Manager() as manager:
+        results = manager.Queue()
+        with ProcessPoolExecutor(
+            max_workers=args.workers,
+            mp_context=get_context("spawn"),
+            initializer=_init_worker,
+            initargs=(results, options),
+        ) as pool:
+            futures = [pool.submit(_analyze_files, args.directory, task) for task in tasks]
+            written = 0
+            try:
+                while written < len(todo):
+                    try:
+                        record = results.get(timeout=1)
+                    except queue.Empty:
+                        # A dead worker breaks the pool; what is written so far is kept for the rerun
+                        for future in futures:
+                            if future.done() and future.exception() is not None:
+                                raise future.exception()
+                        continue
+                    writer.write(record)
+                    written += 1
+                    counts[record["status"]] += 1
+                    detail = record.get("error") or record.get("reason") or f"{len(record.get('risks') or [])} risks"
+                    print(f"[{written}/{len(todo)}] {record['file']}: {record['status']} ({detail}) in {record['seconds']}s")
+            finally:
+                writer.close()
+
+    elapsed = time.monotonic() - started
+    print(f"Finished in {elapsed:.1f}s: {counts}")
+    return counts
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="LegalEase AI offline batch analysis")
+    parser.add_argument("directory", help="directory of PDFs, images and text files")
+    parser.add_argument("--out", default="results.jsonl", help="JSONL results file, also the resume checkpoint")
+    parser.add_argument("--csv", help="CSV file with one row per risk")
+    parser.add_argument("--language", default="English")
+    parser.add_argument("--authenticity", action="store_true", help="also run the authenticity check")
+    parser.add_argument("--workers", type=int, default=min(4, os.cpu_count() or 1), help="worker processes")
+    parser.add_argument("--threads", type=int, default=4, help="files analyzed at once per worker")
+    parser.add_argument("--max-pages", type=int, default=15)
+    parser.add_argument("--max-gemini", type=int, default=16, help="concurrent Gemini calls across workers")
+    parser.add_argument("--max-docai", type=int, default=8, help="concurrent Document AI calls across workers")
+    parser.add_argument("--max-vision", type=int, default=8, help="concurrent Vision calls across workers")
+    parser.add_argument("--batch-llm", action="store_true", help="group model calls into batch submissions")
+    args = parser.parse_args()
+    if not os.path.isdir(args.directory):
+        parser.error(f"{args.directory} is not a directory")
+    counts = run_batch(args)
+    sys.exit(1 if counts["failed"] else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,363 @@
+"""
+Benchmarks for LegalEase AI.
+
+Usage:
+    python benchmark.py analysis-modes [--file contract.txt] [--language English] [--runs 3]
+    python benchmark.py pdf-report [--risks 100 500] [--language English Spanish] [--runs 3]
+    python benchmark.py render-risks [--risks 500] [--runs 5]
+    python benchmark.py startup [--runs 5]
+    python benchmark.py upload-memory [--mb 5 20]
+    python benchmark.py image-normalize [--images photos/] [--ocr]
+
+analysis-modes compares the standard three-call path (legal check, summary and
+risks, with summary and risks in parallel) against the fused single-call path.
+It reports wall-clock latency and the input/output tokens Gemini reports.
+It calls the live Vertex AI model, so valid credentials are required.
+
+pdf-report renders synthetic risk reports locally and reports render time and
+output size per 100 risks for each report size and language. The first run of
+each language builds the font subset; later runs reuse it. Languages whose
+script needs shaping (Hindi, Tamil, ...) have no PDF report.
+
+render-risks times render_risks_html on synthetic risks: the first (cold) render
+and the median of repeated renders that hit the memoized field conversion.
+
+startup measures a cold process: time to import app, the first GET /, and the
+first model construction (credentials, vertexai.init and the SDK imports that
+are deferred until then). Each run is a fresh interpreter; no API calls are made.
+
+upload-memory parses a multipart upload of a generated PDF and counts its pages,
+reporting the peak Python heap (tracemalloc) for the old path (read() into bytes,
+then a BytesIO copy for PyPDF2) and the spooled path (temp file, mmap parse).
+
+image-normalize runs the phone-photo normalization over a reference set (every
+image in --images; a synthetic skewed photo when omitted) and reports bytes
+saved and time per image. With --ocr, each original and normalized image also
+goes through Document AI, and the OCR text is scored against <image>.txt next to
+the image (difflib ratio). This needs live credentials.
+"""
+import argparse
+import difflib
+import glob
+import io
+import json
+import os
+import random
+import subprocess
+import sys
+import statistics
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+from legal_analyzer import (
+    analyze_document_fused,
+    analyze_risks,
+    get_metrics,
+    is_legal_document,
+    render_risks_html,
+    summarize_text,
+)
+import pdf_report
+
+SAMPLE_TEXT = """
+This Non-Disclosure Agreement is entered into on January 5, 2024 between Acme Corp ("Disclosing Party")
+and John Doe ("Receiving Party"). The Receiving Party shall hold in confidence all Confidential Information
+and shall not disclose it to any third party without prior written consent. The Receiving Party shall
+indemnify the Disclosing Party for any breach of this Agreement, without limitation of liability.
+This Agreement may be terminated by the Disclosing Party at any time without notice, and the obligations
+of confidentiality survive indefinitely. Any dispute shall be resolved exclusively in the courts chosen by
+the Disclosing Party. Signed and witnessed by the parties on the date above.
+"""
+
+
+def _token_totals(before: dict, after: dict) -> tuple[float, float]:
+    """Sum input/output token counters that changed between two metric snapshots."""
+    tokens_in = sum(v - before.get(k, 0) for k, v in after.items() if k.endswith(".input_tokens"))
+    tokens_out = sum(v - before.get(k, 0) for k, v in after.items() if k.endswith(".output_tokens"))
+    return tokens_in, tokens_out
+
+
+def _run_standard(text: str, language: str) -> None:
+    is_legal_document(text)
+    with ThreadPoolExecutor() as executor:
+        summary_future = executor.submit(summarize_text, text, language)
+        risks_future = executor.submit(analyze_risks, text, language)
+    summary_future.result()
+    risks_future.result()
+
+
+def _run_fused(text: str, language: str) -> None:
+    analyze_document_fused(text, language)
+
+
+def bench_analysis_modes(text: str, language: str = "English", runs: int = 3) -> dict:
+    """Time both analysis paths and collect token usage per run."""
+    results = {}
+    for name, fn in (("standard", _run_standard), ("fused", _run_fused)):
+        latencies, inputs, outputs = [], [], []
+        for _ in range(runs):
+            before = get_metrics()
+            start = time.perf_counter()
+            fn(text, language)
+            latencies.append(time.perf_counter() - start)
+            tokens_in, tokens_out = _token_totals(before, get_metrics())
+            inputs.append(tokens_in)
+            outputs.append(tokens_out)
+        results[name] = {
+            "latency_median_s": statistics.median(latencies),
+            "latency_max_s": max(latencies),
+            "input_tokens": statistics.mean(inputs),
+            "output_tokens": statistics.mean(outputs),
+        }
+    return results
+
+
+def _synthetic_risks(count: int) -> list[dict]:
+    words = "the party shall pay indemnify terminate notice liability agreement without consent within days".split()
+    rng = random.Random(count)
+    return [{
+        "clause": " ".join(rng.choice(words) for _ in range(rng.randint(8, 40))),
+        "issue": " ".join(rng.choice(words) for _ in range(15)),
+        "severity": rng.choice(["low", "medium", "high"]),
+        "type": rng.choice(["Liability", "Payment", "Termination"]),
+        "worst_case": " ".join(rng.choice(words) for _ in range(8)),
+        "suggestion": " ".join(rng.choice(words) for _ in range(12)),
+    } for _ in range(count)]
+
+
+def bench_pdf_report(sizes: list[int], languages: list[str], runs: int = 3) -> dict:
+    """Render time and size of the risk PDF, normalized to 100 risks."""
+    results = {}
+    for language in languages:
+        for size in sizes:
+            risks = _synthetic_risks(size)
+            pdf_report.render_risk_report(risks, language)  # builds the language's font subset
+            timings = []
+            for _ in range(runs):
+                start = time.perf_counter()
+                pdf = pdf_report.render_risk_report(risks, language)
+                timings.append(time.perf_counter() - start)
+            results[f"{language}/{size}"] = {
+                "render_ms_per_100": statistics.median(timings) * 1000 * 100 / size,
+                "kb_per_100": len(pdf) / 1024 * 100 / size,
+                "total_kb": len(pdf) / 1024,
+            }
+    return results
+
+
+def bench_render_risks(size: int, runs: int = 5) -> dict:
+    """Cold and memoized render time of the risk list HTML."""
+    risks = _synthetic_risks(size)
+    start = time.perf_counter()
+    render_risks_html(risks)
+    cold = time.perf_counter() - start
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        render_risks_html(risks)
+        timings.append(time.perf_counter() - start)
+    return {f"render/{size}": {"cold_ms": cold * 1000, "warm_ms": statistics.median(timings) * 1000}}
+
+
+# Runs in a fresh interpreter; prints one JSON line of timings
+STARTUP_PROBE = """
+import json, sys, time
+start = time.perf_counter()
+import app
+imported = time.perf_counter()
+app.app.test_client().get("/")
+first_request = time.perf_counter()
+heavy = [m for m in ("vertexai", "google.cloud.vision", "google.cloud.documentai", "cv2", "PyPDF2", "pdf2image", "fpdf") if m in sys.modules]
+import legal_analyzer
+legal_analyzer._get_model()
+model_ready = time.perf_counter()
+print(json.dumps({"import_s": imported - start, "first_request_s": first_request - imported,
+                  "first_model_s": model_ready - first_request, "heavy_at_import": len(heavy)}))
+"""
+
+
+def bench_startup(runs: int = 5) -> dict:
+    """Cold-start timings over several fresh processes."""
+    samples = []
+    for _ in range(runs):
+        output = subprocess.run([sys.executable, "-c", STARTUP_PROBE], capture_output=True, text=True, check=True).stdout
+        samples.append(json.loads(output.strip().splitlines()[-1]))
+    return {"startup": {key: statistics.median(sample[key] for sample in samples) for key in samples[0]}}
+
+
+def _noise_pdf(path: str, megabytes: float) -> None:
+    """One-page PDF holding an incompressible RGB image of roughly the given size."""
+    import numpy as np
+    from fpdf import FPDF
+    from PIL import Image
+    side = int((megabytes * 1024 * 1024 / 3) ** 0.5)
+    with tempfile.NamedTemporaryFile(suffix=".png") as png:
+        pixels = np.random.default_rng(0).integers(0, 256, (side, side, 3), dtype=np.uint8)
+        Image.fromarray(pixels).save(png.name, compress_level=0)
+        pdf = FPDF()
+        pdf.add_page()
+        pdf.image(png.name, x=10, y=10, w=180)
+        pdf.output(path, "F")
+
+
+def _upload_peak(app, body: bytes, count_pages) -> tuple:
+    """Peak traced heap while the form is parsed and count_pages(file_storage) runs."""
+    data = {"pdf_file": (io.BytesIO(body), "upload.pdf", "application/pdf")}
+    with app.test_request_context("/", method="POST", data=data, content_type="multipart/form-data"):
+        from flask import request
+        tracemalloc.start()
+        pages = count_pages(request.files["pdf_file"])
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    return peak, pages
+
+
+def bench_upload_memory(sizes: list[float]) -> dict:
+    """Peak heap per upload for the in-memory and the spooled upload paths."""
+    import PyPDF2
+    from flask import Flask
+    import cpu_pool
+    import uploads
+
+    def in_memory(file_storage):
+        content = file_storage.read()
+        return len(PyPDF2.PdfReader(io.BytesIO(content)).pages)
+
+    def spooled(file_storage):
+        return cpu_pool.count_pdf_pages(uploads.from_file_storage(file_storage).path)
+
+    plain_app = Flask("plain")
+    spooling_app = Flask("spooling")
+    spooling_app.request_class = uploads.SpoolingRequest
+    results = {}
+    for megabytes in sizes:
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "upload.pdf")
+            _noise_pdf(path, megabytes)
+            body = open(path, "rb").read()
+        for name, app, count_pages in (("bytes", plain_app, in_memory), ("spooled", spooling_app, spooled)):
+            peak, pages = _upload_peak(app, body, count_pages)
+            results[f"{name}/{megabytes:g}MB"] = {"file_mb": len(body) / 2 ** 20, "peak_heap_mb": peak / 2 ** 20, "pages": pages}
+    return results
+
+
+def _synthetic_photo(path: str) -> None:
+    """A 12 MP photo of a text page, skewed on a noisy background, stored sideways with an EXIF rotation."""
+    import cv2
+    import numpy as np
+    from PIL import Image
+    rng = np.random.default_rng(1)
+    photo = rng.integers(40, 90, (3000, 4000, 3)).astype(np.uint8)
+    page = np.full((2600, 1900, 3), 245, np.uint8)
+    for y in range(100, 2500, 60):
+        cv2.putText(page, f"The Tenant shall pay the rent on day {y // 60} of each month.", (80, y), cv2.FONT_HERSHEY_SIMPLEX, 1.4, (20, 20, 20), 3)
+    corners = np.float32([[0, 0], [1899, 0], [1899, 2599], [0, 2599]])
+    skewed = np.float32([[1100, 250], [3000, 350], [2900, 2850], [1000, 2750]])
+    transform = cv2.getPerspectiveTransform(corners, skewed)
+    mask = cv2.warpPerspective(np.ones(page.shape[:2], np.uint8), transform, (4000, 3000)) > 0
+    photo[mask] = cv2.warpPerspective(page, transform, (4000, 3000))[mask]
+    image = Image.fromarray(cv2.cvtColor(np.ascontiguousarray(np.rot90(photo)), cv2.COLOR_BGR2RGB))
+    exif = image.getexif()
+    exif[0x0112] = 6  # rotate 90 CW to display
+    image.save(path, quality=95, exif=exif)
+
+
+def _ocr_accuracy(path: str, mime_type: str, expected: str) -> float:
+    import app
+    import uploads
+    size, sha256 = uploads.hash_file(path)
+    text = app._process_document_with_docai(uploads.SpooledUpload(path, size, sha256, mime_type))
+    normalize = lambda t: " ".join(t.split()).lower()
+    return difflib.SequenceMatcher(None, normalize(text), normalize(expected)).ratio()
+
+
+def bench_image_normalize(image_dir: str = None, ocr: bool = False) -> dict:
+    """Bytes saved, time and (optionally) OCR accuracy of normalize_document_image per image."""
+    import mimetypes
+    import cpu_pool
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        if image_dir:
+            paths = sorted(p for p in glob.glob(os.path.join(image_dir, "*")) if (mimetypes.guess_type(p)[0] or "").startswith("image/"))
+        else:
+            paths = [os.path.join(tmp, "synthetic.jpg")]
+            _synthetic_photo(paths[0])
+        for path in paths:
+            output = os.path.join(tmp, "normalized.jpg")
+            start = time.perf_counter()
+            result = cpu_pool.normalize_document_image(path, output)
+            elapsed = time.perf_counter() - start
+            row = {
+                "input_kb": result["input_bytes"] / 1024,
+                "output_kb": result["output_bytes"] / 1024,
+                "saved_pct": 100 * (1 - result["output_bytes"] / result["input_bytes"]),
+                "normalize_ms": elapsed * 1000,
+            }
+            expected_path = os.path.splitext(path)[0] + ".txt"
+            if ocr:
+                # nan when the image has no transcript
+                row["ocr_before"] = row["ocr_after"] = float("nan")
+                if os.path.exists(expected_path):
+                    expected = open(expected_path, encoding="utf-8").read()
+                    row["ocr_before"] = _ocr_accuracy(path, mimetypes.guess_type(path)[0], expected)
+                    row["ocr_after"] = _ocr_accuracy(output, "image/jpeg", expected) if result["written"] else row["ocr_before"]
+            results[os.path.basename(path)[:16]] = row
+    return results
+
+
+def _print_table(results: dict) -> None:
+    columns = list(next(iter(results.values())).keys())
+    print(f"{'mode':<16}" + "".join(f"{c:>20}" for c in columns))
+    for name, row in results.items():
+        print(f"{name:<16}" + "".join(f"{row[c]:>20.3f}" for c in columns))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="LegalEase AI benchmarks")
+    sub = parser.add_subparsers(dest="benchmark", required=True)
+
+    modes = sub.add_parser("analysis-modes", help="standard three-call path vs fused single call")
+    modes.add_argument("--file", help="text file to analyze (defaults to a built-in sample)")
+    modes.add_argument("--language", default="English")
+    modes.add_argument("--runs", type=int, default=3)
+
+    pdf = sub.add_parser("pdf-report", help="risk PDF render time and size per 100 risks")
+    pdf.add_argument("--risks", type=int, nargs="+", default=[100, 500])
+    pdf.add_argument("--language", nargs="+", default=["English", "Spanish"])
+    pdf.add_argument("--runs", type=int, default=3)
+
+    render = sub.add_parser("render-risks", help="render_risks_html time for a large risk list")
+    render.add_argument("--risks", type=int, default=500)
+    render.add_argument("--runs", type=int, default=5)
+
+    startup = sub.add_parser("startup", help="cold import, first request and first model construction time")
+    startup.add_argument("--runs", type=int, default=5)
+
+    upload = sub.add_parser("upload-memory", help="peak heap per upload, in-memory vs spooled")
+    upload.add_argument("--mb", type=float, nargs="+", default=[5, 20])
+
+    images = sub.add_parser("image-normalize", help="phone photo normalization: bytes saved and OCR accuracy")
+    images.add_argument("--images", help="directory of reference photos, each with an optional <name>.txt transcript")
+    images.add_argument("--ocr", action="store_true", help="score Document AI text before and after (live API)")
+
+    args = parser.parse_args()
+    if args.benchmark == "analysis-modes":
+        text = open(args.file, encoding="utf-8").read() if args.file else SAMPLE_TEXT
+        print(f"Runs: {args.runs}, document chars: {len(text)}")
+        _print_table(bench_analysis_modes(text, args.language, args.runs))
+    elif args.benchmark == "pdf-report":
+        _print_table(bench_pdf_report(args.risks, args.language, args.runs))
+    elif args.benchmark == "render-risks":
+        _print_table(bench_render_risks(args.risks, args.runs))
+    elif args.benchmark == "startup":
+        _print_table(bench_startup(args.runs))
+    elif args.benchmark == "upload-memory":
+        _print_table(bench_upload_memory(args.mb))
+    elif args.benchmark == "image-normalize":
+        _print_table(bench_image_normalize(args.images, args.ocr))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,461 @@
+"""
+Process pool for CPU-bound document work.
+
+PDF parsing (PyPDF2), rasterization (pdf2image), image encoding and OpenCV all
+hold the GIL, so running them on a request thread stalls every other thread in
+the gunicorn worker. The task functions below run in a long-lived, size-bounded
+process pool instead. This module only imports CPU libraries, so pool workers
+start without any Google client setup. OpenCV, PyPDF2 and pdf2image are
+imported by the tasks that use them, not when the web process starts.
+"""
+import io
+import os
+import math
+import mmap
+import contextlib
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FuturesTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+
+import numpy as np
+
+# --- CONFIGURATION ---
+# Number of worker processes; 0 runs every task inline on the calling thread.
+CPU_POOL_WORKERS = int(os.getenv("CPU_POOL_WORKERS", str(min(4, os.cpu_count() or 1))))
+# Tasks allowed to be queued or running at once before callers are turned away.
+CPU_POOL_MAX_PENDING = int(os.getenv("CPU_POOL_MAX_PENDING", str(max(1, CPU_POOL_WORKERS) * 2)))
+# How long a caller waits for a free slot before CpuPoolBusy is raised.
+CPU_POOL_QUEUE_TIMEOUT = float(os.getenv("CPU_POOL_QUEUE_TIMEOUT", "10"))
+# Default per-task deadline in seconds.
+CPU_TASK_TIMEOUT = float(os.getenv("CPU_TASK_TIMEOUT", "60"))
+
+# Local pre-filter for logo candidates before they are sent to Vision
+LOGO_MIN_SIDE_PX = 32          # smaller images are icons/bullets, not logos
+LOGO_MAX_ASPECT_RATIO = 8.0    # rules, borders and separator lines
+LOGO_MIN_ENTROPY_BITS = 0.05   # near-uniform fills and blank scans
+LOGO_MAX_SIDE_PX = 1024        # larger images are downscaled before upload
+
+# Phone photos of documents are normalized before OCR and logo detection
+IMAGE_OCR_MAX_SIDE_PX = int(os.getenv("IMAGE_OCR_MAX_SIDE_PX", "2400"))  # ~200 DPI for an A4 page
+IMAGE_JPEG_QUALITY = int(os.getenv("IMAGE_JPEG_QUALITY", "85"))
+PAGE_DETECT_SIDE_PX = 800      # contour search runs on a copy this size
+PAGE_MIN_AREA_RATIO = 0.25     # smaller quadrilaterals are not the page
+# A page photo fills most of the frame on every side. A bordered table or box
+# inside a flat scan does not, and is left alone unless it covers most of it.
+PAGE_EDGE_MARGIN_RATIO = 0.12  # max gap between each side of the page and the frame
+PAGE_FULL_AREA_RATIO = 0.85    # or this share of the frame, wherever it lies
+
+
+class CpuPoolBusy(RuntimeError):
+    """Raised when the pool already holds CPU_POOL_MAX_PENDING tasks."""
+
+
+class CpuTaskTimeout(TimeoutError):
+    """Raised when a task does not finish within its deadline."""
+
+
+_executor = None
+_executor_lock = threading.Lock()
+_pending_slots = threading.BoundedSemaphore(max(1, CPU_POOL_MAX_PENDING))
+_stats_lock = threading.Lock()
+_stats = {"submitted": 0, "completed": 0, "failed": 0, "timed_out": 0, "rejected": 0, "recycled": 0}
+
+
+def _count(key: str) -> None:
+    with _stats_lock:
+        _stats[key] += 1
+
+
+def pool_stats() -> dict:
+    """Return counters for tasks submitted, completed, failed, timed out and rejected, and pools recycled."""
+    with _stats_lock:
+        return dict(_stats, workers=CPU_POOL_WORKERS, max_pending=CPU_POOL_MAX_PENDING)
+
+
+def _get_executor() -> ProcessPoolExecutor:
+    """Create the pool on first use, after gunicorn has forked its worker."""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            # spawn, not fork: forking a threaded process with live gRPC channels is unsafe
+            _executor = ProcessPoolExecutor(
+                max_workers=CPU_POOL_WORKERS,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        return _executor
+
+
+def _discard_executor(broken: ProcessPoolExecutor) -> None:
+    """Drop a pool whose worker died so the next task starts a fresh one."""
+    global _executor
+    with _executor_lock:
+        if _executor is broken:
+            _executor = None
+    broken.shutdown(wait=False, cancel_futures=True)
+
+
+def _recycle_executor(stuck: ProcessPoolExecutor) -> None:
+    """
+    Replace a pool with a task still running past its deadline, so later tasks
+    do not queue behind it. The old pool is shut down without waiting: its
+    workers exit once their current tasks finish, and those tasks keep their
+    queue slots until then, so stuck work stays within CPU_POOL_MAX_PENDING.
+    """
+    _discard_executor(stuck)
+    _count("recycled")
+
+
+def run(fn, *args, timeout: float = None):
+    """
+    Run fn(*args) in the process pool and return its result.
+    The calling thread blocks without holding the GIL, so I/O-bound requests
+    keep running. Raises CpuPoolBusy when the queue is full and CpuTaskTimeout
+    when the task misses its deadline.
+    """
+    if CPU_POOL_WORKERS <= 0:
+        return fn(*args)
+
+    if not _pending_slots.acquire(timeout=CPU_POOL_QUEUE_TIMEOUT):
+        _count("rejected")
+        raise CpuPoolBusy(f"CPU pool is full ({CPU_POOL_MAX_PENDING} tasks pending).")
+
+    executor = _get_executor()
+    try:
+        try:
+            future = executor.submit(fn, *args)
+        except BrokenProcessPool:
+            _discard_executor(executor)
+            executor = _get_executor()
+            future = executor.submit(fn, *args)
+    except BaseException:
+        _pending_slots.release()
+        raise
+    _count("submitted")
+    # The slot is released when the worker finishes, not when the caller gives
+    # up, so abandoned tasks still count against the queue bound.
+    future.add_done_callback(lambda _: _pending_slots.release())
+
+    deadline = CPU_TASK_TIMEOUT if timeout is None else timeout
+    try:
+        result = future.result(timeout=deadline)
+    except FuturesTimeoutError:
+        # Still queued: cancelling is enough. Running: the worker is stuck
+        if not future.cancel():
+            _recycle_executor(executor)
+        _count("timed_out")
+        raise CpuTaskTimeout(f"{fn.__name__} did not finish within {deadline:g}s.")
+    except BrokenProcessPool:
+        _discard_executor(executor)
+        _count("failed")
+        raise
+    except Exception:
+        _count("failed")
+        raise
+    _count("completed")
+    return result
+
+
+# --- TASKS ---
+# Everything below runs inside pool workers: file paths or small byte strings
+# in, plain data out. Uploads are passed as paths so they are never pickled.
+
+@contextlib.contextmanager
+def _mapped_file(path: str):
+    """Read-only memory map of a file, usable as a seekable stream."""
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            yield io.BytesIO(b"")
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            yield mapped
+
+
+def count_pdf_pages(file_path: str) -> int:
+    """Return the number of pages in a PDF document."""
+    import PyPDF2
+    with _mapped_file(file_path) as mapped:
+        return len(PyPDF2.PdfReader(mapped).pages)
+
+
+def image_blur_variance(image_path: str) -> float:
+    """
+    Decode an image file and return the Laplacian variance.
+    A lower number means more blurry.
+    """
+    import cv2
+    # 1. Decode the image straight from the file
+    image = cv2.imread(image_path, cv2.IMREAD_COLOR)
+
+    # 2. Convert to grayscale for analysis
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+
+    # 3. Calculate the Laplacian variance
+    return cv2.Laplacian(gray, cv2.CV_64F).var()
+
+
+def pdf_page_blur_variances(file_path: str, dpi: int = 200, timeout: float = None) -> list[float]:
+    """
+    Rasterize each PDF page and return its Laplacian variance.
+    Pages go straight from PIL to NumPy; the PNG round trip the values used to
+    take was lossless, so the variances are unchanged.
+    """
+    import cv2
+    from pdf2image import convert_from_path
+    # pdftoppm reads the file itself and is killed if it outlives the task deadline
+    deadline = CPU_TASK_TIMEOUT if timeout is None else timeout
+    pages = convert_from_path(file_path, dpi=dpi, timeout=max(1, math.ceil(deadline)))
+    variances = []
+    for page in pages:
+        gray = cv2.cvtColor(np.asarray(page.convert("RGB")), cv2.COLOR_RGB2GRAY)
+        variances.append(cv2.Laplacian(gray, cv2.CV_64F).var())
+    return variances
+
+
+def extract_pdf_images(file_path: str) -> list[bytes]:
+    """
+    Extract images from PDF file content.
+    Returns a list of image bytes encoded as PNG/JPEG/JP2 so they can be decoded
+    locally and by Vision. Images whose declared size is too small to hold a logo
+    are skipped without decoding their streams.
+    """
+    import PyPDF2
+    # The public page.images decodes every image and drops a page on the first
+    # undecodable one, so the per-image decoder behind it is used directly.
+    # It is private: PyPDF2 is pinned exactly in requirements.txt, and any
+    # other version without it goes through page.images.
+    try:
+        from PyPDF2.filters import _xobj_to_image
+    except ImportError:
+        _xobj_to_image = None
+    with _mapped_file(file_path) as mapped:
+        pdf_reader = PyPDF2.PdfReader(mapped)
+        if _xobj_to_image is None:
+            return _public_pdf_images(pdf_reader)
+        return _extract_pdf_images(pdf_reader, _xobj_to_image)
+
+
+def _public_pdf_images(pdf_reader) -> list[bytes]:
+    images = []
+    for page_num, page in enumerate(pdf_reader.pages):
+        try:
+            images.extend(image.data for image in page.images)
+        except Exception as e:
+            print(f"Error extracting images from page {page_num}: {e}")
+    return images
+
+
+def _extract_pdf_images(pdf_reader, _xobj_to_image) -> list[bytes]:
+    images = []
+
+    for page_num, page in enumerate(pdf_reader.pages):
+        if '/XObject' in page['/Resources']:
+            xObject = page['/Resources']['/XObject'].get_object()
+
+            for obj in xObject:
+                if xObject[obj]['/Subtype'] == '/Image':
+                    try:
+                        width = int(xObject[obj].get('/Width', 0))
+                        height = int(xObject[obj].get('/Height', 0))
+                        if width and height and min(width, height) < LOGO_MIN_SIDE_PX:
+                            continue
+                        try:
+                            extension, data = _xobj_to_image(xObject[obj])
+                        except Exception:
+                            extension, data = None, None
+                        # Fall back to the raw stream when the filter chain is unsupported
+                        images.append(data if extension else xObject[obj].get_data())
+                    except Exception as e:
+                        print(f"Error extracting image from page {page_num}: {e}")
+                        continue
+
+    return images
+
+
+def _decode_with_pil(image_bytes: bytes):
+    """Decode formats OpenCV rejects (PCX, TGA, some GIF/CMYK/bilevel images) into a BGR(A) or gray array."""
+    from PIL import Image
+    try:
+        with Image.open(io.BytesIO(image_bytes)) as opened:
+            opened.seek(0)
+            if opened.mode in ("L", "RGB", "RGBA"):
+                image = opened.copy()
+            else:
+                image = opened.convert("RGBA" if "A" in opened.getbands() or "transparency" in opened.info else "RGB")
+    except Exception:
+        return None
+    array = np.asarray(image)
+    if array.ndim == 3:
+        array = array[:, :, [2, 1, 0, 3][:array.shape[2]]]  # RGB(A) -> BGR(A)
+    return np.ascontiguousarray(array)
+
+
+def prepare_logo_image(image_bytes: bytes) -> bytes:
+    """
+    Decode an image locally and decide whether it is worth a Vision call.
+    Returns None for candidates that cannot be logos (too small, extreme aspect
+    ratio, near-uniform), otherwise the image bytes, downscaled and re-encoded
+    when larger than logo detection needs. Images OpenCV cannot decode are
+    decoded with PIL and sent as PNG; images neither can decode are sent as
+    they are, for Vision to decide.
+    """
+    import cv2
+    try:
+        nparr = np.frombuffer(image_bytes, np.uint8)
+        image = cv2.imdecode(nparr, cv2.IMREAD_UNCHANGED)
+        from_pil = image is None
+        if from_pil:
+            image = _decode_with_pil(image_bytes)
+            if image is None:
+                return image_bytes
+
+        height, width = image.shape[:2]
+        if min(height, width) < LOGO_MIN_SIDE_PX:
+            return None
+        if max(height, width) / min(height, width) > LOGO_MAX_ASPECT_RATIO:
+            return None
+
+        # Shannon entropy of the grayscale histogram; ~0 for flat fills
+        if image.ndim == 2:
+            gray = image
+        else:
+            code = cv2.COLOR_BGRA2GRAY if image.shape[2] == 4 else cv2.COLOR_BGR2GRAY
+            gray = cv2.cvtColor(image, code)
+        if gray.dtype != np.uint8:
+            gray = cv2.convertScaleAbs(gray, alpha=255.0 / max(float(gray.max()), 1.0))
+        hist = np.bincount(gray.ravel(), minlength=256).astype(np.float64)
+        probs = hist[hist > 0] / gray.size
+        entropy = float(-(probs * np.log2(probs)).sum())
+        if entropy < LOGO_MIN_ENTROPY_BITS:
+            return None
+
+        longest = max(height, width)
+        if longest <= LOGO_MAX_SIDE_PX and not from_pil:
+            return image_bytes
+
+        scale = min(1.0, LOGO_MAX_SIDE_PX / longest)
+        resized = image if scale == 1.0 else cv2.resize(
+            image, (max(1, int(width * scale)), max(1, int(height * scale))), interpolation=cv2.INTER_AREA)
+        # Keep transparency and line art lossless; photos and scans go to JPEG.
+        # Formats only PIL reads are always re-encoded, as PNG, so Vision can read them.
+        if from_pil or (image.ndim == 3 and image.shape[2] == 4) or image_bytes[:8] == b"\x89PNG\r\n\x1a\n":
+            ok, encoded = cv2.imencode(".png", resized)
+        else:
+            ok, encoded = cv2.imencode(".jpg", resized, [cv2.IMWRITE_JPEG_QUALITY, 90])
+        if not ok:
+            return image_bytes
+        encoded = encoded.tobytes()
+        return encoded if from_pil or len(encoded) < len(image_bytes) else image_bytes
+    except Exception as e:
+        print(f"Error preparing logo image: {e}")
+        # Let Vision decide when local decoding is inconclusive
+        return image_bytes
+
+
+def prepare_logo_file(image_path: str) -> bytes:
+    """prepare_logo_image for an uploaded image file; only the prepared bytes come back."""
+    with open(image_path, "rb") as f:
+        return prepare_logo_image(f.read())
+
+
+def prepare_logo_images(images: list[bytes]) -> list[bytes]:
+    """Run prepare_logo_image over a batch in a single task."""
+    return [prepare_logo_image(image_bytes) for image_bytes in images]
+
+
+def _order_corners(points: np.ndarray) -> np.ndarray:
+    """Quadrilateral corners as top-left, top-right, bottom-right, bottom-left."""
+    sums = points.sum(axis=1)
+    diffs = np.diff(points, axis=1).ravel()
+    return np.array([
+        points[np.argmin(sums)], points[np.argmin(diffs)],
+        points[np.argmax(sums)], points[np.argmax(diffs)],
+    ], dtype=np.float32)
+
+
+def _reaches_frame(quad: np.ndarray, width: int, height: int) -> bool:
+    """Whether the quadrilateral lies within PAGE_EDGE_MARGIN_RATIO of all four frame edges."""
+    x_margin, y_margin = PAGE_EDGE_MARGIN_RATIO * width, PAGE_EDGE_MARGIN_RATIO * height
+    xs, ys = quad[:, 0], quad[:, 1]
+    return (xs.min() <= x_margin and xs.max() >= width - 1 - x_margin
+            and ys.min() <= y_margin and ys.max() >= height - 1 - y_margin)
+
+
+def _find_page(image: np.ndarray):
+    """
+    Corners of the page outline in a photo, or None. The largest quadrilateral
+    covering PAGE_MIN_AREA_RATIO counts only when it reaches near every frame
+    edge or covers PAGE_FULL_AREA_RATIO; otherwise it is a table or box on a
+    flat scan, which must not be cropped to.
+    """
+    import cv2
+    height, width = image.shape[:2]
+    scale = min(1.0, PAGE_DETECT_SIDE_PX / max(height, width))
+    small = cv2.resize(image, (max(1, int(width * scale)), max(1, int(height * scale))), interpolation=cv2.INTER_AREA)
+    gray = cv2.GaussianBlur(cv2.cvtColor(small, cv2.COLOR_BGR2GRAY), (5, 5), 0)
+    edges = cv2.dilate(cv2.Canny(gray, 50, 150), np.ones((3, 3), np.uint8))
+    contours, _ = cv2.findContours(edges, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    min_area = PAGE_MIN_AREA_RATIO * small.shape[0] * small.shape[1]
+    for contour in sorted(contours, key=cv2.contourArea, reverse=True)[:5]:
+        if cv2.contourArea(contour) < min_area:
+            break
+        approx = cv2.approxPolyDP(contour, 0.02 * cv2.arcLength(contour, True), True)
+        if len(approx) == 4 and cv2.isContourConvex(approx):
+            quad = approx.reshape(4, 2).astype(np.float32)
+            frame_area = small.shape[0] * small.shape[1]
+            if cv2.contourArea(approx) < PAGE_FULL_AREA_RATIO * frame_area and not _reaches_frame(quad, small.shape[1], small.shape[0]):
+                return None
+            return _order_corners(quad / scale)
+    return None
+
+
+def normalize_document_image(image_path: str, output_path: str) -> dict:
+    """
+    Prepare a photographed document for OCR: apply the EXIF orientation, crop
+    and straighten the page when its outline is found, downscale to
+    IMAGE_OCR_MAX_SIDE_PX and re-encode as JPEG into output_path.
+    Returns what was done and the sizes; "written" is False when the result
+    would not be smaller or better than the original, which is then kept.
+    """
+    import cv2
+    from PIL import Image, ImageOps
+
+    input_bytes = os.path.getsize(image_path)
+    with Image.open(image_path) as opened:
+        orientation = opened.getexif().get(0x0112, 1)  # EXIF Orientation
+        image = ImageOps.exif_transpose(opened).convert("RGB")
+    image = cv2.cvtColor(np.asarray(image), cv2.COLOR_RGB2BGR)
+    original_size = image.shape[1], image.shape[0]
+
+    corners = _find_page(image)
+    cropped = corners is not None
+    if cropped:
+        top = np.linalg.norm(corners[1] - corners[0])
+        bottom = np.linalg.norm(corners[2] - corners[3])
+        left = np.linalg.norm(corners[3] - corners[0])
+        right = np.linalg.norm(corners[2] - corners[1])
+        width, height = int(max(top, bottom)), int(max(left, right))
+        target = np.array([[0, 0], [width - 1, 0], [width - 1, height - 1], [0, height - 1]], dtype=np.float32)
+        image = cv2.warpPerspective(image, cv2.getPerspectiveTransform(corners, target), (width, height))
+
+    height, width = image.shape[:2]
+    scale = min(1.0, IMAGE_OCR_MAX_SIDE_PX / max(height, width))
+    if scale < 1.0:
+        image = cv2.resize(image, (max(1, int(width * scale)), max(1, int(height * scale))), interpolation=cv2.INTER_AREA)
+
+    ok, encoded = cv2.imencode(".jpg", image, [cv2.IMWRITE_JPEG_QUALITY, IMAGE_JPEG_QUALITY])
+    rotated = orientation not in (1, None)
+    # Re-encoding alone is only worth it when it shrinks the file
+    written = bool(ok) and (rotated or cropped or len(encoded) < input_bytes)
+    if written:
+        with open(output_path, "wb") as f:
+            f.write(encoded.tobytes())
+    return {
+        "written": written,
+        "rotated": rotated,
+        "cropped": cropped,
+        "original_size": original_size,
+        "output_size": (image.shape[1], image.shape[0]),
+        "input_bytes": input_bytes,
+        "output_bytes": len(encoded) if written else input_bytes,
+    }
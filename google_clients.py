@@ -0,0 +1,95 @@
+"""
+Credentials and Google API clients, created on first use.
+
+Both app.py and legal_analyzer need credentials, Vertex AI and API clients.
+Building them at import time made every cold start pay for loading the Google
+SDKs, even for requests that never touch them. Everything here is resolved
+once, on first use, and shared by both modules.
+"""
+import json
+import os
+import threading
+
+# --- CONFIGURATION ---
+CREDENTIALS_FILE = "credentials.json"  # for local dev
+
+_lock = threading.RLock()
+_credentials = None
+_credentials_loaded = False
+_vertex_initialized = False
+_clients = {}
+
+
+def get_credentials():
+    """
+    Service account credentials from GOOGLE_APPLICATION_CREDENTIALS_JSON (Render),
+    then credentials.json (local dev), then Application Default Credentials
+    (Cloud Run). Returns None when none of them is available.
+    """
+    global _credentials, _credentials_loaded
+    with _lock:
+        if _credentials_loaded:
+            return _credentials
+        from google.oauth2 import service_account
+        from google.auth import default as google_auth_default
+
+        creds_json = os.getenv("GOOGLE_APPLICATION_CREDENTIALS_JSON")
+        if creds_json:
+            try:
+                _credentials = service_account.Credentials.from_service_account_info(json.loads(creds_json))
+                print("Loaded credentials from GOOGLE_APPLICATION_CREDENTIALS_JSON.")
+            except Exception as e:
+                print(f"Error loading credentials from environment variable: {e}")
+        if _credentials is None:
+            try:
+                _credentials = service_account.Credentials.from_service_account_file(CREDENTIALS_FILE)
+                print("Loaded credentials from local credentials.json.")
+            except Exception:
+                pass
+        if _credentials is None:
+            try:
+                _credentials, _ = google_auth_default()
+                print("Loaded Application Default Credentials.")
+            except Exception as e:
+                print("Warning: Could not find credentials. API calls will likely fail.", e)
+        _credentials_loaded = True
+        return _credentials
+
+
+def init_vertex(project: str, location: str) -> None:
+    """vertexai.init once per process, with the shared credentials."""
+    global _vertex_initialized
+    with _lock:
+        if _vertex_initialized:
+            return
+        import vertexai
+        vertexai.init(project=project, location=location, credentials=get_credentials())
+        _vertex_initialized = True
+
+
+def shared_client(key, factory):
+    """Return the client stored under key, building it with factory() on first use."""
+    client = _clients.get(key)
+    if client is not None:
+        return client
+    with _lock:
+        if key not in _clients:
+            _clients[key] = factory()
+        return _clients[key]
+
+
+def vision_client():
+    """Shared Vision ImageAnnotatorClient."""
+    def build():
+        from google.cloud import vision
+        return vision.ImageAnnotatorClient(credentials=get_credentials())
+    return shared_client("vision", build)
+
+
+def documentai_client(location: str):
+    """Shared Document AI client for a regional endpoint."""
+    def build():
+        from google.cloud import documentai
+        opts = {"api_endpoint": f"{location}-documentai.googleapis.com"}
+        return documentai.DocumentProcessorServiceClient(client_options=opts, credentials=get_credentials())
+    return shared_client(("documentai", location), build)
@@ -1,80 +1,395 @@
-import cv2
-import numpy as np
-import io
-from pdf2image import convert_from_bytes # For PDF page processing
 import os
-import vertexai
-from vertexai.generative_models import GenerativeModel
 import markdown
+from jinja2 import Environment
+from markupsafe import Markup, escape
 import json
 import re
 import csv
-import io
-from google.oauth2 import service_account
-from google.auth import default as google_auth_default
-from fpdf import FPDF
-import PyPDF2
-from google.cloud import vision
-from PIL import Image
-import base64
+import functools
+import cpu_pool
+import google_clients
+import llm_backends
+import api_gateway
+import single_flight
+import prompt_budget
+import near_duplicates
+import difflib
+import threading
+import time
+import hashlib
+import uuid
+import atexit
+from datetime import timedelta
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 # --- CONFIGURATION ---
 PROJECT_ID = "legalease-ai-471416"
 LOCATION = "asia-south1"
-CREDENTIALS_FILE = "credentials.json"  # for local dev
+# Optional JSON/CSV file with known institutions for logo matching
+LOGO_DATABASE_FILE = os.getenv("LOGO_DATABASE_FILE", "")
+MODEL_NAME = llm_backends.DEFAULT_MODEL  # per-operation routes: llm_backends.OPERATION_MODELS
+# Context caching for documents reused across chat, rewrite and re-analysis:
+# "vertex" (Vertex AI cached content), "local" (in-process fake) or "off"
+CONTEXT_CACHE_BACKEND = os.getenv("CONTEXT_CACHE_BACKEND", "vertex")
+CONTEXT_CACHE_MIN_CHARS = int(os.getenv("CONTEXT_CACHE_MIN_CHARS", "20000"))
+CONTEXT_CACHE_TTL_SECONDS = int(os.getenv("CONTEXT_CACHE_TTL_SECONDS", "3600"))
 
-# --- LOAD CREDENTIALS AND INITIALIZE VERTEX AI ---
-credentials = None
+# --- MODEL ---
+# Models come from the configured LLM backend (see llm_backends), routed per
+# operation and created on first use, so importing this module stays cheap.
+model = None  # tests and benchmarks may assign their own model here; it bypasses routing
 
-try:
-    # 1. Check if GOOGLE_APPLICATION_CREDENTIALS_JSON is set (Render deployment)
-    creds_json = os.getenv("GOOGLE_APPLICATION_CREDENTIALS_JSON")
-    if creds_json:
-        credentials = service_account.Credentials.from_service_account_info(json.loads(creds_json))
-        print("Initialized with credentials from GOOGLE_APPLICATION_CREDENTIALS_JSON.")
-    else:
-        # 2. Local file fallback
-        credentials = service_account.Credentials.from_service_account_file(CREDENTIALS_FILE)
-        print("Initialized with local credentials.json.")
-except Exception as e:
-    try:
-        # 3. ADC fallback
-        credentials, _ = google_auth_default()
-        print("Initialized with Application Default Credentials.")
-    except Exception as e2:
-        print("Warning: Could not find credentials. API calls will likely fail.", e2)
 
-# Initialize Vertex AI
-vertexai.init(project=PROJECT_ID, location=LOCATION, credentials=credentials)
+def _get_model(operation: str = None):
+    """The model for an operation; the default model when operation is None."""
+    if model is not None:
+        return model
+    return llm_backends.model_for(operation)
+
+
+def _generation_config(**kwargs):
+    """Generation config for the current backend, without importing the Vertex SDK at module load."""
+    return llm_backends.generation_config(**kwargs)
+
+
+# --- METRICS ---
+# Process-wide counters, exposed through the /metrics endpoint.
+_metrics_lock = threading.Lock()
+_metrics: dict[str, float] = {}
+
+
+def record_metric(name: str, value: float = 1) -> None:
+    """Add value to the named counter."""
+    with _metrics_lock:
+        _metrics[name] = _metrics.get(name, 0) + value
+
+
+def get_metrics() -> dict:
+    """Return a snapshot of all counters."""
+    with _metrics_lock:
+        return dict(sorted(_metrics.items()))
+
+
+def record_usage(operation: str, response) -> None:
+    """Record input/output token counts reported on a Gemini response."""
+    usage = getattr(response, "usage_metadata", None)
+    if usage is None:
+        return
+    input_tokens = getattr(usage, "prompt_token_count", 0) or 0
+    output_tokens = getattr(usage, "candidates_token_count", 0) or 0
+    record_metric(f"{operation}.input_tokens", input_tokens)
+    record_metric(f"{operation}.output_tokens", output_tokens)
+    print(f"Token usage for {operation}: {input_tokens} in, {output_tokens} out")
+
+
+def _build_prompt(operation: str, text: str, render) -> str:
+    """
+    Render a prompt within the operation's token budget (see prompt_budget) and
+    record its estimated size, to compare against the usage Gemini reports.
+    """
+    prompt, accounting = prompt_budget.build_prompt(operation, text, render)
+    record_metric(f"{operation}.prompt_tokens_est", accounting["estimated_tokens"])
+    if accounting["truncated"]:
+        record_metric(f"{operation}.truncated")
+        print(f"Prompt for {operation} truncated to fit {accounting['budget']} tokens "
+              f"(document ~{accounting['document_tokens']} tokens).")
+    return prompt
+
+
+def _generate(gen_model, prompt, operation: str = None, **kwargs):
+    """
+    Call gen_model.generate_content through the Gemini gateway (limits, retries,
+    breaker). Operations listed in HEDGE_OPERATIONS are hedged when slow. In
+    batch mode the call waits for its micro-batch instead.
+    """
+    if llm_backends.batchable(gen_model):
+        return llm_backends.batcher.submit(gen_model, prompt, kwargs.get("generation_config")).result()
+    return api_gateway.GEMINI_HEDGING.call(
+        operation, api_gateway.GEMINI.call, gen_model.generate_content, prompt, **kwargs
+    )
+
+
+# --- CONTEXT CACHING ---
+# Large documents are registered once as cached content and later calls send a
+# short reference instead of the full text.
+CACHED_DOCUMENT_REFERENCE = "[The full document is provided in the cached context.]"
+
+
+class VertexContextCache:
+    """Vertex AI cached content backend."""
+
+    def __init__(self):
+        self._handles = {}
+
+    def create(self, text: str, ttl_seconds: int) -> str:
+        from vertexai.preview import caching
+        google_clients.init_vertex(PROJECT_ID, LOCATION)
+        cached = caching.CachedContent.create(
+            model_name=MODEL_NAME,
+            contents=[text],
+            ttl=timedelta(seconds=ttl_seconds),
+        )
+        self._handles[cached.name] = cached
+        return cached.name
+
+    def model_for(self, name: str):
+        from vertexai.generative_models import GenerativeModel
+        return GenerativeModel.from_cached_content(cached_content=self._handles[name])
+
+    def delete(self, name: str) -> None:
+        cached = self._handles.pop(name, None)
+        if cached is not None:
+            cached.delete()
+
+
+class LocalContextCache:
+    """
+    In-process stand-in for Vertex context caching, for offline tests and dev.
+    Cached models send the stored text as a leading content part, which is
+    what the Vertex cache does server-side.
+    """
+
+    def __init__(self):
+        self.contents = {}
+
+    def create(self, text: str, ttl_seconds: int) -> str:
+        name = f"local/{uuid.uuid4().hex}"
+        self.contents[name] = text
+        return name
+
+    def model_for(self, name: str):
+        return _LocalCachedModel(self.contents[name])
+
+    def delete(self, name: str) -> None:
+        self.contents.pop(name, None)
+
+
+class _LocalCachedModel:
+    def __init__(self, text: str):
+        self._text = text
+
+    def generate_content(self, prompt, **kwargs):
+        return _get_model().generate_content([self._text, prompt], **kwargs)
+
+
+_CONTEXT_CACHE_BACKENDS = {"vertex": VertexContextCache, "local": LocalContextCache}
+context_cache_api = _CONTEXT_CACHE_BACKENDS[CONTEXT_CACHE_BACKEND]() if CONTEXT_CACHE_BACKEND in _CONTEXT_CACHE_BACKENDS else None
+
+# document key -> {"name", "expires_at", "chars"}
+_document_caches: dict[str, dict] = {}
+_document_caches_lock = threading.Lock()
+_document_cache_key_locks: dict[str, threading.Lock] = {}
 
-# --- MODEL INSTANTIATION: Define the model once to be reused ---
-model = GenerativeModel("gemini-2.5-flash")
 
-# Initialize Vision API client
-vision_client = vision.ImageAnnotatorClient(credentials=credentials)
+def _document_key(text: str) -> str:
+    """Whitespace-insensitive content hash, so text echoed back by the page still matches."""
+    return hashlib.sha256(" ".join(text.split()).encode("utf-8")).hexdigest()
 
 
-def count_pdf_pages(file_content: bytes) -> int:
+def cleanup_expired_document_caches() -> int:
+    """Delete cache entries past their TTL. Returns how many were removed."""
+    now = time.time()
+    with _document_caches_lock:
+        expired = [(key, entry) for key, entry in _document_caches.items() if entry["expires_at"] <= now]
+        for key, _ in expired:
+            del _document_caches[key]
+            _document_cache_key_locks.pop(key, None)
+    for _, entry in expired:
+        try:
+            context_cache_api.delete(entry["name"])
+        except Exception as e:
+            print(f"Error deleting cached content {entry['name']}: {e}")
+        record_metric("context_cache.expired")
+    return len(expired)
+
+
+def get_document_cache(text: str, create: bool = True) -> str:
+    """
+    Return the cache handle for a document, registering it first if it is large
+    enough and create is set. Returns None when the document is not cached.
+    """
+    if context_cache_api is None or not text or len(text) < CONTEXT_CACHE_MIN_CHARS:
+        return None
+    cleanup_expired_document_caches()
+    key = _document_key(text)
+    with _document_caches_lock:
+        entry = _document_caches.get(key)
+        if entry is not None:
+            record_metric("context_cache.hits")
+            return entry["name"]
+        if not create:
+            return None
+        key_lock = _document_cache_key_locks.setdefault(key, threading.Lock())
+
+    # One creation per document even when summary and risks start together
+    with key_lock:
+        with _document_caches_lock:
+            entry = _document_caches.get(key)
+        if entry is not None:
+            record_metric("context_cache.hits")
+            return entry["name"]
+        try:
+            name = context_cache_api.create(text, CONTEXT_CACHE_TTL_SECONDS)
+        except Exception as e:
+            print(f"Context cache creation failed: {e}")
+            record_metric("context_cache.create_failed")
+            return None
+        with _document_caches_lock:
+            _document_caches[key] = {
+                "name": name,
+                # Expire locally a little early so no call races the server-side TTL
+                "expires_at": time.time() + CONTEXT_CACHE_TTL_SECONDS * 0.95,
+                "chars": len(text),
+            }
+        record_metric("context_cache.created")
+        return name
+
+
+def _model_for_document(text: str, operation: str = None) -> tuple:
+    """
+    Return (model, document_text_for_prompt). When the document has a live
+    cache the prompt carries CACHED_DOCUMENT_REFERENCE instead of the text.
+    Cached content belongs to MODEL_NAME, so operations routed elsewhere skip it.
+    """
+    cacheable = model is not None or llm_backends.model_name_for(operation) == MODEL_NAME
+    name = get_document_cache(text) if cacheable else None
+    if name is not None:
+        try:
+            return context_cache_api.model_for(name), CACHED_DOCUMENT_REFERENCE
+        except Exception as e:
+            print(f"Cached model unavailable, sending full text: {e}")
+    return _get_model(operation), text
+
+
+@atexit.register
+def _delete_document_caches() -> None:
+    """Release server-side cached content when the process exits."""
+    with _document_caches_lock:
+        entries = list(_document_caches.values())
+        _document_caches.clear()
+    for entry in entries:
+        try:
+            context_cache_api.delete(entry["name"])
+        except Exception:
+            pass
+
+
+# --- STRUCTURED OUTPUT ---
+RISK_ANALYSIS_TEMPERATURE = 0.2
+DOCUMENT_TYPE_TEMPERATURE = 0.0
+
+RISK_FIELDS = ["clause", "issue", "severity", "type", "worst_case", "suggestion"]
+
+RISKS_RESPONSE_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "risks": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "clause": {"type": "string", "description": "Short quote or heading from the relevant clause."},
+                    "issue": {"type": "string", "description": "A brief, one-sentence explanation of the potential problem."},
+                    "severity": {"type": "string", "enum": ["low", "medium", "high"]},
+                    "type": {"type": "string", "description": "A single category like IP, Liability, Payment, Termination, etc."},
+                    "worst_case": {"type": "string", "description": "A very short, practical worst-case outcome (max 10 words)."},
+                    "suggestion": {"type": "string", "description": "A short, actionable tip. Start with a verb (e.g., 'Clarify...', 'Negotiate...', 'Define...')."},
+                },
+                "required": RISK_FIELDS,
+            },
+        },
+    },
+    "required": ["risks"],
+}
+
+DOCUMENT_TYPE_CATEGORIES = [
+    "Contractual Documents",
+    "Transactional Documents",
+    "Constitutional & Statutory Documents",
+    "Litigation Documents",
+    "Property Documents",
+    "Financial & Banking Documents",
+    "Personal Legal Documents",
+    "Corporate & Business Documents",
+    "Intellectual Property Documents",
+    "Employment & Labour Documents",
+    "Other Legal Documents",
+]
+
+DOCUMENT_TYPE_RESPONSE_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "document_type": {"type": "string", "enum": DOCUMENT_TYPE_CATEGORIES},
+    },
+    "required": ["document_type"],
+}
+
+TRANSLATION_TEMPERATURE = 0.0
+TRANSLATED_RISK_FIELDS = ["clause", "issue", "type", "worst_case", "suggestion"]
+
+SUMMARY_TRANSLATION_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "summary_markdown": {"type": "string"},
+    },
+    "required": ["summary_markdown"],
+}
+
+RISK_TRANSLATION_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "risks": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {field: {"type": "string"} for field in TRANSLATED_RISK_FIELDS},
+                "required": TRANSLATED_RISK_FIELDS,
+            },
+        },
+    },
+    "required": ["risks"],
+}
+
+REWRITE_BATCH_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "rewrites": {"type": "array", "items": {"type": "string"}},
+    },
+    "required": ["rewrites"],
+}
+
+FUSED_ANALYSIS_RESPONSE_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "is_legal_document": {"type": "boolean"},
+        "summary_markdown": {"type": "string"},
+        "risks": RISKS_RESPONSE_SCHEMA["properties"]["risks"],
+    },
+    "required": ["is_legal_document", "summary_markdown", "risks"],
+}
+
+
+def count_pdf_pages(file_path: str) -> int:
     """
-    Count the number of pages in a PDF document.
+    Count the number of pages in a PDF file.
     Returns the page count or 0 if unable to count.
     """
     try:
-        pdf_reader = PyPDF2.PdfReader(io.BytesIO(file_content))
-        return len(pdf_reader.pages)
+        return cpu_pool.run(cpu_pool.count_pdf_pages, file_path)
     except Exception as e:
         print(f"Error counting PDF pages: {e}")
         return 0
 
 
-def check_page_limit(file_content: bytes, mime_type: str, max_pages: int = 15) -> dict:
+def check_page_limit(upload, max_pages: int = 15) -> dict:
     """
-    Check if the document exceeds the page limit.
+    Check if an uploaded document (uploads.SpooledUpload) exceeds the page limit.
     Returns a dictionary with limit status and details.
     """
     try:
-        if mime_type == 'application/pdf':
-            page_count = count_pdf_pages(file_content)
+        if upload.mime_type == 'application/pdf':
+            page_count = count_pdf_pages(upload.path)
             if page_count > max_pages:
                 return {
                     "exceeds_limit": True,
@@ -110,31 +425,22 @@ def check_page_limit(file_content: bytes, mime_type: str, max_pages: int = 15) -
             "recommendation": "Proceeding with analysis."
         }
 
-def check_image_blur(image_bytes: bytes) -> float:
+def check_image_blur(image_path: str) -> float:
     """
-    Reads image bytes and returns the Laplacian variance.
+    Reads an image file and returns the Laplacian variance.
     A lower number means more blurry.
     """
     try:
-        # 1. Decode the image from bytes
-        nparr = np.frombuffer(image_bytes, np.uint8)
-        image = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-        
-        # 2. Convert to grayscale for analysis
-        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-        
-        # 3. Calculate the Laplacian variance
-        variance = cv2.Laplacian(gray, cv2.CV_64F).var()
-        return variance
+        return cpu_pool.run(cpu_pool.image_blur_variance, image_path)
     except Exception as e:
         print(f"Error checking image blur: {e}")
         # Return a high number to avoid false positives on decode error
         return 9999.0
 
 
-def check_document_blur(file_content: bytes, mime_type: str) -> dict:
+def check_document_blur(upload) -> dict:
     """
-    Checks an uploaded file (PDF or image) for blurriness.
+    Checks an uploaded file (PDF or image, as an uploads.SpooledUpload) for blurriness.
     """
     # You can tune this threshold. 300 is a good starting point.
     # Lower = more tolerant. Higher = more strict.
@@ -147,19 +453,14 @@ def check_document_blur(file_content: bytes, mime_type: str) -> dict:
     }
 
     try:
-        if mime_type == 'application/pdf':
-            # 1. Convert PDF to a list of images (one per page)
-            pages = convert_from_bytes(file_content, dpi=200)
+        if upload.mime_type == 'application/pdf':
+            # 1. Rasterize every page and measure it in the CPU pool
+            # pdftoppm and the caller both stop at what is left of the stage budget
+            budget = max(1.0, api_gateway.remaining_time(cpu_pool.CPU_TASK_TIMEOUT))
+            variances = cpu_pool.run(cpu_pool.pdf_page_blur_variances, upload.path, 200, budget, timeout=budget)
             
-            for i, page in enumerate(pages, 1):
-                # 2. Convert PIL Image to bytes
-                img_byte_arr = io.BytesIO()
-                page.save(img_byte_arr, format='PNG')
-                image_bytes = img_byte_arr.getvalue()
-                
-                # 3. Check blur on this page
-                variance = check_image_blur(image_bytes)
-                
+            for i, variance in enumerate(variances, 1):
+                # 2. Check blur on this page
                 if variance < LAPLACIAN_THRESHOLD:
                     result["is_blurry"] = True
                     result["blurry_pages"].append(i)
@@ -168,9 +469,9 @@ def check_document_blur(file_content: bytes, mime_type: str) -> dict:
                 page_str = ', '.join(map(str, result['blurry_pages']))
                 result["summary"] = f"Document appears blurry on page(s): {page_str}. For best results, please upload a clearer version."
 
-        elif mime_type.startswith('image/'):
+        elif upload.mime_type.startswith('image/'):
             # 1. It's a single image, check it directly
-            variance = check_image_blur(file_content)
+            variance = check_image_blur(upload.path)
             
             if variance < LAPLACIAN_THRESHOLD:
                 result["is_blurry"] = True
@@ -184,8 +485,15 @@ def check_document_blur(file_content: bytes, mime_type: str) -> dict:
     return result
 
 
+@single_flight.coalesce("analyze_risks")
 def analyze_risks(text: str, target_language: str = "English") -> list[dict]:
     """Analyze legal text and return a list of risks."""
+    risks = _extract_risks(text, target_language)
+    return risks if risks is not None else []
+
+
+def _extract_risks(text: str, target_language: str) -> list[dict]:
+    """Risk extraction behind analyze_risks; returns None (not []) when the model call fails."""
     # REMOVED: vertexai.init() call was here
 
     def _parse_json_flex(raw: str) -> list[dict]:
@@ -213,145 +521,172 @@ def analyze_risks(text: str, target_language: str = "English") -> list[dict]:
                 return data.get("risks", []) if isinstance(data, dict) else []
             except Exception:
                 pass
-        return []
+        return None
+
+    def _parse_structured(raw: str) -> list[dict]:
+        # The response schema guarantees this shape; anything else is recorded
+        try:
+            data = json.loads(raw)
+            if isinstance(data, dict) and isinstance(data.get("risks"), list):
+                return data["risks"]
+        except Exception:
+            pass
+        record_metric("analyze_risks.parse_fallback")
+        return _parse_json_flex(raw)
 
-    base_prompt = f"""
+    generation_config = _generation_config(
+        temperature=RISK_ANALYSIS_TEMPERATURE,
+        response_mime_type="application/json",
+        response_schema=RISKS_RESPONSE_SCHEMA,
+    )
+    doc_model, document = _model_for_document(text, "analyze_risks")
+    base_prompt = _build_prompt("analyze_risks", document, lambda document: f"""
     You are a senior contract analyst. Read the document and extract a concise list of potential risks.
-    Return STRICT JSON ONLY, no markdown, no commentary, matching this schema exactly:
-    {{
-    "risks": [
-    {{
-      "clause": "Short quote or heading from the relevant clause.",
-      "issue": "A brief, one-sentence explanation of the potential problem.",
-      "severity": "low|medium|high",
-      "type": "A single category like IP, Liability, Payment, Termination, etc.",
-      "worst_case": "A very short, practical worst-case outcome (max 10 words).",
-      "suggestion": "A short, actionable tip. Start with a verb (e.g., 'Clarify...', 'Negotiate...', 'Define...')."
-    }}
-    ]
-    }}
+    For each risk give the clause, the issue, its severity, a risk type, the worst case and a suggestion.
     CRITICAL:
     - The values for "clause", "issue", and "suggestion" MUST be written in this language: {target_language}
     - The value for "severity" MUST be one of: low, medium, high (lowercase, English)
     - "type" should be a single short word or phrase in {target_language} that best describes the risk category.
     Document:
     ---
-    {text}
+    {document}
     ---
-    """
+    """)
     try:
-        response = model.generate_content(base_prompt)
-        raw = response.text or ""
-        risks = _parse_json_flex(raw)
-        # Fallback: retry with truncated document and stronger instruction if empty
-        if not risks:
-            short_doc = text[:15000]
-            retry_prompt = f"""
-            Output JSON only. Do not include any text before or after the JSON. Same schema as above.
+        record_metric("analyze_risks.calls")
+        response = _generate(doc_model, base_prompt, operation="analyze_risks", generation_config=generation_config)
+        record_usage("analyze_risks", response)
+        risks = _parse_structured(response.text or "")
+        # Exceptional path: the constrained output still did not parse
+        if risks is None:
+            record_metric("analyze_risks.retry")
+            retry_prompt = _build_prompt("analyze_risks.retry", text, lambda short_doc: f"""
+            Extract the potential risks from this document.
             Ensure fields are in {target_language} except severity which must be low|medium|high.
             Document:
             ---
             {short_doc}
             ---
-            """
+            """)
             try:
-                retry_resp = model.generate_content(retry_prompt)
-                risks = _parse_json_flex(retry_resp.text or "")
+                retry_resp = _generate(_get_model("analyze_risks"), retry_prompt, generation_config=generation_config)
+                record_usage("analyze_risks.retry", retry_resp)
+                risks = _parse_structured(retry_resp.text or "")
             except Exception:
                 pass
-        # Normalize severity to expected set
-        normalized = []
-        for r in risks:
-            sev = str(r.get("severity", "")).strip().lower()
-            if sev not in {"low", "medium", "high"}:
-                sev = "medium"
-            normalized.append({
-                "clause": r.get("clause", ""),
-                "issue": r.get("issue", ""),
-                "severity": sev,
-                "type": r.get("type", ""),
-                "worst_case": r.get("worst_case", ""),
-                "suggestion": r.get("suggestion", "")
-            })
-        return normalized
+            if risks is None:
+                record_metric("analyze_risks.failed")
+                return None
+        return _normalize_risks(risks)
     except Exception as e:
         print(f"Risk analysis error: {e}")
-        return []
+        return None
+
+
+def _normalize_risks(risks: list) -> list[dict]:
+    """Keep the known risk fields and normalize severity to low|medium|high."""
+    normalized = []
+    for r in risks:
+        if not isinstance(r, dict):
+            continue
+        sev = str(r.get("severity", "")).strip().lower()
+        if sev not in {"low", "medium", "high"}:
+            sev = "medium"
+        normalized.append({
+            "clause": r.get("clause", ""),
+            "issue": r.get("issue", ""),
+            "severity": sev,
+            "type": r.get("type", ""),
+            "worst_case": r.get("worst_case", ""),
+            "suggestion": r.get("suggestion", "")
+        })
+    return normalized
+
+
+# --- RISK RENDERING ---
+# Badge and field labels per language prefix: (high, medium, low, risk, issue, suggestion)
+RISK_LABELS = [
+    (("spanish", "espa"), ("Alto", "Medio", "Bajo", "Riesgo", "Problema", "Sugerencia")),
+    (("french", "fran"), ("Élevé", "Moyen", "Faible", "Risque", "Problème", "Suggestion")),
+    (("german", "deut"), ("Hoch", "Mittel", "Niedrig", "Risiko", "Problem", "Empfehlung")),
+    (("hindi", "हिन्दी"), ("उच्च", "मध्यम", "निम्न", "जोखिम", "मुद्दा", "सुझाव")),
+    (("marathi", "मराठी"), ("उच्च", "मध्यम", "कमी", "जोखीम", "मुद्दा", "सूचना")),
+]
+DEFAULT_RISK_LABELS = ("High", "Medium", "Low", "Risk", "Issue", "Suggestion")
+SEVERITY_CSS = {"low": "risk-low", "medium": "risk-medium", "high": "risk-high"}
+# Anything that could make markdown output differ from the escaped text
+MARKDOWN_SYNTAX = re.compile(r'[*_`\[\]!#\\]|^\s*(?:[-+>]|\d+[.)])\s|\n|  $', re.MULTILINE)
+MARKDOWN_CACHE_SIZE = 4096
+
+RISKS_TEMPLATE = Environment(autoescape=True).from_string(
+    "<ul class='risk-list'>"
+    "{% for r in risks %}"
+    "<li class='risk-item {{ r.css }}' data-type='{{ r.type_text }}'>"
+    "<div class='risk-header'><span class='risk-badge'>{{ r.badge }} {{ labels[3] }}</span>"
+    "<strong>{{ r.clause or 'Unnamed Clause' }}</strong></div>"
+    "<div class='risk-body'><div class='risk-issue'><b>{{ labels[4] }}:</b> {{ r.issue }}</div>"
+    "<div class='risk-worst'><b>Worst case:</b> {{ r.worst_case }}</div>"
+    "<div class='risk-type'><b>Type:</b> {{ r.type }}</div>"
+    "<div class='risk-suggestion'><b>{{ labels[5] }}:</b> {{ r.suggestion }}</div>"
+    "</div>"
+    "</li>"
+    "{% endfor %}"
+    "</ul>"
+)
+
+
+@functools.lru_cache(maxsize=64)
+def _risk_labels(lang: str) -> tuple:
+    lang = (lang or "").lower()
+    for prefixes, labels in RISK_LABELS:
+        # Native names may follow other text, e.g. "Hindi (हिन्दी)"
+        if lang.startswith(prefixes) or any(p in lang for p in prefixes if not p.isascii()):
+            return labels
+    return DEFAULT_RISK_LABELS
+
+
+@functools.lru_cache(maxsize=MARKDOWN_CACHE_SIZE)
+def _md_inline(s: str) -> Markup:
+    """Escaped inline HTML for a risk field. Markdown runs only when the text has markdown syntax."""
+    if not s:
+        return Markup("")
+    if not MARKDOWN_SYNTAX.search(s):
+        return escape(s)
+    # Escape first so raw HTML from the model is shown as text, then render markdown
+    html = markdown.markdown(str(escape(s)))
+    # Strip wrapping <p> ... </p>
+    if html.startswith('<p>') and html.endswith('</p>'):
+        html = html[3:-4]
+    # Flatten lists
+    html = html.replace('<ul>', '').replace('</ul>', '')
+    html = html.replace('<ol>', '').replace('</ol>', '')
+    html = html.replace('</li>', '; ')
+    html = html.replace('<li>', '')
+    # Remove newlines introduced by markdown
+    return Markup(html.replace('\n', ' ').strip(' ;'))
 
 
 def render_risks_html(risks: list[dict], target_language: str = "English") -> str:
     """Render color-coded HTML list for risks with localized badge labels."""
-    def _labels(lang: str) -> tuple[str, str, str, str]:
-        lang = (lang or "").lower()
-        if lang.startswith("spanish") or lang.startswith("espa"): # Español
-            return ("Alto", "Medio", "Bajo", "Riesgo")
-        if lang.startswith("french") or lang.startswith("fran"): # Français
-            return ("Élevé", "Moyen", "Faible", "Risque")
-        if lang.startswith("german") or lang.startswith("deut"): # Deutsch
-            return ("Hoch", "Mittel", "Niedrig", "Risiko")
-        if lang.startswith("hindi") or "हिन्दी" in lang: # हिन्दी
-            return ("उच्च", "मध्यम", "निम्न", "जोखिम")
-        if lang.startswith("marathi") or "मराठी" in lang: # मराठी
-            return ("उच्च", "मध्यम", "कमी", "जोखीम")
-        return ("High", "Medium", "Low", "Risk")
-
-    def _field_labels(lang: str) -> tuple[str, str]:
-        lang = (lang or "").lower()
-        if lang.startswith("spanish") or lang.startswith("espa"):
-            return ("Problema", "Sugerencia")
-        if lang.startswith("french") or lang.startswith("fran"):
-            return ("Problème", "Suggestion")
-        if lang.startswith("german") or lang.startswith("deut"):
-            return ("Problem", "Empfehlung")
-        if lang.startswith("hindi") or "हिन्दी" in lang:
-            return ("मुद्दा", "सुझाव")
-        if lang.startswith("marathi") or "मराठी" in lang:
-            return ("मुद्दा", "सूचना")
-        return ("Issue", "Suggestion")
-
-    def _md_inline(s: str) -> str:
-        """Convert markdown to inline HTML: strip block tags like <p>, <ul>, <ol>, <li>."""
-        if not s:
-            return ""
-        html = markdown.markdown(s)
-        # Strip wrapping <p> ... </p>
-        if html.startswith('<p>') and html.endswith('</p>'):
-            html = html[3:-4]
-        # Flatten lists
-        html = html.replace('<ul>', '').replace('</ul>', '')
-        html = html.replace('<ol>', '').replace('</ol>', '')
-        html = html.replace('</li>', '; ')
-        html = html.replace('<li>', '')
-        # Remove newlines introduced by markdown
-        return html.replace('\n', ' ').strip(' ;')
-
     if not risks:
         return "<p class='risk-empty'>No obvious risks detected.</p>"
-    sev_to_class = {"low": "risk-low", "medium": "risk-medium", "high": "risk-high"}
-    high_lbl, med_lbl, low_lbl, risk_word = _labels(target_language)
-    issue_lbl, sugg_lbl = _field_labels(target_language)
-    sev_label_map = {"high": high_lbl, "medium": med_lbl, "low": low_lbl}
-    items = []
+    labels = _risk_labels(target_language)
+    badges = {"high": labels[0], "medium": labels[1], "low": labels[2]}
+    rows = []
     for r in risks:
-        css = sev_to_class.get(r.get("severity", "medium"), "risk-medium")
-        clause = _md_inline((r.get("clause") or "").strip())
-        issue = _md_inline((r.get("issue") or "").strip())
-        worst_case = _md_inline((r.get("worst_case") or "").strip())
-        rtype = _md_inline((r.get("type") or "").strip())
-        suggestion = _md_inline((r.get("suggestion") or "").strip())
-        badge_text = f"{sev_label_map.get(r.get('severity','medium'), med_lbl)} {risk_word}"
-        items.append(
-            f"<li class='risk-item {css}' data-type='{rtype}'>"
-            f"<div class='risk-header'><span class='risk-badge'>{badge_text}</span>"
-            f"<strong>{clause or 'Unnamed Clause'}</strong></div>"
-            f"<div class='risk-body'><div class='risk-issue'><b>{issue_lbl}:</b> {issue}</div>"
-            f"<div class='risk-worst'><b>Worst case:</b> {worst_case}</div>"
-            f"<div class='risk-type'><b>Type:</b> {rtype}</div>"
-            f"<div class='risk-suggestion'><b>{sugg_lbl}:</b> {suggestion}</div>"
-            f"</div>"
-            f"</li>"
-        )
-    return "<ul class='risk-list'>" + "".join(items) + "</ul>"
+        severity = r.get("severity", "medium")
+        type_text = (r.get("type") or "").strip()
+        rows.append({
+            "css": SEVERITY_CSS.get(severity, "risk-medium"),
+            "badge": badges.get(severity, labels[1]),
+            "type_text": type_text,
+            "clause": _md_inline((r.get("clause") or "").strip()),
+            "issue": _md_inline((r.get("issue") or "").strip()),
+            "worst_case": _md_inline((r.get("worst_case") or "").strip()),
+            "type": _md_inline(type_text),
+            "suggestion": _md_inline((r.get("suggestion") or "").strip()),
+        })
+    return RISKS_TEMPLATE.render(risks=rows, labels=labels)
 
 
 def compute_risk_stats(risks: list[dict]) -> dict:
@@ -371,10 +706,20 @@ def compute_risk_stats(risks: list[dict]) -> dict:
 
 
 def rewrite_clause(clause_text: str, target_language: str = "English", mode: str = "plain") -> str:
-    """Generate a safer rewrite of a clause."""
+    """Generate a safer rewrite of a clause (cached per clause, language and mode)."""
+    rewrite = cached_rewrite(clause_text, target_language, mode)
+    return rewrite if rewrite is not None else REWRITE_FAILED_MESSAGE
+
+
+def _rewrite_style(mode: str) -> str:
+    return "plain, clear non-legalese" if mode == "plain" else "concise, formal legal drafting"
+
+
+def _rewrite_one(clause_text: str, target_language: str, mode: str) -> str:
+    """One rewrite call. Returns None on failure so the error is not cached."""
     # REMOVED: vertexai.init() call was here
-    style_hint = "plain, clear non-legalese" if mode == "plain" else "concise, formal legal drafting"
-    prompt = f"""
+    style_hint = _rewrite_style(mode)
+    prompt = _build_prompt("rewrite_clause", clause_text, lambda clause_text: f"""
     Rewrite the following clause to be SAFER for the signing party while preserving business intent.
     - Use {style_hint}
     - Keep it brief and actionable
@@ -384,30 +729,34 @@ def rewrite_clause(clause_text: str, target_language: str = "English", mode: str
     ---
     {clause_text}
     ---
-    """
+    """)
     try:
-        resp = model.generate_content(prompt)
-        return (resp.text or "").strip()
+        resp = _generate(_get_model("rewrite_clause"), prompt, operation="rewrite_clause")
+        record_usage("rewrite_clause", resp)
+        return (resp.text or "").strip() or None
     except Exception as e:
         print(f"Rewrite error: {e}")
-        return "Sorry, could not generate a safer rewrite right now."
+        return None
+
+
+class _CSVLine:
+    """File-like target for csv.writer: writerow returns the formatted line."""
+
+    def write(self, line: str) -> str:
+        return line
+
+
+def iter_risks_csv(risks: list[dict]):
+    """Yield the risks CSV one line at a time, for streamed downloads."""
+    writer = csv.writer(_CSVLine())
+    yield writer.writerow(RISK_FIELDS)
+    for r in risks:
+        yield writer.writerow([r.get(field, "") for field in RISK_FIELDS])
 
 
 def risks_to_csv(risks: list[dict]) -> str:
     """Return CSV string for risks."""
-    output = io.StringIO()
-    writer = csv.writer(output)
-    writer.writerow(["clause", "issue", "severity", "type", "worst_case", "suggestion"])
-    for r in risks:
-        writer.writerow([
-            r.get("clause", ""),
-            r.get("issue", ""),
-            r.get("severity", ""),
-            r.get("type", ""),
-            r.get("worst_case", ""),
-            r.get("suggestion", ""),
-        ])
-    return output.getvalue()
+    return "".join(iter_risks_csv(risks))
 
 
 def risks_to_html(risks: list[dict], target_language: str = "English") -> str:
@@ -422,95 +771,647 @@ def risks_to_html(risks: list[dict], target_language: str = "English") -> str:
 
 def risks_to_pdf_bytes(risks: list[dict], target_language: str = "English") -> bytes:
     """Render a compact PDF for the risks list and return it as bytes."""
-    def _safe(text: str) -> str:
-        s = (text or "")
-        s = (s
-            .replace("“", '"').replace("”", '"')
-            .replace("‘", "'").replace("’", "'")
-            .replace("–", "-").replace("—", "-")
-            .replace("•", "-")
-        )
-        try:
-            return s.encode('latin-1', 'replace').decode('latin-1')
-        except Exception:
-            return s
-    pdf = FPDF(unit="pt", format="A4")
-    pdf.set_auto_page_break(auto=True, margin=36)
-    pdf.add_page()
-    pdf.set_title("LegalEase AI - Risk Report")
+    import pdf_report
+    if len(risks) >= pdf_report.OFFLOAD_MIN_RISKS:
+        # Large reports render in the CPU pool so layout does not hold the GIL
+        return cpu_pool.run(pdf_report.render_risk_report, risks, target_language)
+    return pdf_report.render_risk_report(risks, target_language)
 
-    pdf.set_font("Helvetica", "B", 16)
-    pdf.cell(0, 22, "LegalEase AI - Risk Report", ln=1)
-    pdf.set_font("Helvetica", size=11)
-    pdf.set_text_color(40, 40, 40)
 
-    if not risks:
-        pdf.multi_cell(0, 16, _safe("No obvious risks detected."))
-        return pdf.output(dest='S').encode('latin1')
-
-    sev_color = {"low": (6,214,160), "medium": (255,209,102), "high": (255,107,107)}
-
-    for r in risks:
-        sev = str(r.get("severity", "medium")).lower()
-        color = sev_color.get(sev, (200,200,200))
-        pdf.set_fill_color(*color)
-        pdf.set_text_color(0,0,0)
-        pdf.cell(70, 16, _safe(sev.capitalize()), align='C', fill=True)
-        pdf.cell(0, 16, _safe(f"Clause: {r.get('clause','')}`".rstrip('`')), ln=1)
-
-        pdf.set_text_color(60,60,60)
-        issue = r.get("issue", "")
-        worst = r.get("worst_case", "")
-        type_ = r.get("type", "")
-        sugg = r.get("suggestion", "")
-        if type_:
-            pdf.set_font_size(11)
-            pdf.multi_cell(0, 14, _safe(f"Type: {type_}"))
-        if issue:
-            pdf.multi_cell(0, 14, _safe(f"Issue: {issue}"))
-        if worst:
-            pdf.multi_cell(0, 14, _safe(f"Worst case: {worst}"))
-        if sugg:
-            pdf.multi_cell(0, 14, _safe(f"Suggestion: {sugg}"))
-        pdf.ln(6)
-
-    return pdf.output(dest='S').encode('latin-1', 'replace')
+SUMMARY_INSTRUCTIONS = """
+    **Output Structure:**
+    1.  **Document Purpose:** Start with a 1-2 sentence overview explaining what this document is for (e.g., 'This is a freelance contract for web design services between a client and a developer.').
+    2.  **Key Sections Explained:** Below the overview, create a summary of the document's main sections. For each section, use a bolded heading (like **Scope of Work** or **Payment Terms**) and provide a 1-3 sentence explanation in simple terms. Cover all important topics present in the document, such as who is involved, main responsibilities, payment details, confidentiality, liability, and how the agreement can be ended.
+"""
 
 
+@single_flight.coalesce("summarize_text")
 def summarize_text(text: str, target_language: str = "English") -> str:
     """Generates a simple summary of the text."""
+    summary = _summary_markdown(text, target_language)
+    if summary is None:
+        return "Sorry, there was an error processing your request with the AI."
+    return markdown.markdown(summary)
+
+
+def _summary_markdown(text: str, target_language: str) -> str:
+    """Summary markdown behind summarize_text; None when the model call fails."""
     # REMOVED: vertexai.init() call was here
-    prompt = f"""
+    doc_model, document = _model_for_document(text, "summarize_text")
+    prompt = _build_prompt("summarize_text", document, lambda document: f"""
     You are an expert paralegal AI assistant. Your goal is to simplify complex legal documents for the average person, providing a balanced summary that is detailed but easy to read.
+    {SUMMARY_INSTRUCTIONS}
+    Use Markdown for formatting. The entire response MUST be in this language: **{target_language}**
 
-    **Output Structure:**
-    1.  **Document Purpose:** Start with a 1-2 sentence overview explaining what this document is for (e.g., 'This is a freelance contract for web design services between a client and a developer.').
-    2.  **Key Sections Explained:** Below the overview, create a summary of the document's main sections. For each section, use a bolded heading (like **Scope of Work** or **Payment Terms**) and provide a 1-3 sentence explanation in simple terms. Cover all important topics present in the document, such as who is involved, main responsibilities, payment details, confidentiality, liability, and how the agreement can be ended.
+    ---
+    LEGAL TEXT:
+    {document}
+    ---
+    """)
+    try:
+        response = _generate(doc_model, prompt, operation="summarize_text")
+        record_usage("summarize_text", response)
+        return response.text
+    except Exception as e:
+        print(f"An error occurred with the AI model: {e}")
+        return None
 
-    Use Markdown for formatting. The entire response MUST be in this language: **{target_language}**
+
+def analyze_document_fused(text: str, target_language: str = "English") -> dict:
+    """
+    Single-call alternative to is_legal_document + summarize_text + analyze_risks.
+    The document is sent once and one structured response carries the legal flag,
+    the summary markdown and the risk list.
+    Returns {"is_legal": bool, "summary_html": str, "risks": list[dict]},
+    or None if the call fails so the caller can fall back to the separate calls.
+    """
+    doc_model, document = _model_for_document(text, "analyze_document_fused")
+    prompt = _build_prompt("analyze_document_fused", document, lambda document: f"""
+    You are an expert paralegal AI assistant and senior contract analyst. Read the document once and return three things.
+
+    1. "is_legal_document": true if the text is a legal document (contracts, terms of service, non-disclosure agreements, lease agreements, privacy policies, etc.), false for articles, stories, recipes, conversations, etc.
+
+    2. "summary_markdown": a balanced summary that simplifies the document for the average person, detailed but easy to read.
+    {SUMMARY_INSTRUCTIONS}
+    Use Markdown for formatting.
+
+    3. "risks": a concise list of potential risks, each with the clause, the issue, its severity, a risk type, the worst case and a suggestion.
+
+    CRITICAL:
+    - "summary_markdown" and the risk values for "clause", "issue", "type", "worst_case" and "suggestion" MUST be written in this language: {target_language}
+    - The value for "severity" MUST be one of: low, medium, high (lowercase, English)
 
     ---
     LEGAL TEXT:
-    {text}
+    {document}
+    ---
+    """)
+    generation_config = _generation_config(
+        temperature=RISK_ANALYSIS_TEMPERATURE,
+        response_mime_type="application/json",
+        response_schema=FUSED_ANALYSIS_RESPONSE_SCHEMA,
+    )
+    try:
+        record_metric("analyze_document_fused.calls")
+        response = _generate(doc_model, prompt, operation="analyze_document_fused", generation_config=generation_config)
+        record_usage("analyze_document_fused", response)
+        data = json.loads(response.text or "")
+        return {
+            "is_legal": bool(data.get("is_legal_document", True)),
+            "summary_html": markdown.markdown(data.get("summary_markdown", "")),
+            "risks": _normalize_risks(data.get("risks", [])),
+        }
+    except Exception as e:
+        print(f"Fused analysis error: {e}")
+        record_metric("analyze_document_fused.failed")
+        return None
+
+
+# --- LANGUAGE-NEUTRAL ANALYSIS CACHE ---
+# Summary and risks are computed once per document in CANONICAL_LANGUAGE.
+# Other languages translate only the short result fields; severity and the
+# risk list structure are shared.
+CANONICAL_LANGUAGE = os.getenv("CANONICAL_LANGUAGE", "English")
+ANALYSIS_CACHE_MAX_DOCUMENTS = int(os.getenv("ANALYSIS_CACHE_MAX_DOCUMENTS", "256"))
+# Translated in the background as soon as a document has been analyzed
+PRESET_LANGUAGES = [lang.strip() for lang in os.getenv("PRESET_LANGUAGES", "").split(",") if lang.strip()]
+
+
+class _LRUCache:
+    """Small thread-safe LRU map."""
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._entries:
+                return None
+            self._entries.move_to_end(key)
+            return self._entries[key]
+
+    def put(self, key, value) -> None:
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+# (document key, part) -> canonical summary markdown / risk list
+_canonical_analysis = _LRUCache(ANALYSIS_CACHE_MAX_DOCUMENTS * 2)
+# (document key, part, language) -> translated summary markdown / risk list
+_translated_analysis = _LRUCache(ANALYSIS_CACHE_MAX_DOCUMENTS * 8)
+
+
+def _is_canonical_language(language: str) -> bool:
+    return (language or CANONICAL_LANGUAGE).strip().lower() == CANONICAL_LANGUAGE.lower()
+
+
+def translate_summary(summary_markdown: str, target_language: str) -> str:
+    """Translate a summary, keeping its Markdown structure. Returns None on failure."""
+    prompt = f"""
+    Translate this Markdown summary of a legal document into {target_language}.
+    Keep the Markdown structure, headings, lists and emphasis exactly as they are. Do not add or drop content.
+
+    ---
+    {summary_markdown}
     ---
     """
+    generation_config = _generation_config(
+        temperature=TRANSLATION_TEMPERATURE,
+        response_mime_type="application/json",
+        response_schema=SUMMARY_TRANSLATION_SCHEMA,
+    )
     try:
-        response = model.generate_content(prompt)
-        return markdown.markdown(response.text)
+        record_metric("translate_summary.calls")
+        response = _generate(_get_model("translate_summary"), prompt, generation_config=generation_config)
+        record_usage("translate_summary", response)
+        return json.loads(response.text)["summary_markdown"]
     except Exception as e:
-        print(f"An error occurred with the AI model: {e}")
-        return "Sorry, there was an error processing your request with the AI."
+        print(f"Summary translation error: {e}")
+        return None
+
+
+def translate_risks(risks: list[dict], target_language: str) -> list[dict]:
+    """
+    Translate the text fields of a risk list. Severity and order come from the
+    source list. Returns None if the call fails or the list comes back reshaped.
+    """
+    if not risks:
+        return []
+    payload = json.dumps({"risks": [{field: r.get(field, "") for field in TRANSLATED_RISK_FIELDS} for r in risks]}, ensure_ascii=False)
+    prompt = f"""
+    Translate every string value in this JSON into {target_language}.
+    Return the same number of risks in the same order with the same keys. Do not merge, drop or add risks.
+
+    {payload}
+    """
+    generation_config = _generation_config(
+        temperature=TRANSLATION_TEMPERATURE,
+        response_mime_type="application/json",
+        response_schema=RISK_TRANSLATION_SCHEMA,
+    )
+    try:
+        record_metric("translate_risks.calls")
+        response = _generate(_get_model("translate_risks"), prompt, generation_config=generation_config)
+        record_usage("translate_risks", response)
+        translated = json.loads(response.text)["risks"]
+    except Exception as e:
+        print(f"Risk translation error: {e}")
+        return None
+    if len(translated) != len(risks):
+        record_metric("translate_risks.shape_mismatch")
+        return None
+    return [dict(source, **{field: item.get(field) or source.get(field, "") for field in TRANSLATED_RISK_FIELDS})
+            for source, item in zip(risks, translated)]
+
+
+# --- NEAR-DUPLICATE REUSE ---
+# Template documents (same NDA/lease, different names and dates) reuse the
+# risks found in clauses they share verbatim with a document analyzed before;
+# only the differing clauses go to the model. Summaries are always generated
+# fresh, since a prior summary would carry the other document's parties.
+NEAR_DUPLICATE_THRESHOLD = float(os.getenv("NEAR_DUPLICATE_THRESHOLD", "0.8"))
+NEAR_DUPLICATE_MAX_DOCUMENTS = int(os.getenv("NEAR_DUPLICATE_MAX_DOCUMENTS", "1000"))
+near_duplicate_index = near_duplicates.NearDuplicateIndex(NEAR_DUPLICATE_THRESHOLD, NEAR_DUPLICATE_MAX_DOCUMENTS)
+# A risk belongs to the clause holding its quote, or most (this share) of the quote's words
+QUOTE_MIN_WORD_OVERLAP = 0.8
+
+
+QUOTE_MARKS = re.compile(r"[\"“”‘’…]|\.\.\.|(?<!\w)'|'(?!\w)")
+QUOTE_WORD = re.compile(r"[\w\u0900-\u0DFF]+")
+
+
+def _quote_key(value: str) -> str:
+    """Quote text normalized for containment checks (quote marks, ellipses, case, spacing)."""
+    return " ".join(QUOTE_MARKS.sub(" ", value or "").lower().split())
+
+
+def _locate_risks(risks: list[dict], clauses: list[str]) -> list:
+    """
+    For each risk, the hash of the clause of the analyzed document that holds its
+    quote (verbatim, or most of its words when trimmed or paraphrased); None when
+    no clause does, e.g. a canonical English quote of a document in another language.
+    """
+    indexed = []
+    for clause in clauses:
+        key = _quote_key(clause)
+        indexed.append((near_duplicates.clause_hash(clause), key, set(QUOTE_WORD.findall(key))))
+    located = []
+    for risk in risks:
+        quote = _quote_key(risk.get("clause", ""))
+        words = set(QUOTE_WORD.findall(quote))
+        best, best_overlap = None, QUOTE_MIN_WORD_OVERLAP
+        for clause_hash, key, clause_words in indexed:
+            if quote and quote in key:
+                best = clause_hash
+                break
+            overlap = len(words & clause_words) / len(words) if words else 0.0
+            if overlap > best_overlap:
+                best, best_overlap = clause_hash, overlap
+        located.append(best)
+    return located
+
+
+def _reusable_risk_indexes(doc_key: str, prior_risks: list[dict], clause_hashes: set) -> list[int]:
+    """
+    Indexes of doc_key's risks that carry over to a document with these clause
+    hashes: the risks of clauses it still contains. None when any risk could not
+    be tied to a clause, since it may concern a changed clause or quote text the
+    new document lacks; the document should then be analyzed in full.
+    """
+    located = (_document_versions.get(doc_key) or {}).get("risk_clauses")
+    if located is None or len(located) != len(prior_risks) or None in located:
+        return None
+    return [i for i, h in enumerate(located) if h in clause_hashes]
+
+
+def _near_duplicate_prior(text: str) -> tuple:
+    """(match, prior canonical risks) for a near-duplicate with cached risks, else (None, None)."""
+    match = near_duplicate_index.query(text, exclude=_document_key(text))
+    if match is None:
+        return None, None
+    prior_risks = _canonical_analysis.get((match["doc_key"], "risks"))
+    return (match, prior_risks) if prior_risks is not None else (None, None)
+
+
+def _canonical_risks(text: str, language: str) -> list[dict]:
+    """Canonical risk list, re-analyzing only changed clauses of a near-duplicate."""
+    match, prior_risks = _near_duplicate_prior(text)
+    risks = None
+    if match is not None:
+        record_metric("near_duplicate.matches")
+        keep = _reusable_risk_indexes(match["doc_key"], prior_risks, _clause_hashes(match["unchanged_clauses"]))
+        if keep is None:
+            record_metric("near_duplicate.full_reanalysis")
+            match = None
+    if match is not None:
+        kept = [prior_risks[i] for i in keep]
+        changed_text = "\n\n".join(match["changed_clauses"])
+        new_risks = _extract_risks(changed_text, language) if changed_text.strip() else []
+        if new_risks is not None:
+            record_metric("near_duplicate.reused_risks", len(kept))
+            record_metric("near_duplicate.changed_clauses", len(match["changed_clauses"]))
+            print(f"Near-duplicate ({match['similarity']:.0%} similar): reused {len(kept)} risks, "
+                  f"re-analyzed {len(match['changed_clauses'])} changed clauses.")
+            risks = kept + new_risks
+    if risks is None:
+        risks = _extract_risks(text, language)
+    if risks is not None:
+        _remember_document(text, risks)
+    return risks
+
+
+def _clause_hashes(clauses: list[str]) -> set:
+    return {near_duplicates.clause_hash(clause) for clause in clauses}
+
+
+def _remember_document(text: str, risks: list[dict] = None, previous_id: str = None) -> str:
+    """
+    Index an analyzed document for near-duplicate and version lookups, with the
+    clause each of its canonical risks belongs to; returns its id.
+    """
+    doc_key = _document_key(text)
+    near_duplicate_index.add(doc_key, text)
+    existing = _document_versions.get(doc_key) or {}
+    clauses = prompt_budget.split_sections(text)
+    _document_versions.put(doc_key, {
+        "clause_hashes": _clause_hashes(clauses),
+        "risk_clauses": _locate_risks(risks, clauses) if risks is not None else existing.get("risk_clauses"),
+        "previous": previous_id or existing.get("previous"),
+    })
+    return doc_key
+
+
+def preliminary_risks(text: str, target_language: str = "English") -> list[dict]:
+    """
+    Cache-only preview for a near-duplicate: the prior document's risks for
+    clauses this document shares verbatim, in target_language if already
+    translated. Makes no model calls; returns None when nothing applies.
+    """
+    match, prior_risks = _near_duplicate_prior(text)
+    if match is None:
+        return None
+    keep = _reusable_risk_indexes(match["doc_key"], prior_risks, _clause_hashes(match["unchanged_clauses"]))
+    if keep is None:
+        return None
+    if not _is_canonical_language(target_language):
+        prior_risks = _translated_analysis.get((match["doc_key"], "risks", target_language.strip().lower()))
+        if prior_risks is None:
+            return None
+    return [dict(prior_risks[i]) for i in keep]
+
+
+# --- DOCUMENT VERSIONS ---
+# Revisions of a contract are registered against the previous analysis; only
+# changed or added clauses are re-analyzed and the response says how the risk
+# picture moved.
+# document id -> {"clause_hashes": set, "risk_clauses": clause hash per canonical risk, "previous": previous document id}
+_document_versions = _LRUCache(ANALYSIS_CACHE_MAX_DOCUMENTS)
+MODIFIED_RISK_SIMILARITY = 0.6
+SEVERITY_RANK = {"low": 0, "medium": 1, "high": 2}
+
+
+def document_id(text: str) -> str:
+    """Stable id for a document's text, used to register later versions against it."""
+    return _document_key(text)
+
+
+def _risk_identity(risk: dict) -> tuple:
+    return _quote_key(risk.get("clause", "")), _quote_key(risk.get("issue", ""))
+
+
+def diff_risks(before: list[dict], after: list[dict]) -> dict:
+    """
+    Risk-level delta between two canonical risk lists: added and removed risks,
+    and removed/added pairs on a similar clause reported as modified.
+    Items carry their index in the list they came from.
+    """
+    before_ids = {_risk_identity(r) for r in before}
+    after_ids = {_risk_identity(r) for r in after}
+    added = [i for i, r in enumerate(after) if _risk_identity(r) not in before_ids]
+    removed = [i for i, r in enumerate(before) if _risk_identity(r) not in after_ids]
+
+    modified = []
+    for i in list(removed):
+        best, best_ratio = None, MODIFIED_RISK_SIMILARITY
+        for j in added:
+            ratio = difflib.SequenceMatcher(None, _quote_key(before[i].get("clause", "")), _quote_key(after[j].get("clause", ""))).ratio()
+            if ratio >= best_ratio:
+                best, best_ratio = j, ratio
+        if best is not None:
+            modified.append((i, best))
+            removed.remove(i)
+            added.remove(best)
+    return {"added": added, "removed": removed, "modified": modified, "unchanged": len(after) - len(added) - len(modified)}
+
+
+def _severity_counts(risks: list[dict]) -> dict:
+    return compute_risk_stats(risks)["severity"]
+
+
+def _delta_summary(delta: dict, before: list[dict], after: list[dict]) -> str:
+    parts = []
+    if delta["added"]:
+        high = sum(1 for j in delta["added"] if after[j]["severity"] == "high")
+        parts.append(f"{len(delta['added'])} risk(s) added" + (f" ({high} high)" if high else ""))
+    if delta["removed"]:
+        parts.append(f"{len(delta['removed'])} risk(s) resolved or removed")
+    escalated = sum(1 for i, j in delta["modified"] if SEVERITY_RANK.get(after[j]["severity"], 1) > SEVERITY_RANK.get(before[i]["severity"], 1))
+    reduced = sum(1 for i, j in delta["modified"] if SEVERITY_RANK.get(after[j]["severity"], 1) < SEVERITY_RANK.get(before[i]["severity"], 1))
+    if delta["modified"]:
+        parts.append(f"{len(delta['modified'])} risk(s) changed ({escalated} more severe, {reduced} less severe)")
+    return "; ".join(parts) + "." if parts else "No change in risk terms."
+
+
+def analyze_revision(text: str, previous_id: str, target_language: str = "English") -> dict:
+    """
+    Analyze a new version of a previously analyzed document. Risks of clauses
+    carried over verbatim are reused; only changed or added clauses go to the
+    model. When the prior risks cannot be tied to clauses, the revision is
+    analyzed in full. Returns None when the previous analysis is no longer cached.
+    """
+    previous = _document_versions.get(previous_id)
+    prior_risks = _canonical_analysis.get((previous_id, "risks"))
+    if previous is None or prior_risks is None:
+        return None
+
+    clauses = prompt_budget.split_sections(text)
+    clause_hashes = [near_duplicates.clause_hash(clause) for clause in clauses]
+    unchanged = [c for c, h in zip(clauses, clause_hashes) if h in previous["clause_hashes"]]
+    changed = [c for c, h in zip(clauses, clause_hashes) if h not in previous["clause_hashes"]]
+    removed_clauses = len(previous["clause_hashes"] - set(clause_hashes))
+
+    doc_key = _document_key(text)
+    risks = _canonical_analysis.get((doc_key, "risks"))
+    if risks is None:
+        record_metric("analyze_revision.calls")
+        keep = _reusable_risk_indexes(previous_id, prior_risks, set(clause_hashes))
+        if keep is None:
+            # Prior risks cannot be tied to clauses reliably: analyze the revision in full
+            record_metric("analyze_revision.full_reanalysis")
+            risks = _extract_risks(text, CANONICAL_LANGUAGE)
+            if risks is None:
+                return None
+        else:
+            kept = [prior_risks[i] for i in keep]
+            changed_text = "\n\n".join(changed)
+            new_risks = _extract_risks(changed_text, CANONICAL_LANGUAGE) if changed_text.strip() else []
+            if new_risks is None:
+                return None
+            risks = kept + new_risks
+            record_metric("analyze_revision.reused_risks", len(kept))
+            record_metric("analyze_revision.changed_clauses", len(changed))
+        _canonical_analysis.put((doc_key, "risks"), risks)
+    _remember_document(text, risks, previous_id=previous_id)
+
+    delta = diff_risks(prior_risks, risks)
+    localized = localized_risks(text, target_language)
+    localized_prior = prior_risks
+    if not _is_canonical_language(target_language):
+        cached_prior = _translated_analysis.get((previous_id, "risks", target_language.strip().lower()))
+        if cached_prior is not None:
+            localized_prior = cached_prior
+        elif delta["removed"] or delta["modified"]:
+            localized_prior = translate_risks(prior_risks, target_language.strip()) or prior_risks
+    return {
+        "document_id": doc_key,
+        "previous_document_id": previous_id,
+        "clauses": {"total": len(clauses), "unchanged": len(unchanged), "changed_or_added": len(changed), "removed": removed_clauses},
+        "risks": localized,
+        "delta": {
+            "summary": _delta_summary(delta, prior_risks, risks),
+            "added": [localized[j] for j in delta["added"]],
+            "removed": [localized_prior[i] for i in delta["removed"]],
+            "modified": [{"before": localized_prior[i], "after": localized[j]} for i, j in delta["modified"]],
+            "unchanged": delta["unchanged"],
+            "severity_before": _severity_counts(prior_risks),
+            "severity_after": _severity_counts(risks),
+        },
+    }
+
+
+_CANONICAL_PARTS = {"summary": _summary_markdown, "risks": _canonical_risks}
+_TRANSLATORS = {"summary": translate_summary, "risks": translate_risks}
+
+
+def _cached_part(cache: _LRUCache, key: tuple, compute, *args, name: str = "analysis_cache"):
+    """Cache lookup with single-flight computation; failures (None) are not cached."""
+    value = cache.get(key)
+    if value is not None:
+        record_metric(f"{name}.hits")
+        return value
+    record_metric(f"{name}.misses")
+    value = single_flight.do(single_flight.make_key(name, *key), compute, *args)
+    if value is not None:
+        cache.put(key, value)
+    return value
+
+
+def _localized_part(text: str, part: str, target_language: str):
+    """Canonical result for part, translated to target_language; None if either step fails."""
+    doc_key = _document_key(text)
+    value = _cached_part(_canonical_analysis, (doc_key, part), _CANONICAL_PARTS[part], text, CANONICAL_LANGUAGE)
+    if value is None or _is_canonical_language(target_language):
+        return value
+    language = target_language.strip()
+    return _cached_part(_translated_analysis, (doc_key, part, language.lower()), _TRANSLATORS[part], value, language)
+
+
+def localized_summary(text: str, target_language: str = "English") -> str:
+    """summarize_text through the language-neutral cache. Returns summary HTML."""
+    summary = _localized_part(text, "summary", target_language)
+    if summary is None:
+        # Translation or canonical analysis failed: analyze directly in the target language
+        return summarize_text(text, target_language)
+    return markdown.markdown(summary)
+
+
+def localized_risks(text: str, target_language: str = "English") -> list[dict]:
+    """analyze_risks through the language-neutral cache."""
+    risks = _localized_part(text, "risks", target_language)
+    if risks is None:
+        return analyze_risks(text, target_language)
+    return [dict(r) for r in risks]
+
+
+def prewarm_translations(text: str, languages: list[str] = None) -> None:
+    """
+    Translate a document's cached analysis into each preset language, one
+    translation at a time: this runs as a single job on the caller's bounded
+    prewarm pool, which is what limits its model calls.
+    """
+    languages = [lang for lang in (PRESET_LANGUAGES if languages is None else languages) if not _is_canonical_language(lang)]
+    for language in languages:
+        for part in _CANONICAL_PARTS:
+            try:
+                _localized_part(text, part, language)
+            except Exception as e:
+                print(f"Prewarming the {language} {part} failed: {e}")
+
+
+# --- CLAUSE REWRITES ---
+# Rewrites are cached per clause, language and mode. Several clauses are
+# rewritten in one structured call. With PREWARM_REWRITES on, rewrites for
+# high-severity risks are generated in the background once the risk analysis
+# is done, so most "rewrite" clicks are answered from the cache.
+REWRITE_CACHE_MAX_ENTRIES = int(os.getenv("REWRITE_CACHE_MAX_ENTRIES", "2048"))
+REWRITE_BATCH_SIZE = int(os.getenv("REWRITE_BATCH_SIZE", "8"))
+REWRITE_CLAUSE_MAX_TOKENS = 3000
+PREWARM_REWRITES = os.getenv("PREWARM_REWRITES", "false").lower() in ("1", "true", "yes")
+PREWARM_REWRITE_SEVERITIES = ("high",)
+PREWARM_REWRITE_MODES = [mode.strip() for mode in os.getenv("PREWARM_REWRITE_MODES", "plain").split(",") if mode.strip()]
+REWRITE_FAILED_MESSAGE = "Sorry, could not generate a safer rewrite right now."
+
+# (clause hash, language, mode) -> rewrite text
+_rewrite_cache = _LRUCache(REWRITE_CACHE_MAX_ENTRIES)
+
+
+def _rewrite_key(clause_text: str, target_language: str, mode: str) -> tuple:
+    return near_duplicates.clause_hash(clause_text), target_language.strip().lower(), mode
+
+
+def cached_rewrite(clause_text: str, target_language: str = "English", mode: str = "plain") -> str:
+    """Rewrite from the cache, or a single call on a miss. None if the call fails."""
+    key = _rewrite_key(clause_text, target_language, mode)
+    return _cached_part(_rewrite_cache, key, _rewrite_one, clause_text, target_language, mode, name="rewrite_cache")
+
+
+def _rewrite_batch(clauses: list[str], target_language: str, mode: str) -> list[str]:
+    """Rewrite several clauses in one structured call. None on failure or a count mismatch."""
+    fitted = [prompt_budget.fit_text(clause, REWRITE_CLAUSE_MAX_TOKENS)[0] for clause in clauses]
+    payload = json.dumps({"clauses": fitted}, ensure_ascii=False)
+    prompt = f"""
+    Rewrite each clause in this JSON to be SAFER for the signing party while preserving business intent.
+    - Use {_rewrite_style(mode)}
+    - Keep each rewrite brief and actionable
+    - Write entirely in: {target_language}
+    Return exactly one rewrite per clause, in the same order.
+
+    {payload}
+    """
+    generation_config = _generation_config(
+        response_mime_type="application/json",
+        response_schema=REWRITE_BATCH_SCHEMA,
+    )
+    try:
+        record_metric("rewrite_batch.calls")
+        response = _generate(_get_model("rewrite_clauses"), prompt, operation="rewrite_clauses", generation_config=generation_config)
+        record_usage("rewrite_clauses", response)
+        rewrites = json.loads(response.text)["rewrites"]
+    except Exception as e:
+        print(f"Batch rewrite error: {e}")
+        return None
+    if len(rewrites) != len(clauses) or not all(isinstance(r, str) and r.strip() for r in rewrites):
+        record_metric("rewrite_batch.shape_mismatch")
+        return None
+    return [r.strip() for r in rewrites]
+
+
+def rewrite_clauses(clauses: list[str], target_language: str = "English", mode: str = "plain") -> list[str]:
+    """
+    Safer rewrites for many clauses, in order. Cached clauses are answered
+    directly; the rest go out in structured batches of REWRITE_BATCH_SIZE, and
+    a failed batch falls back to concurrent single rewrites.
+    """
+    results = [None] * len(clauses)
+    missing = {}  # clause hash -> (clause, indexes), so repeated clauses are rewritten once
+    for i, clause in enumerate(clauses):
+        key = _rewrite_key(clause, target_language, mode)
+        cached = _rewrite_cache.get(key)
+        if cached is not None:
+            record_metric("rewrite_cache.hits")
+            results[i] = cached
+        else:
+            missing.setdefault(key, (clause, []))[1].append(i)
+
+    pending = list(missing.items())
+    record_metric("rewrite_cache.misses", len(pending))
+    for start in range(0, len(pending), REWRITE_BATCH_SIZE):
+        batch = pending[start:start + REWRITE_BATCH_SIZE]
+        rewrites = _rewrite_batch([clause for _, (clause, _) in batch], target_language, mode) if len(batch) > 1 else None
+        if rewrites is None:
+            with ThreadPoolExecutor(max_workers=min(4, len(batch))) as executor:
+                # Same flight key as cached_rewrite, so a click on one of these clauses joins the call
+                rewrites = list(executor.map(
+                    lambda item: single_flight.do(single_flight.make_key("rewrite_cache", *item[0]), _rewrite_one, item[1][0], target_language, mode),
+                    batch,
+                ))
+        for (key, (_, indexes)), rewrite in zip(batch, rewrites):
+            if rewrite is not None:
+                _rewrite_cache.put(key, rewrite)
+            for i in indexes:
+                results[i] = rewrite if rewrite is not None else REWRITE_FAILED_MESSAGE
+    return results
+
+
+def prewarm_rewrites(risks: list[dict], target_language: str = "English") -> None:
+    """Background job: cache rewrites for the clauses of high-severity risks."""
+    if not PREWARM_REWRITES:
+        return
+    clauses = [r["clause"] for r in risks if r.get("severity") in PREWARM_REWRITE_SEVERITIES and r.get("clause", "").strip()]
+    if not clauses:
+        return
+    record_metric("rewrite_prewarm.clauses", len(clauses))
+    for mode in PREWARM_REWRITE_MODES:
+        rewrite_clauses(clauses, target_language, mode)
 
 
 def get_chatbot_response(history: list, document_text: str) -> str:
     """Gets a conversational, document-aware response from the Gemini model."""
     # REMOVED: vertexai.init() call was here
-    conversation_history_string = ""
+    history_lines = []
     for message in history:
         role = "User" if message['role'] == 'user' else "AI"
-        conversation_history_string += f"{role}: {message['text']}\n"
+        history_lines.append(f"{role}: {message['text']}")
+    # Oldest turns are dropped first once the history outgrows its budget
+    conversation_history_string = "\n".join(prompt_budget.fit_history(history_lines)) + "\n"
 
-    prompt = f"""You are LegalEase AI's expert chatbot. Your primary goal is to answer questions based ONLY on the provided legal document.
+    chat_model, document_text = _model_for_document(document_text, "get_chatbot_response")
+    prompt = _build_prompt("get_chatbot_response", document_text, lambda document_text: f"""You are LegalEase AI's expert chatbot. Your primary goal is to answer questions based ONLY on the provided legal document.
 
     If the user asks a question, answer it using the document.
     If the user asks for a definition, provide it.
@@ -525,9 +1426,10 @@ def get_chatbot_response(history: list, document_text: str) -> str:
     CONVERSATION HISTORY:
     {conversation_history_string}
     ---
-    AI: """
+    AI: """)
     try:
-        response = model.generate_content(prompt)
+        response = _generate(chat_model, prompt)
+        record_usage("get_chatbot_response", response)
         html_response = markdown.markdown(response.text.strip())
         return html_response
     except Exception as e:
@@ -540,10 +1442,7 @@ def is_legal_document(text: str) -> bool:
     Uses the AI to perform a quick classification of the text.
     Returns True if the document appears to be legal in nature, False otherwise.
     """
-    # Use a very short snippet for speed
-    text_snippet = text[:2000]
-
-    prompt = f"""
+    prompt = _build_prompt("is_legal_document", text, lambda text_snippet: f"""
     You are a document classifier. Your task is to determine if the following text is a legal document.
     Legal documents include contracts, terms of service, non-disclosure agreements, lease agreements, privacy policies, etc.
     Non-legal documents include articles, stories, recipes, conversations, etc.
@@ -554,11 +1453,12 @@ def is_legal_document(text: str) -> bool:
     TEXT:
     {text_snippet}
     ---
-    """
+    """)
     try:
         # Use a low temperature for a more deterministic, non-creative answer
         generation_config = {"temperature": 0.0}
-        response = model.generate_content(prompt, generation_config=generation_config)
+        response = _generate(_get_model("is_legal_document"), prompt, generation_config=generation_config)
+        record_usage("is_legal_document", response)
 
         # Check if the response text contains "YES"
         return "yes" in (response.text or "").strip().lower()
@@ -574,9 +1474,7 @@ def detect_document_type(text: str) -> str:
     Lightweight LLM call to identify the document type using comprehensive legal classification.
     Returns detailed document type based on legal document categories.
     """
-    text_snippet = text[:2000]  # Use smaller snippet for speed
-    
-    prompt = f"""
+    prompt = _build_prompt("detect_document_type", text, lambda text_snippet: f"""
 You are a legal document classifier. Analyze the following text and determine its document type using this comprehensive classification system:
 
 **PRIMARY CATEGORIES:**
@@ -622,126 +1520,232 @@ Respond with ONLY the most specific document type that best fits the content. Us
 TEXT:
 {text_snippet}
 ---
-"""
+""")
     
     try:
-        generation_config = {"temperature": 0.0}
-        response = model.generate_content(prompt, generation_config=generation_config)
-        doc_type = (response.text or "").strip()
-        
-        # Normalize the response to match our expected types
-        doc_type_lower = doc_type.lower()
-        
-        # Map responses to our standardized categories (order matters for overlapping terms)
-        if any(term in doc_type_lower for term in ["employment", "labour", "appointment letter", "termination notice"]):
-            return "Employment & Labour Documents"
-        elif any(term in doc_type_lower for term in ["property", "sale deed", "gift deed", "mortgage deed", "title deed"]):
-            return "Property Documents"
-        elif any(term in doc_type_lower for term in ["financial", "banking", "promissory note", "bank guarantee"]):
-            return "Financial & Banking Documents"
-        elif any(term in doc_type_lower for term in ["litigation", "fir", "charge sheet", "writ petition", "affidavit", "power of attorney"]):
-            return "Litigation Documents"
-        elif any(term in doc_type_lower for term in ["corporate", "business", "board resolution", "annual report", "non-disclosure"]):
-            return "Corporate & Business Documents"
-        elif any(term in doc_type_lower for term in ["intellectual property", "patent", "trademark", "copyright"]):
-            return "Intellectual Property Documents"
-        elif any(term in doc_type_lower for term in ["personal", "will", "birth certificate", "marriage certificate", "divorce decree", "adoption"]):
-            return "Personal Legal Documents"
-        elif any(term in doc_type_lower for term in ["transactional", "purchase order", "bill of exchange"]):
-            return "Transactional Documents"
-        elif any(term in doc_type_lower for term in ["constitutional", "statutory", "articles of association", "memorandum of association"]):
-            return "Constitutional & Statutory Documents"
-        elif any(term in doc_type_lower for term in ["contractual", "agreement", "lease deed", "partnership deed"]):
-            return "Contractual Documents"
-        else:
-            return "Other Legal Documents"
+        generation_config = _generation_config(
+            temperature=DOCUMENT_TYPE_TEMPERATURE,
+            response_mime_type="application/json",
+            response_schema=DOCUMENT_TYPE_RESPONSE_SCHEMA,
+        )
+        record_metric("detect_document_type.calls")
+        response = _generate(_get_model("detect_document_type"), prompt, generation_config=generation_config)
+        record_usage("detect_document_type", response)
+        raw = (response.text or "").strip()
+        try:
+            doc_type = json.loads(raw).get("document_type", "")
+        except Exception:
+            record_metric("detect_document_type.parse_fallback")
+            doc_type = raw
+        if doc_type in DOCUMENT_TYPE_CATEGORIES:
+            return doc_type
+        return _normalize_document_type(doc_type)
             
     except Exception as e:
         print(f"Document type detection failed: {e}")
         return "Other Legal Documents"
 
 
+def _normalize_document_type(doc_type: str) -> str:
+    """Map a free-text classifier answer onto one of DOCUMENT_TYPE_CATEGORIES."""
+    # Normalize the response to match our expected types
+    doc_type_lower = doc_type.lower()
+    
+    # Map responses to our standardized categories (order matters for overlapping terms)
+    if any(term in doc_type_lower for term in ["employment", "labour", "appointment letter", "termination notice"]):
+        return "Employment & Labour Documents"
+    elif any(term in doc_type_lower for term in ["property", "sale deed", "gift deed", "mortgage deed", "title deed"]):
+        return "Property Documents"
+    elif any(term in doc_type_lower for term in ["financial", "banking", "promissory note", "bank guarantee"]):
+        return "Financial & Banking Documents"
+    elif any(term in doc_type_lower for term in ["litigation", "fir", "charge sheet", "writ petition", "affidavit", "power of attorney"]):
+        return "Litigation Documents"
+    elif any(term in doc_type_lower for term in ["corporate", "business", "board resolution", "annual report", "non-disclosure"]):
+        return "Corporate & Business Documents"
+    elif any(term in doc_type_lower for term in ["intellectual property", "patent", "trademark", "copyright"]):
+        return "Intellectual Property Documents"
+    elif any(term in doc_type_lower for term in ["personal", "will", "birth certificate", "marriage certificate", "divorce decree", "adoption"]):
+        return "Personal Legal Documents"
+    elif any(term in doc_type_lower for term in ["transactional", "purchase order", "bill of exchange"]):
+        return "Transactional Documents"
+    elif any(term in doc_type_lower for term in ["constitutional", "statutory", "articles of association", "memorandum of association"]):
+        return "Constitutional & Statutory Documents"
+    elif any(term in doc_type_lower for term in ["contractual", "agreement", "lease deed", "partnership deed"]):
+        return "Contractual Documents"
+    else:
+        return "Other Legal Documents"
+
+
+# --- PRECHECK SCANNER ---
+# Indicators for the rule-based pre-check. Each one matches at a word boundary in
+# the lowercased text, either as a keyword prefix or through an extra pattern.
+PRECHECK_KEYWORDS = {
+    # Names/parties/institutions
+    "parties": [
+        "party", "parties", "between", "agreement between", "contract between",
+        "plaintiff", "defendant", "petitioner", "respondent",
+        "company", "corporation", "llc", "inc", "ltd",
+        "signed by", "witnessed by", "notarized by",
+    ],
+    # Signature/seal/witness mentions
+    "signature": [
+        "signature", "signed", "sign", "seal", "notary", "witness", "notarized",
+        "executed", "acknowledged", "sworn", "affirmed",
+    ],
+    # Placeholder text (negative scoring)
+    "placeholders": [
+        "lorem ipsum", "your name", "placeholder", "sample text", "test document",
+        "insert", "fill in", "replace with", "xxx", "___",
+        "template", "draft", "example", "sample",
+    ],
+    # Legal terminology (bonus points)
+    "legal_terms": [
+        "whereas", "hereby", "herein", "thereof", "pursuant to", "in accordance with",
+        "liability", "indemnification", "breach", "remedy", "jurisdiction",
+        "confidential", "proprietary", "intellectual property", "copyright",
+    ],
+}
+
+# (category, full pattern, scanner head). The scanner only looks ahead for the
+# head; the full pattern is confirmed at each hit.
+PRECHECK_PATTERNS = [
+    ("parties", r'\b(mr\.|ms\.|mrs\.|dr\.)\s+\w+', r'(?:mr|ms|mrs|dr)\.'),
+    # Same matches as the old greedy `\[.*\]`, without backtracking on long lines
+    ("placeholders", r'\b\[[^\]\n]*\]', r'\['),
+]
+
+# Dates are matched against the original text, case-insensitively
+PRECHECK_DATE_PATTERNS = [
+    r'\b(19|20)\d{2}\b',  # YYYY format
+    r'\b\d{1,2}[-/]\d{1,2}[-/](19|20)\d{2}\b',  # DD-MM-YYYY or DD/MM/YYYY
+    r'\b(January|February|March|April|May|June|July|August|September|October|November|December)\s+\d{1,2},?\s+(19|20)\d{2}\b'  # Month DD, YYYY
+]
+PRECHECK_MONTHS = [
+    "january", "february", "march", "april", "may", "june", "july",
+    "august", "september", "october", "november", "december",
+]
+
+PRECHECK_WEIGHTS = {
+    "date": 20,
+    "parties": 20,
+    "signature": 20,
+    "placeholders": -30,
+    "legal_terms": 20,
+}
+
+
+def _keyword_alternation(keywords: list[str]) -> str:
+    """Group keywords by first character so the regex engine branches once per position."""
+    by_first: dict[str, list[str]] = {}
+    for keyword in keywords:
+        by_first.setdefault(keyword[0], []).append(re.escape(keyword[1:]))
+    return "|".join(f"{re.escape(first)}(?:{'|'.join(rests)})" for first, rests in by_first.items())
+
+
+def _compile_precheck_scanner(include_dates: bool) -> tuple:
+    """
+    Build the combined scanner plus one confirming regex per category.
+    The scanner finds every candidate position in a single traversal; the
+    per-category regexes then check which indicators start at each hit.
+    """
+    keywords = {name: list(words) for name, words in PRECHECK_KEYWORDS.items()}
+    patterns: dict[str, list[str]] = {name: [] for name in keywords}
+    heads = []
+    if include_dates:
+        # ASCII only: lowercasing cannot move word boundaries, so dates join the pass
+        keywords["date"] = list(PRECHECK_MONTHS)
+        patterns["date"] = [pattern.lower() for pattern in PRECHECK_DATE_PATTERNS]
+        heads.append(r'\d')
+    for name, pattern, head in PRECHECK_PATTERNS:
+        patterns[name].append(pattern)
+        heads.append(head)
+
+    confirmers = []
+    for name, words in keywords.items():
+        # Month names only start a date match; the date patterns decide
+        parts = [] if name == "date" else [r'\b(?:' + "|".join(map(re.escape, words)) + ')']
+        confirmers.append((name, re.compile("|".join(parts + patterns[name]))))
+
+    all_keywords = [word for words in keywords.values() for word in words]
+    # Zero-width: a hit consumes nothing, so an indicator starting inside another
+    # one (e.g. "inc" in "fill incorporated") is still a candidate
+    scanner = re.compile(r'\b(?=' + "|".join([_keyword_alternation(all_keywords)] + heads) + ')')
+    return scanner, confirmers
+
+
+_PRECHECK_ASCII_SCANNER = _compile_precheck_scanner(include_dates=True)
+_PRECHECK_UNICODE_SCANNER = _compile_precheck_scanner(include_dates=False)
+_PRECHECK_DATE_RE = re.compile("|".join(PRECHECK_DATE_PATTERNS), re.IGNORECASE)
+
+
+def _scan_precheck_indicators(text: str) -> set[str]:
+    """Return the set of indicator categories present in the text."""
+    text_lower = text.lower()
+    if text.isascii():
+        found = set()
+        scanner, remaining = _PRECHECK_ASCII_SCANNER
+    else:
+        found = {"date"} if _PRECHECK_DATE_RE.search(text) else set()
+        scanner, remaining = _PRECHECK_UNICODE_SCANNER
+
+    remaining = list(remaining)
+    bracket_fails_until = -1
+    for hit in scanner.finditer(text_lower):
+        pos = hit.start()
+        if text_lower[pos] == "[":
+            # Every '[' up to the newline shares the same closing-bracket answer
+            if pos < bracket_fails_until:
+                continue
+            newline = text_lower.find("\n", pos)
+            bracket_fails_until = newline if newline != -1 else len(text_lower)
+        for name, confirmer in list(remaining):
+            if confirmer.match(text_lower, pos):
+                found.add(name)
+                remaining.remove((name, confirmer))
+        # Stop early once every category is satisfied
+        if not remaining:
+            break
+    return found
+
+
 def run_prechecks(text: str) -> int:
     """
     Rule-based pre-check that scores from 0-100 based on document characteristics.
     """
-    score = 0
-    text_lower = text.lower()
-    
-    # Check for date patterns (YYYY or DD-MM-YYYY)
-    date_patterns = [
-        r'\b(19|20)\d{2}\b',  # YYYY format
-        r'\b\d{1,2}[-/]\d{1,2}[-/](19|20)\d{2}\b',  # DD-MM-YYYY or DD/MM/YYYY
-        r'\b(January|February|March|April|May|June|July|August|September|October|November|December)\s+\d{1,2},?\s+(19|20)\d{2}\b'  # Month DD, YYYY
-    ]
-    
-    has_date = any(re.search(pattern, text, re.IGNORECASE) for pattern in date_patterns)
-    if has_date:
-        score += 20
-    
-    # Check for names/parties/institutions
-    party_indicators = [
-        r'\b(party|parties|between|agreement between|contract between)',
-        r'\b(plaintiff|defendant|petitioner|respondent)',
-        r'\b(company|corporation|llc|inc|ltd)',
-        r'\b(mr\.|ms\.|mrs\.|dr\.)\s+\w+',
-        r'\b(signed by|witnessed by|notarized by)'
-    ]
-    
-    has_parties = any(re.search(pattern, text_lower) for pattern in party_indicators)
-    if has_parties:
-        score += 20
-    
-    # Check for signature/seal/witness mentions
-    signature_indicators = [
-        r'\b(signature|signed|sign|seal|notary|witness|notarized)',
-        r'\b(executed|acknowledged|sworn|affirmed)'
-    ]
-    
-    has_signature = any(re.search(pattern, text_lower) for pattern in signature_indicators)
-    if has_signature:
-        score += 20
-    
-    # Check word count (>150 words)
-    word_count = len(text.split())
+    found = _scan_precheck_indicators(text)
+    score = sum(PRECHECK_WEIGHTS[name] for name in found)
+
+    # Check word count (>150 words). Splitting stops once the threshold is known.
+    word_count = len(text.split(maxsplit=150))
     if word_count > 150:
         score += 20
     elif word_count > 50:
         score += 10
-    
-    # Check for placeholder text (negative scoring)
-    placeholder_patterns = [
-        r'\b(lorem ipsum|your name|placeholder|sample text|test document)',
-        r'\b(insert|fill in|replace with|xxx|___|\[.*\])',
-        r'\b(template|draft|example|sample)'
-    ]
-    
-    has_placeholders = any(re.search(pattern, text_lower) for pattern in placeholder_patterns)
-    if has_placeholders:
-        score -= 30
-    
-    # Check for legal terminology (bonus points)
-    legal_terms = [
-        r'\b(whereas|hereby|herein|thereof|pursuant to|in accordance with)',
-        r'\b(liability|indemnification|breach|remedy|jurisdiction)',
-        r'\b(confidential|proprietary|intellectual property|copyright)'
-    ]
-    
-    has_legal_terms = any(re.search(pattern, text_lower) for pattern in legal_terms)
-    if has_legal_terms:
-        score += 20
-    
+
     # Ensure score is between 0 and 100
     return max(0, min(100, score))
 
 
-def check_document_authenticity(text: str, file_content: bytes = None, mime_type: str = None) -> dict:
+def score_many(texts: list[str]) -> list[int]:
+    """
+    Batch variant of run_prechecks for bulk corpora.
+    Reuses the precompiled scanner and scores identical texts only once.
+    """
+    cache: dict[str, int] = {}
+    scores = []
+    for text in texts:
+        if text not in cache:
+            cache[text] = run_prechecks(text)
+        scores.append(cache[text])
+    return scores
+
+
+@single_flight.coalesce("check_document_authenticity")
+def check_document_authenticity(text: str, upload=None) -> dict:
     """
     Performs a multi-stage hybrid authenticity check with document type detection,
     rule-based pre-checks, logo analysis, and dynamic prompting for improved accuracy.
     """
-    text_snippet = text[:15000]  # Use a slightly larger snippet for more context
-    
     # Stage 1: Document Type Detection
     doc_type = detect_document_type(text)
     
@@ -751,9 +1755,9 @@ def check_document_authenticity(text: str, file_content: bytes = None, mime_type
     # Stage 2.5: Logo Analysis (if file content is provided)
     logo_analysis = None
     logo_authenticity_score = 50  # Default neutral score
-    if file_content and mime_type:
+    if upload is not None:
         try:
-            logo_result = check_document_logos(file_content, mime_type)
+            logo_result = check_document_logos(upload)
             if logo_result["success"]:
                 logo_analysis = logo_result["logo_analysis"]
                 logo_authenticity_score = logo_analysis["overall_logo_authenticity_score"]
@@ -791,7 +1795,7 @@ LOGO ANALYSIS RESULTS:
 - Logo risk factors: {', '.join(logo_analysis['logo_risk_factors']) if logo_analysis['logo_risk_factors'] else 'None detected'}
 """
     
-    prompt = f"""
+    prompt = _build_prompt("check_document_authenticity", text, lambda text_snippet: f"""
 You are a highly specialized forensic document examiner and authenticity classifier.
 Your goal is to determine whether the given document is **REAL (authentic)**, **SUSPICIOUS (partially authentic)**, or **FAKE (fabricated or AI-generated)** based on forensic, linguistic, structural cues, and logo analysis.
 
@@ -845,11 +1849,12 @@ Return a STRICT JSON object using this format (no markdown, no extra text):
 DOCUMENT:
 {text_snippet}
 ---
-"""
+""")
 
     try:
         generation_config = {"temperature": 0.0, "response_mime_type": "application/json"}
-        response = model.generate_content(prompt, generation_config=generation_config)
+        response = _generate(_get_model("check_document_authenticity"), prompt, generation_config=generation_config)
+        record_usage("check_document_authenticity", response)
         llm_result = json.loads(response.text)
         
         # Stage 4: Confidence Fusion with Conservative Approach
@@ -942,44 +1947,41 @@ DOCUMENT:
         return fallback_result
 
 
-def extract_images_from_pdf(file_content: bytes) -> list[bytes]:
+def extract_images_from_pdf(file_path: str) -> list[bytes]:
     """
-    Extract images from PDF file content.
-    Returns a list of image bytes.
+    Extract images from a PDF file.
+    Returns a list of image bytes (PNG/JPEG/JP2), skipping images too small to be logos.
     """
     try:
-        pdf_reader = PyPDF2.PdfReader(io.BytesIO(file_content))
-        images = []
-        
-        for page_num, page in enumerate(pdf_reader.pages):
-            if '/XObject' in page['/Resources']:
-                xObject = page['/Resources']['/XObject'].get_object()
-                
-                for obj in xObject:
-                    if xObject[obj]['/Subtype'] == '/Image':
-                        try:
-                            data = xObject[obj].get_data()
-                            images.append(data)
-                        except Exception as e:
-                            print(f"Error extracting image from page {page_num}: {e}")
-                            continue
-        
-        return images
+        return cpu_pool.run(cpu_pool.extract_pdf_images, file_path)
     except Exception as e:
         print(f"Error extracting images from PDF: {e}")
         return []
 
 
+def prepare_logo_image(image_bytes: bytes) -> bytes:
+    """
+    Pre-filter and downscale one logo candidate in the CPU pool.
+    Returns None when the image cannot be a logo.
+    """
+    try:
+        return cpu_pool.run(cpu_pool.prepare_logo_image, image_bytes)
+    except Exception as e:
+        print(f"Error preparing logo image: {e}")
+        return image_bytes
+
+
 def detect_logos_in_image(image_bytes: bytes) -> list[dict]:
     """
     Use Google Cloud Vision API to detect logos in an image.
     Returns a list of detected logos with their properties.
     """
     try:
+        from google.cloud import vision
         image = vision.Image(content=image_bytes)
         
         # Perform logo detection
-        response = vision_client.logo_detection(image=image)
+        response = api_gateway.VISION.call(google_clients.vision_client().logo_detection, image=image)
         logos = response.logo_annotations
         
         detected_logos = []
@@ -999,83 +2001,240 @@ def detect_logos_in_image(image_bytes: bytes) -> list[dict]:
         return []
 
 
-def get_company_logo_database() -> dict:
+# Built-in database of known company logos and their authenticity markers.
+# This is a simplified version - in production, load a comprehensive database
+# through LOGO_DATABASE_FILE.
+DEFAULT_LOGO_DATABASE = {
+    # Major corporations with high authenticity markers
+    "google": {
+        "authenticity_score": 95,
+        "common_variations": ["Google", "GOOGLE", "google"],
+        "description": "Google LLC official logo",
+        "risk_factors": ["color variations", "font changes", "missing trademark symbol"]
+    },
+    "microsoft": {
+        "authenticity_score": 95,
+        "common_variations": ["Microsoft", "MICROSOFT", "microsoft"],
+        "description": "Microsoft Corporation official logo",
+        "risk_factors": ["color variations", "font changes", "missing trademark symbol"]
+    },
+    "apple": {
+        "authenticity_score": 95,
+        "common_variations": ["Apple", "APPLE", "apple"],
+        "description": "Apple Inc. official logo",
+        "risk_factors": ["color variations", "shape distortions", "missing trademark symbol"]
+    },
+    "amazon": {
+        "authenticity_score": 95,
+        "common_variations": ["Amazon", "AMAZON", "amazon"],
+        "description": "Amazon.com Inc. official logo",
+        "risk_factors": ["color variations", "font changes", "missing trademark symbol"]
+    },
+    "meta": {
+        "authenticity_score": 95,
+        "common_variations": ["Meta", "META", "meta", "Facebook", "FACEBOOK"],
+        "description": "Meta Platforms Inc. official logo",
+        "risk_factors": ["color variations", "font changes", "missing trademark symbol"]
+    },
+    # Financial institutions
+    "jpmorgan": {
+        "authenticity_score": 90,
+        "common_variations": ["JPMorgan", "JPMORGAN", "JP Morgan", "Chase"],
+        "description": "JPMorgan Chase & Co. official logo",
+        "risk_factors": ["color variations", "font changes", "missing trademark symbol"]
+    },
+    "bank of america": {
+        "authenticity_score": 90,
+        "common_variations": ["Bank of America", "BANK OF AMERICA", "BofA"],
+        "description": "Bank of America Corporation official logo",
+        "risk_factors": ["color variations", "font changes", "missing trademark symbol"]
+    },
+    # Legal firms
+    "latham": {
+        "authenticity_score": 85,
+        "common_variations": ["Latham & Watkins", "LATHAM & WATKINS", "Latham"],
+        "description": "Latham & Watkins LLP official logo",
+        "risk_factors": ["color variations", "font changes", "missing trademark symbol"]
+    },
+    "skadden": {
+        "authenticity_score": 85,
+        "common_variations": ["Skadden", "SKADDEN", "Skadden Arps"],
+        "description": "Skadden, Arps, Slate, Meagher & Flom LLP official logo",
+        "risk_factors": ["color variations", "font changes", "missing trademark symbol"]
+    },
+    # Government entities
+    "united states": {
+        "authenticity_score": 98,
+        "common_variations": ["United States", "UNITED STATES", "U.S.", "USA"],
+        "description": "United States Government official seal/logo",
+        "risk_factors": ["color variations", "missing official elements", "unauthorized use"]
+    },
+    "irs": {
+        "authenticity_score": 98,
+        "common_variations": ["IRS", "Internal Revenue Service", "INTERNAL REVENUE SERVICE"],
+        "description": "Internal Revenue Service official logo",
+        "risk_factors": ["color variations", "missing official elements", "unauthorized use"]
+    }
+}
+
+
+def load_logo_database(path: str) -> dict:
     """
-    Returns a database of known company logos and their authenticity markers.
-    This is a simplified version - in production, this would be a comprehensive database.
+    Load a logo database from a JSON or CSV file.
+    JSON may be a mapping of company -> entry or a list of entries with a "company" key.
+    CSV needs a "company" column; multi-valued columns are separated by "|".
     """
-    return {
-        # Major corporations with high authenticity markers
-        "google": {
-            "authenticity_score": 95,
-            "common_variations": ["Google", "GOOGLE", "google"],
-            "description": "Google LLC official logo",
-            "risk_factors": ["color variations", "font changes", "missing trademark symbol"]
-        },
-        "microsoft": {
-            "authenticity_score": 95,
-            "common_variations": ["Microsoft", "MICROSOFT", "microsoft"],
-            "description": "Microsoft Corporation official logo",
-            "risk_factors": ["color variations", "font changes", "missing trademark symbol"]
-        },
-        "apple": {
-            "authenticity_score": 95,
-            "common_variations": ["Apple", "APPLE", "apple"],
-            "description": "Apple Inc. official logo",
-            "risk_factors": ["color variations", "shape distortions", "missing trademark symbol"]
-        },
-        "amazon": {
-            "authenticity_score": 95,
-            "common_variations": ["Amazon", "AMAZON", "amazon"],
-            "description": "Amazon.com Inc. official logo",
-            "risk_factors": ["color variations", "font changes", "missing trademark symbol"]
-        },
-        "meta": {
-            "authenticity_score": 95,
-            "common_variations": ["Meta", "META", "meta", "Facebook", "FACEBOOK"],
-            "description": "Meta Platforms Inc. official logo",
-            "risk_factors": ["color variations", "font changes", "missing trademark symbol"]
-        },
-        # Financial institutions
-        "jpmorgan": {
-            "authenticity_score": 90,
-            "common_variations": ["JPMorgan", "JPMORGAN", "JP Morgan", "Chase"],
-            "description": "JPMorgan Chase & Co. official logo",
-            "risk_factors": ["color variations", "font changes", "missing trademark symbol"]
-        },
-        "bank of america": {
-            "authenticity_score": 90,
-            "common_variations": ["Bank of America", "BANK OF AMERICA", "BofA"],
-            "description": "Bank of America Corporation official logo",
-            "risk_factors": ["color variations", "font changes", "missing trademark symbol"]
-        },
-        # Legal firms
-        "latham": {
-            "authenticity_score": 85,
-            "common_variations": ["Latham & Watkins", "LATHAM & WATKINS", "Latham"],
-            "description": "Latham & Watkins LLP official logo",
-            "risk_factors": ["color variations", "font changes", "missing trademark symbol"]
-        },
-        "skadden": {
-            "authenticity_score": 85,
-            "common_variations": ["Skadden", "SKADDEN", "Skadden Arps"],
-            "description": "Skadden, Arps, Slate, Meagher & Flom LLP official logo",
-            "risk_factors": ["color variations", "font changes", "missing trademark symbol"]
-        },
-        # Government entities
-        "united states": {
-            "authenticity_score": 98,
-            "common_variations": ["United States", "UNITED STATES", "U.S.", "USA"],
-            "description": "United States Government official seal/logo",
-            "risk_factors": ["color variations", "missing official elements", "unauthorized use"]
-        },
-        "irs": {
-            "authenticity_score": 98,
-            "common_variations": ["IRS", "Internal Revenue Service", "INTERNAL REVENUE SERVICE"],
-            "description": "Internal Revenue Service official logo",
-            "risk_factors": ["color variations", "missing official elements", "unauthorized use"]
+    if path.lower().endswith(".csv"):
+        with open(path, newline="", encoding="utf-8") as f:
+            rows = list(csv.DictReader(f))
+        entries = [(row.get("company", ""), {
+            "authenticity_score": row.get("authenticity_score") or 50,
+            "common_variations": (row.get("common_variations") or "").split("|"),
+            "description": row.get("description") or "",
+            "risk_factors": (row.get("risk_factors") or "").split("|"),
+        }) for row in rows]
+    else:
+        with open(path, encoding="utf-8") as f:
+            data = json.load(f)
+        if isinstance(data, dict):
+            entries = list(data.items())
+        else:
+            entries = [(item.get("company", ""), item) for item in data]
+
+    database = {}
+    for company, entry in entries:
+        company = str(company).strip().lower()
+        if not company:
+            continue
+        variations = [str(v).strip() for v in entry.get("common_variations", []) if str(v).strip()]
+        database[company] = {
+            "authenticity_score": int(float(entry.get("authenticity_score", 50))),
+            "common_variations": variations or [company],
+            "description": entry.get("description", ""),
+            "risk_factors": [str(r).strip() for r in entry.get("risk_factors", []) if str(r).strip()],
         }
-    }
+    return database
+
+
+def _build_logo_matcher(database: dict) -> dict:
+    """
+    Build an Aho-Corasick automaton over the lowercased logo variations.
+    Each state keeps the lowest company position among the variations ending
+    there, so a lookup returns the same company the linear scan would.
+    """
+    goto = [{}]
+    best = [None]
+    for position, company_data in enumerate(database.values()):
+        for variation in company_data["common_variations"]:
+            state = 0
+            for ch in variation.lower():
+                if ch not in goto[state]:
+                    goto.append({})
+                    best.append(None)
+                    goto[state][ch] = len(goto) - 1
+                state = goto[state][ch]
+            if best[state] is None or position < best[state]:
+                best[state] = position
+
+    # Breadth-first pass to add failure links and inherit matches from suffixes
+    fail = [0] * len(goto)
+    queue = deque(goto[0].values())
+    while queue:
+        state = queue.popleft()
+        for ch, nxt in goto[state].items():
+            queue.append(nxt)
+            f = fail[state]
+            while f and ch not in goto[f]:
+                f = fail[f]
+            fail[nxt] = goto[f].get(ch, 0)
+            inherited = best[fail[nxt]]
+            if inherited is not None and (best[nxt] is None or inherited < best[nxt]):
+                best[nxt] = inherited
+
+    return {"goto": goto, "fail": fail, "best": best, "companies": list(database.items())}
+
+
+def _build_logo_index(path: str = "", fallback: bool = True) -> dict:
+    """
+    Build the logo index from a file. When the file cannot be loaded, the
+    built-in database is used, or with fallback=False the error is raised.
+    """
+    database = DEFAULT_LOGO_DATABASE
+    mtime = None
+    if path:
+        try:
+            mtime = os.path.getmtime(path)
+            database = load_logo_database(path)
+            print(f"Loaded {len(database)} logo database entries from {path}.")
+        except Exception as e:
+            if not fallback:
+                raise
+            print(f"Error loading logo database from {path}: {e}")
+    return {"path": path, "mtime": mtime, "database": database, "matcher": _build_logo_matcher(database)}
+
+
+_logo_index_lock = threading.Lock()
+_logo_index = _build_logo_index(LOGO_DATABASE_FILE)
+
+
+def reload_logo_database(path: str = None) -> dict:
+    """
+    Rebuild the logo index (optionally from a new file) and swap it in.
+    Lookups in flight keep using the previous index until they finish. If the
+    file cannot be loaded (bad JSON, a partial write), the previous index and
+    its mtime are kept, so the load is tried again on the next lookup.
+    """
+    global _logo_index
+    path = _logo_index["path"] if path is None else path
+    try:
+        new_index = _build_logo_index(path, fallback=False)
+    except Exception as e:
+        print(f"Error reloading logo database from {path}, keeping the previous one: {e}")
+        return _logo_index["database"]
+    with _logo_index_lock:
+        _logo_index = new_index
+    return new_index["database"]
+
+
+def _get_logo_index() -> dict:
+    """Return the current logo index, reloading it if the source file changed."""
+    index = _logo_index
+    if index["path"]:
+        try:
+            changed = os.path.getmtime(index["path"]) != index["mtime"]
+        except OSError:
+            changed = False
+        if changed:
+            reload_logo_database()
+            index = _logo_index
+    return index
+
+
+def get_company_logo_database() -> dict:
+    """
+    Returns the database of known company logos and their authenticity markers.
+    The database is loaded once and reloaded when LOGO_DATABASE_FILE changes.
+    """
+    return _get_logo_index()["database"]
+
+
+def match_logo_company(logo_name: str, index: dict = None) -> tuple:
+    """
+    Find the company whose variation appears in the logo name.
+    Runs in time proportional to the name length, independent of database size.
+    Returns (company_name, company_data) or None.
+    """
+    matcher = (index or _get_logo_index())["matcher"]
+    goto, fail, best = matcher["goto"], matcher["fail"], matcher["best"]
+    state = 0
+    matched = None
+    for ch in logo_name.lower():
+        while state and ch not in goto[state]:
+            state = fail[state]
+        state = goto[state].get(ch, 0)
+        if best[state] is not None and (matched is None or best[state] < matched):
+            matched = best[state]
+    return matcher["companies"][matched] if matched is not None else None
 
 
 def analyze_logo_authenticity(detected_logos: list[dict]) -> dict:
@@ -1083,7 +2242,7 @@ def analyze_logo_authenticity(detected_logos: list[dict]) -> dict:
     Analyze detected logos for authenticity based on the company database.
     Returns authenticity analysis results.
     """
-    logo_database = get_company_logo_database()
+    logo_index = _get_logo_index()
     analysis_results = {
         "total_logos_detected": len(detected_logos),
         "authentic_logos": [],
@@ -1101,15 +2260,10 @@ def analyze_logo_authenticity(detected_logos: list[dict]) -> dict:
     valid_logos = 0
     
     for logo in detected_logos:
-        logo_name = logo["description"].lower()
         logo_score = logo["score"]
         
         # Find matching company in database
-        matched_company = None
-        for company_name, company_data in logo_database.items():
-            if any(variation.lower() in logo_name for variation in company_data["common_variations"]):
-                matched_company = (company_name, company_data)
-                break
+        matched_company = match_logo_company(logo["description"], logo_index)
         
         if matched_company:
             company_name, company_data = matched_company
@@ -1165,23 +2319,37 @@ def analyze_logo_authenticity(detected_logos: list[dict]) -> dict:
     return analysis_results
 
 
-def check_document_logos(file_content: bytes, mime_type: str) -> dict:
+def check_document_logos(upload) -> dict:
     """
-    Check for logos in a document and analyze their authenticity.
-    Returns comprehensive logo analysis results.
+    Check for logos in an uploaded document (uploads.SpooledUpload) and analyze
+    their authenticity. Returns comprehensive logo analysis results.
     """
     try:
-        if mime_type == 'application/pdf':
+        if upload.mime_type == 'application/pdf':
             # Extract images from PDF
-            images = extract_images_from_pdf(file_content)
+            images = extract_images_from_pdf(upload.path)
+            # Drop candidates that cannot be logos and shrink oversized ones locally
+            try:
+                candidates = cpu_pool.run(cpu_pool.prepare_logo_images, images)
+            except Exception as e:
+                print(f"Error preparing logo images: {e}")
+                candidates = images
         else:
-            # For other file types, treat the entire file as an image
-            images = [file_content]
+            # For other file types, treat the entire file as an image; the pool
+            # reads it from disk and only the prepared candidate comes back
+            images = [upload.path]
+            try:
+                candidates = [cpu_pool.run(cpu_pool.prepare_logo_file, upload.path)]
+            except Exception as e:
+                print(f"Error preparing logo image: {e}")
+                with upload.in_memory() as content:
+                    candidates = [content]
+        candidates = [image_bytes for image_bytes in candidates if image_bytes]
         
         all_detected_logos = []
         
         # Process each image for logo detection
-        for image_bytes in images:
+        for image_bytes in candidates:
             detected_logos = detect_logos_in_image(image_bytes)
             all_detected_logos.extend(detected_logos)
         
@@ -1190,7 +2358,9 @@ def check_document_logos(file_content: bytes, mime_type: str) -> dict:
         
         return {
             "success": True,
-            "images_processed": len(images),
+            "images_processed": len(candidates),
+            "images_skipped": len(images) - len(candidates),
+            "bytes_sent": sum(len(image_bytes) for image_bytes in candidates),
             "logo_analysis": logo_analysis
         }
         
@@ -0,0 +1,350 @@
+"""
+Pluggable LLM backends with per-operation model routing and micro-batching.
+
+legal_analyzer asks for the model of an operation ("is_legal_document",
+"analyze_risks", ...) instead of one hard-wired GenerativeModel. The backend
+(LLM_BACKEND) decides how prompts are served: "vertex" calls Gemini on Vertex
+AI, "local" answers offline for tests and development. OPERATION_MODELS can
+route operations to other models; cheap classification calls can opt in to a
+lighter model with LLM_LIGHT_OPERATIONS.
+
+Non-interactive jobs can turn on batch mode. Prompts are then queued and
+submitted in groups of up to LLM_BATCH_MAX_SIZE: as a Vertex batch prediction
+job when LLM_BATCH_GCS_PREFIX is set, otherwise as concurrent calls through the
+Gemini gateway. Interactive requests never batch.
+"""
+import json
+import os
+import threading
+import time
+import uuid
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import api_gateway
+import google_clients
+
+# --- CONFIGURATION ---
+LLM_BACKEND = os.getenv("LLM_BACKEND", "vertex")  # "vertex" or "local"
+PROJECT_ID = "legalease-ai-471416"
+LOCATION = "asia-south1"
+DEFAULT_MODEL = os.getenv("LLM_MODEL", "gemini-2.5-flash")
+LIGHT_MODEL = os.getenv("LLM_LIGHT_MODEL", "gemini-2.5-flash-lite")
+# Operations moved to LIGHT_MODEL, opt-in: e.g. "is_legal_document,detect_document_type"
+LLM_LIGHT_OPERATIONS = [op.strip() for op in os.getenv("LLM_LIGHT_OPERATIONS", "").split(",") if op.strip()]
+# Operation -> model; everything else uses DEFAULT_MODEL.
+# LLM_OPERATION_MODELS="op=model,op=model" adds to or overrides these.
+OPERATION_MODELS = {operation: LIGHT_MODEL for operation in LLM_LIGHT_OPERATIONS}
+for _route in os.getenv("LLM_OPERATION_MODELS", "").split(","):
+    if "=" in _route:
+        _operation, _model_name = _route.split("=", 1)
+        OPERATION_MODELS[_operation.strip()] = _model_name.strip()
+
+# Batch mode (offline jobs only)
+LLM_BATCH_MODE = os.getenv("LLM_BATCH_MODE", "0") == "1"
+LLM_BATCH_MAX_SIZE = int(os.getenv("LLM_BATCH_MAX_SIZE", "32"))
+LLM_BATCH_MAX_WAIT_SECONDS = float(os.getenv("LLM_BATCH_MAX_WAIT_SECONDS", "2"))
+LLM_BATCH_MAX_IN_FLIGHT = int(os.getenv("LLM_BATCH_MAX_IN_FLIGHT", "4"))
+# gs://bucket/prefix for Vertex batch prediction input and output; unset = concurrent calls
+LLM_BATCH_GCS_PREFIX = os.getenv("LLM_BATCH_GCS_PREFIX", "").rstrip("/")
+LLM_BATCH_POLL_SECONDS = float(os.getenv("LLM_BATCH_POLL_SECONDS", "15"))
+# Text the local backend answers to prompts without a response schema
+LOCAL_LLM_TEXT = os.getenv("LOCAL_LLM_TEXT", "YES")
+
+
+def model_name_for(operation: str) -> str:
+    return OPERATION_MODELS.get(operation, DEFAULT_MODEL)
+
+
+class _Usage:
+    def __init__(self, prompt_token_count: int = 0, candidates_token_count: int = 0):
+        self.prompt_token_count = prompt_token_count
+        self.candidates_token_count = candidates_token_count
+
+
+class BackendResponse:
+    """The parts of a Gemini response legal_analyzer reads: text and usage_metadata."""
+
+    def __init__(self, text: str, usage_metadata=None):
+        self.text = text
+        self.usage_metadata = usage_metadata
+
+
+class RoutedModel:
+    """A backend model behind the generate_content interface of GenerativeModel."""
+
+    def __init__(self, backend, model_name: str):
+        self.backend = backend
+        self.model_name = model_name
+
+    def generate_content(self, prompt, **kwargs):
+        return self.backend.generate(self.model_name, prompt, **kwargs)
+
+
+# --- BACKENDS ---
+class VertexBackend:
+    """Gemini on Vertex AI, one GenerativeModel per model name."""
+
+    def __init__(self):
+        self._models = {}
+        self._lock = threading.Lock()
+
+    def model(self, model_name: str):
+        generative_model = self._models.get(model_name)
+        if generative_model is None:
+            with self._lock:
+                if model_name not in self._models:
+                    from vertexai.generative_models import GenerativeModel
+                    google_clients.init_vertex(PROJECT_ID, LOCATION)
+                    self._models[model_name] = GenerativeModel(model_name)
+                generative_model = self._models[model_name]
+        return generative_model
+
+    def generation_config(self, **kwargs):
+        from vertexai.generative_models import GenerationConfig
+        return GenerationConfig(**kwargs)
+
+    def generate(self, model_name: str, prompt, **kwargs):
+        return self.model(model_name).generate_content(prompt, **kwargs)
+
+    def generate_batch(self, model_name: str, prompts: list, generation_config=None) -> list:
+        """
+        Responses (or exceptions) in prompt order. Uses a batch prediction job when
+        LLM_BATCH_GCS_PREFIX is set, otherwise concurrent gateway calls.
+        """
+        if LLM_BATCH_GCS_PREFIX:
+            return self._batch_prediction(model_name, prompts, generation_config)
+        kwargs = {"generation_config": generation_config} if generation_config is not None else {}
+        with ThreadPoolExecutor(max_workers=min(len(prompts), 8)) as pool:
+            futures = [
+                pool.submit(api_gateway.GEMINI.call, self.generate, model_name, prompt, **kwargs)
+                for prompt in prompts
+            ]
+        return [f.exception() or f.result() for f in futures]
+
+    def _request_json(self, prompt: str, generation_config, item: int) -> dict:
+        request = {
+            "contents": [{"role": "user", "parts": [{"text": prompt}]}],
+            "labels": {"batch_item": str(item)},
+        }
+        if generation_config is not None:
+            if isinstance(generation_config, dict):
+                generation_config = self.generation_config(**generation_config)
+            # Field names stay snake_case; the request JSON accepts proto field names
+            request["generationConfig"] = generation_config.to_dict()
+        return {"request": request}
+
+    def _batch_prediction(self, model_name: str, prompts: list, generation_config) -> list:
+        from google.cloud import storage
+        from vertexai.batch_prediction import BatchPredictionJob
+
+        google_clients.init_vertex(PROJECT_ID, LOCATION)
+        bucket_name, _, prefix = LLM_BATCH_GCS_PREFIX[len("gs://"):].partition("/")
+        run_prefix = f"{prefix}/{uuid.uuid4().hex}".lstrip("/")
+        client = google_clients.shared_client("storage", lambda: storage.Client(project=PROJECT_ID, credentials=google_clients.get_credentials()))
+        bucket = client.bucket(bucket_name)
+
+        lines = [json.dumps(self._request_json(prompt, generation_config, i)) for i, prompt in enumerate(prompts)]
+        bucket.blob(f"{run_prefix}/input.jsonl").upload_from_string("\n".join(lines), content_type="application/jsonl")
+        job = BatchPredictionJob.submit(
+            source_model=model_name,
+            input_dataset=f"gs://{bucket_name}/{run_prefix}/input.jsonl",
+            output_uri_prefix=f"gs://{bucket_name}/{run_prefix}/output",
+        )
+        while not job.has_ended:
+            time.sleep(LLM_BATCH_POLL_SECONDS)
+            job.refresh()
+        if not job.has_succeeded:
+            raise RuntimeError(f"Batch prediction job {job.resource_name} failed: {job.error}")
+
+        results = [RuntimeError("No batch prediction output for this prompt")] * len(prompts)
+        output_prefix = job.output_location[len(f"gs://{bucket_name}/"):]
+        for blob in client.list_blobs(bucket_name, prefix=output_prefix):
+            if not blob.name.endswith(".jsonl"):
+                continue
+            for line in blob.download_as_text().splitlines():
+                if line.strip():
+                    item, result = self._parse_output_line(json.loads(line))
+                    if item is not None and 0 <= item < len(prompts):
+                        results[item] = result
+        return results
+
+    def _parse_output_line(self, record: dict) -> tuple:
+        item = record.get("request", {}).get("labels", {}).get("batch_item")
+        item = int(item) if item is not None else None
+        if record.get("status"):
+            return item, RuntimeError(f"Batch item failed: {record['status']}")
+        response = record.get("response", {})
+        candidates = response.get("candidates") or []
+        if not candidates:
+            return item, RuntimeError("Batch item returned no candidates")
+        text = "".join(part.get("text", "") for part in candidates[0].get("content", {}).get("parts", []))
+        usage = response.get("usageMetadata", {})
+        return item, BackendResponse(text, _Usage(usage.get("promptTokenCount", 0), usage.get("candidatesTokenCount", 0)))
+
+
+class LocalBackend:
+    """
+    Offline stand-in for tests and development. Prompts with a response schema
+    get the smallest JSON document that satisfies it; others get LOCAL_LLM_TEXT.
+    Assign responder(model_name, prompt, generation_config) -> str to script answers.
+    """
+
+    def __init__(self, responder=None):
+        self.responder = responder
+        self.calls = deque(maxlen=1000)  # (model_name, prompt) for inspection
+
+    def generation_config(self, **kwargs):
+        return dict(kwargs)
+
+    def generate(self, model_name: str, prompt, generation_config=None, **kwargs):
+        self.calls.append((model_name, prompt))
+        if self.responder is not None:
+            return BackendResponse(self.responder(model_name, prompt, generation_config))
+        schema = (generation_config or {}).get("response_schema")
+        if schema is not None:
+            return BackendResponse(json.dumps(_minimal_instance(schema)))
+        if (generation_config or {}).get("response_mime_type") == "application/json":
+            return BackendResponse("{}")
+        return BackendResponse(LOCAL_LLM_TEXT)
+
+    def generate_batch(self, model_name: str, prompts: list, generation_config=None) -> list:
+        return [self.generate(model_name, prompt, generation_config=generation_config) for prompt in prompts]
+
+
+def _minimal_instance(schema: dict):
+    kind = str(schema.get("type", "object")).lower()
+    if "enum" in schema:
+        return schema["enum"][0]
+    if kind == "object":
+        properties = schema.get("properties", {})
+        return {name: _minimal_instance(properties[name]) for name in schema.get("required", []) if name in properties}
+    return {"array": [], "string": "", "integer": 0, "number": 0, "boolean": False}.get(kind)
+
+
+_BACKENDS = {"vertex": VertexBackend, "local": LocalBackend}
+backend = _BACKENDS[LLM_BACKEND]()
+
+
+def model_for(operation: str = None) -> RoutedModel:
+    """The routed model for an operation; the default model when operation is None."""
+    model_name = model_name_for(operation)
+    if isinstance(backend, VertexBackend):
+        backend.model(model_name)  # construct now, so failures surface at the caller
+    return RoutedModel(backend, model_name)
+
+
+def generation_config(**kwargs):
+    """Generation config in the current backend's format."""
+    return backend.generation_config(**kwargs)
+
+
+# --- MICRO-BATCHING ---
+class MicroBatcher:
+    """
+    Queues generate calls and submits them in groups of up to max_size prompts
+    sharing a model and generation config, after at most max_wait seconds.
+    """
+
+    def __init__(self, max_size: int, max_wait: float, max_in_flight: int):
+        self.max_size = max(1, max_size)
+        self.max_wait = max_wait
+        self._queue = deque()  # (group, model, prompt, generation_config, future, queued_at)
+        self._cond = threading.Condition()
+        self._thread = None
+        self._submitter = ThreadPoolExecutor(max_workers=max(1, max_in_flight), thread_name_prefix="llm-batch")
+        self._stats = {"queued": 0, "batches": 0, "batched_prompts": 0, "failed_batches": 0}
+
+    def stats(self) -> dict:
+        with self._cond:
+            stats = dict(self._stats, waiting=len(self._queue))
+        stats["mean_batch_size"] = stats["batched_prompts"] / stats["batches"] if stats["batches"] else 0.0
+        return stats
+
+    def submit(self, routed_model: RoutedModel, prompt: str, generation_config=None) -> Future:
+        group = (id(routed_model.backend), routed_model.model_name, _config_key(generation_config))
+        future = Future()
+        with self._cond:
+            self._queue.append((group, routed_model, prompt, generation_config, future, time.monotonic()))
+            self._stats["queued"] += 1
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="llm-batcher", daemon=True)
+                self._thread.start()
+            self._cond.notify_all()
+        return future
+
+    def _take_batch(self) -> list:
+        """Block until a batch is due, then remove it from the queue (called with the lock held)."""
+        while True:
+            while not self._queue:
+                self._cond.wait()
+            group = self._queue[0][0]
+            same_group = sum(1 for entry in self._queue if entry[0] == group)
+            due_at = self._queue[0][5] + self.max_wait
+            if same_group >= self.max_size or time.monotonic() >= due_at:
+                break
+            self._cond.wait(timeout=due_at - time.monotonic())
+        batch, rest = [], deque()
+        for entry in self._queue:
+            if entry[0] == group and len(batch) < self.max_size:
+                batch.append(entry)
+            else:
+                rest.append(entry)
+        self._queue = rest
+        return batch
+
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                batch = self._take_batch()
+                self._stats["batches"] += 1
+                self._stats["batched_prompts"] += len(batch)
+            self._submitter.submit(self._execute, batch)
+
+    def _execute(self, batch: list) -> None:
+        routed_model, generation_config = batch[0][1], batch[0][3]
+        try:
+            results = routed_model.backend.generate_batch(
+                routed_model.model_name, [entry[2] for entry in batch], generation_config=generation_config
+            )
+        except Exception as e:
+            with self._cond:
+                self._stats["failed_batches"] += 1
+            results = [e] * len(batch)
+        for entry, result in zip(batch, results):
+            if isinstance(result, BaseException):
+                entry[4].set_exception(result)
+            else:
+                entry[4].set_result(result)
+
+
+def _config_key(generation_config) -> str:
+    if generation_config is None:
+        return ""
+    if isinstance(generation_config, dict):
+        return json.dumps(generation_config, sort_keys=True, default=str)
+    return repr(generation_config.to_dict())
+
+
+batcher = MicroBatcher(LLM_BATCH_MAX_SIZE, LLM_BATCH_MAX_WAIT_SECONDS, LLM_BATCH_MAX_IN_FLIGHT)
+
+
+def set_batch_mode(enabled: bool) -> None:
+    """Turn batch mode on for this process (offline jobs only)."""
+    global LLM_BATCH_MODE
+    LLM_BATCH_MODE = enabled
+
+
+def batchable(gen_model) -> bool:
+    """True when calls to gen_model should go through the micro-batcher."""
+    return LLM_BATCH_MODE and isinstance(gen_model, RoutedModel)
+
+
+def backend_stats() -> dict:
+    return {
+        "backend": LLM_BACKEND,
+        "default_model": DEFAULT_MODEL,
+        "routes": dict(OPERATION_MODELS),
+        "batch_mode": LLM_BATCH_MODE,
+        "batcher": batcher.stats(),
+    }
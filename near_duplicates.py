@@ -0,0 +1,140 @@
+"""
+Near-duplicate detection for documents built from the same template.
+
+Each analyzed document gets a MinHash signature over word shingles of its
+normalized text (case folded, digits masked, any script), indexed with LSH
+banding so a lookup only compares a handful of candidates. Documents with too
+few shingles for the estimate to mean anything are never matched. Per-clause hashes of the exact
+text let a near match report which clauses actually differ.
+"""
+import hashlib
+import re
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from prompt_budget import split_sections
+
+# --- CONFIGURATION ---
+NUM_PERMUTATIONS = 128
+LSH_BANDS = 32                  # 32 bands x 4 rows: candidates from ~0.5 similarity upward
+SHINGLE_WORDS = 5
+MIN_SHINGLES = 20               # shorter documents are neither indexed nor matched
+MERSENNE_PRIME = (1 << 31) - 1  # keeps a * x below 2**63 in uint64 arithmetic
+
+# Unicode words; the Indic blocks are listed so vowel signs and viramas stay inside words
+TOKEN = re.compile(r"[\w\u0900-\u0DFF]+|#")
+DIGIT_RUN = re.compile(r"\d+")
+WHITESPACE = re.compile(r"\s+")
+
+_rng = np.random.default_rng(20240917)
+_PERM_A = _rng.integers(1, MERSENNE_PRIME, NUM_PERMUTATIONS, dtype=np.uint64)
+_PERM_B = _rng.integers(0, MERSENNE_PRIME, NUM_PERMUTATIONS, dtype=np.uint64)
+
+
+def _shingle_hashes(text: str) -> np.ndarray:
+    tokens = TOKEN.findall(DIGIT_RUN.sub("#", text.casefold()))
+    shingles = {" ".join(tokens[i:i + SHINGLE_WORDS]) for i in range(len(tokens) - SHINGLE_WORDS + 1)}
+    return np.fromiter(
+        (int.from_bytes(hashlib.blake2b(s.encode("utf-8"), digest_size=4).digest(), "big") for s in shingles),
+        dtype=np.uint64,
+        count=len(shingles),
+    )
+
+
+def minhash_signature(text: str, hashes: np.ndarray = None) -> np.ndarray:
+    """NUM_PERMUTATIONS minimum hash values; equal positions estimate Jaccard similarity."""
+    if hashes is None:
+        hashes = _shingle_hashes(text)
+    signature = np.full(NUM_PERMUTATIONS, MERSENNE_PRIME, dtype=np.uint64)
+    # Chunked so a long document never materializes a shingles x permutations matrix
+    for start in range(0, len(hashes), 4096):
+        permuted = (np.outer(hashes[start:start + 4096], _PERM_A) + _PERM_B) % MERSENNE_PRIME
+        np.minimum(signature, permuted.min(axis=0), out=signature)
+    return signature
+
+
+def estimate_similarity(sig_a: np.ndarray, sig_b: np.ndarray) -> float:
+    return float(np.count_nonzero(sig_a == sig_b)) / NUM_PERMUTATIONS
+
+
+def clause_hash(clause: str) -> str:
+    """Exact-content hash of a clause (whitespace and case insensitive, digits kept)."""
+    return hashlib.sha1(WHITESPACE.sub(" ", clause.strip().lower()).encode("utf-8")).hexdigest()
+
+
+class NearDuplicateIndex:
+    """Bounded LSH index from document key to MinHash signature and clause hashes."""
+
+    def __init__(self, threshold: float, max_documents: int):
+        self.threshold = threshold
+        self.max_documents = max_documents
+        self._rows = NUM_PERMUTATIONS // LSH_BANDS
+        self._entries = OrderedDict()   # doc_key -> {"signature", "clause_hashes", "bands"}
+        self._buckets = {}              # (band, band_hash) -> set of doc_keys
+        self._lock = threading.Lock()
+
+    def _band_keys(self, signature: np.ndarray) -> list[tuple]:
+        return [(band, signature[band * self._rows:(band + 1) * self._rows].tobytes()) for band in range(LSH_BANDS)]
+
+    def add(self, doc_key: str, text: str) -> None:
+        hashes = _shingle_hashes(text)
+        if len(hashes) < MIN_SHINGLES:
+            return
+        signature = minhash_signature(text, hashes)
+        entry = {
+            "signature": signature,
+            "clause_hashes": {clause_hash(clause) for clause in split_sections(text)},
+            "bands": self._band_keys(signature),
+        }
+        with self._lock:
+            self._remove_locked(doc_key)
+            self._entries[doc_key] = entry
+            for band_key in entry["bands"]:
+                self._buckets.setdefault(band_key, set()).add(doc_key)
+            while len(self._entries) > self.max_documents:
+                self._remove_locked(next(iter(self._entries)))
+
+    def _remove_locked(self, doc_key: str) -> None:
+        entry = self._entries.pop(doc_key, None)
+        if entry is None:
+            return
+        for band_key in entry["bands"]:
+            bucket = self._buckets.get(band_key)
+            if bucket is not None:
+                bucket.discard(doc_key)
+                if not bucket:
+                    del self._buckets[band_key]
+
+    def query(self, text: str, exclude: str = None) -> dict:
+        """
+        Best indexed match at or above the threshold, or None. The match lists
+        the clauses of text that do not appear verbatim in the matched document.
+        """
+        hashes = _shingle_hashes(text)
+        if len(hashes) < MIN_SHINGLES:
+            return None
+        signature = minhash_signature(text, hashes)
+        with self._lock:
+            candidates = set()
+            for band_key in self._band_keys(signature):
+                candidates |= self._buckets.get(band_key, set())
+            candidates.discard(exclude)
+            scored = [(estimate_similarity(signature, self._entries[key]["signature"]), key) for key in candidates]
+            if not scored:
+                return None
+            similarity, doc_key = max(scored)
+            if similarity < self.threshold:
+                return None
+            self._entries.move_to_end(doc_key)
+            prior_clauses = self._entries[doc_key]["clause_hashes"]
+
+        clauses = split_sections(text)
+        changed = [clause for clause in clauses if clause_hash(clause) not in prior_clauses]
+        return {
+            "doc_key": doc_key,
+            "similarity": similarity,
+            "changed_clauses": changed,
+            "unchanged_clauses": [clause for clause in clauses if clause_hash(clause) in prior_clauses],
+        }
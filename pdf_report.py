@@ -0,0 +1,346 @@
+"""
+Risk report PDFs.
+
+Reports are laid out in one pass: every risk is wrapped into lines up front
+with memoized word widths, so page breaks are known before anything is drawn
+and each line is a single cell() call. With a Unicode TrueType font in
+PDF_FONT_DIR the report embeds it. fpdf builds a new font subset for every
+document, so the subset is fixed (Latin, Latin Extended-A and punctuation)
+and _ReportPDF writes the compiled subset cached from earlier reports.
+Characters outside the subset are drawn as SUBSET_FALLBACK_CHAR.
+Without a font file the report falls back to Helvetica and latin-1.
+
+fpdf 1.7.2 has no glyph shaping, so Indic scripts cannot be drawn correctly
+(conjuncts and vowel signs come out broken) whatever the font: reports in
+those languages raise ReportLanguageUnsupported.
+"""
+import os
+import re
+import threading
+import zlib
+from collections import OrderedDict
+
+from fpdf import FPDF
+from fpdf.ttfonts import TTFontFile
+
+# --- CONFIGURATION ---
+PDF_FONT_DIR = os.getenv("PDF_FONT_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "static", "fonts"))
+PDF_FONT = os.getenv("PDF_FONT_LATIN", "NotoSans-Regular.ttf")
+# Languages whose script needs glyph shaping -> script name, for the error message
+SHAPED_SCRIPT_LANGUAGES = {
+    "hindi": "Devanagari",
+    "marathi": "Devanagari",
+    "nepali": "Devanagari",
+    "sanskrit": "Devanagari",
+    "bengali": "Bengali",
+    "punjabi": "Gurmukhi",
+    "gujarati": "Gujarati",
+    "tamil": "Tamil",
+    "telugu": "Telugu",
+    "kannada": "Kannada",
+    "malayalam": "Malayalam",
+}
+# Code points every subset carries: ASCII, Latin-1, Latin Extended-A, general punctuation, rupee sign
+SUBSET_RANGES = [(0x20, 0x7E), (0xA0, 0xFF), (0x100, 0x17F), (0x2010, 0x2027), (0x20B9, 0x20B9)]
+SUBSET_FALLBACK_CHAR = "?"
+SUBSET_CACHE_MAX_ENTRIES = int(os.getenv("PDF_SUBSET_CACHE_MAX_ENTRIES", "16"))
+# Reports with at least this many risks render in the CPU process pool
+OFFLOAD_MIN_RISKS = int(os.getenv("PDF_OFFLOAD_MIN_RISKS", "50"))
+
+PAGE_MARGIN = 36
+TITLE = "LegalEase AI - Risk Report"
+BADGE_WIDTH = 70
+HEADER_LINE_HEIGHT = 16
+LINE_HEIGHT = 14
+RISK_GAP = 6
+SEVERITY_COLORS = {"low": (6, 214, 160), "medium": (255, 209, 102), "high": (255, 107, 107)}
+DETAIL_FIELDS = [("type", "Type"), ("issue", "Issue"), ("worst_case", "Worst case"), ("suggestion", "Suggestion")]
+
+SUBSET_CODES = frozenset(code for start, end in SUBSET_RANGES for code in range(start, end + 1))
+# font file -> metrics fpdf needs to lay text out
+_font_metrics = {}
+# font file -> compiled subset, least recently used first
+_subset_cache = OrderedDict()
+_font_cache_lock = threading.Lock()
+
+
+class ReportLanguageUnsupported(ValueError):
+    """Raised for report languages whose script fpdf cannot shape."""
+
+
+def supports_language(language: str) -> bool:
+    return (language or "").strip().lower() not in SHAPED_SCRIPT_LANGUAGES
+
+
+class _CodePoints(list):
+    """Subset list with set lookups; fpdf tests membership once per code point of the font."""
+
+    def __init__(self, codes):
+        super().__init__(codes)
+        self._members = frozenset(codes)
+
+    def __contains__(self, code):
+        return code in self._members
+
+
+def _metrics(path: str) -> dict:
+    """Font metrics for add_font, read once per process instead of pickled to disk."""
+    with _font_cache_lock:
+        metrics = _font_metrics.get(path)
+    if metrics is None:
+        ttf = TTFontFile()
+        ttf.getMetrics(path)
+        metrics = {
+            "name": re.sub("[ ()]", "", ttf.fullName),
+            "desc": {
+                "Ascent": int(round(ttf.ascent, 0)),
+                "Descent": int(round(ttf.descent, 0)),
+                "CapHeight": int(round(ttf.capHeight, 0)),
+                "Flags": ttf.flags,
+                "FontBBox": "[%s %s %s %s]" % tuple(int(round(v, 0)) for v in ttf.bbox),
+                "ItalicAngle": int(ttf.italicAngle),
+                "StemV": int(round(ttf.stemV, 0)),
+                "MissingWidth": int(round(ttf.defaultWidth, 0)),
+            },
+            "up": round(ttf.underlinePosition),
+            "ut": round(ttf.underlineThickness),
+            "cw": ttf.charWidths,
+            "originalsize": os.stat(path).st_size,
+        }
+        with _font_cache_lock:
+            _font_metrics[path] = metrics
+    return metrics
+
+
+def _compiled_subset(path: str) -> dict:
+    """The fixed subset of a font, compiled and compressed once and reused by every report."""
+    with _font_cache_lock:
+        compiled = _subset_cache.get(path)
+        if compiled is not None:
+            _subset_cache.move_to_end(path)
+            return compiled
+    ttf = TTFontFile()
+    stream = ttf.makeSubset(path, _CodePoints(sorted(SUBSET_CODES | set(range(1, 32)))))
+    cid_to_gid = bytearray(256 * 256 * 2)
+    for code, glyph in ttf.codeToGlyph.items():
+        cid_to_gid[code * 2] = glyph >> 8
+        cid_to_gid[code * 2 + 1] = glyph & 0xFF
+    compiled = {
+        "stream": zlib.compress(stream),
+        "length1": len(stream),
+        "cid_to_gid": zlib.compress(bytes(cid_to_gid)),
+        "max_uni": ttf.maxUni,
+    }
+    with _font_cache_lock:
+        _subset_cache[path] = compiled
+        while len(_subset_cache) > SUBSET_CACHE_MAX_ENTRIES:
+            _subset_cache.popitem(last=False)
+    return compiled
+
+
+class _ReportPDF(FPDF):
+    """
+    FPDF that embeds its Unicode font from the cached subset. fpdf itself
+    would compile a new subset for every document and pickle the font
+    metrics to disk; other FPDF documents are left to fpdf.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._report_fonts = set()
+
+    def add_report_font(self, family: str, path: str) -> None:
+        metrics = _metrics(path)
+        fontkey = family.lower()
+        self.fonts[fontkey] = {
+            "i": len(self.fonts) + 1, "type": "TTF", "name": metrics["name"], "desc": metrics["desc"],
+            "up": metrics["up"], "ut": metrics["ut"], "cw": metrics["cw"], "ttffile": path,
+            "fontkey": fontkey, "subset": _CodePoints(sorted(SUBSET_CODES | set(range(32)))), "unifilename": None,
+        }
+        self.font_files[fontkey] = {"length1": metrics["originalsize"], "type": "TTF", "ttffile": path}
+        self._report_fonts.add(fontkey)
+
+    def _putfonts(self):
+        own = {key: self.fonts.pop(key) for key in self._report_fonts}
+        try:
+            super()._putfonts()
+        finally:
+            self.fonts.update(own)
+        for font in own.values():
+            self._put_report_font(font)
+
+    def _put_report_font(self, font: dict) -> None:
+        """Font objects as fpdf writes a TTF font, from the compiled subset."""
+        compiled = _compiled_subset(font["ttffile"])
+        fontname = "MPDFAA+" + font["name"]
+        font["n"] = self.n + 1
+        # Type0 font
+        self._newobj()
+        self._out("<</Type /Font /Subtype /Type0 /BaseFont /" + fontname + " /Encoding /Identity-H")
+        self._out("/DescendantFonts [" + str(self.n + 1) + " 0 R] /ToUnicode " + str(self.n + 2) + " 0 R>>")
+        self._out("endobj")
+        # CIDFontType2
+        self._newobj()
+        self._out("<</Type /Font /Subtype /CIDFontType2 /BaseFont /" + fontname)
+        self._out("/CIDSystemInfo " + str(self.n + 2) + " 0 R /FontDescriptor " + str(self.n + 3) + " 0 R")
+        if font["desc"].get("MissingWidth"):
+            self._out("/DW %d" % font["desc"]["MissingWidth"])
+        self._putTTfontwidths(font, compiled["max_uni"])
+        self._out("/CIDToGIDMap " + str(self.n + 4) + " 0 R>>")
+        self._out("endobj")
+        # ToUnicode
+        self._newobj()
+        to_unicode = (
+            "/CIDInit /ProcSet findresource begin\n12 dict begin\nbegincmap\n"
+            "/CIDSystemInfo\n<</Registry (Adobe)\n/Ordering (UCS)\n/Supplement 0\n>> def\n"
+            "/CMapName /Adobe-Identity-UCS def\n/CMapType 2 def\n"
+            "1 begincodespacerange\n<0000> <FFFF>\nendcodespacerange\n"
+            "1 beginbfrange\n<0000> <FFFF> <0000>\nendbfrange\n"
+            "endcmap\nCMapName currentdict /CMap defineresource pop\nend\nend"
+        )
+        self._out("<</Length " + str(len(to_unicode)) + ">>")
+        self._putstream(to_unicode)
+        self._out("endobj")
+        # CIDSystemInfo
+        self._newobj()
+        self._out("<</Registry (Adobe) /Ordering (UCS) /Supplement 0>>")
+        self._out("endobj")
+        # Font descriptor
+        self._newobj()
+        self._out("<</Type /FontDescriptor /FontName /" + fontname)
+        for key in ("Ascent", "Descent", "CapHeight", "Flags", "FontBBox", "ItalicAngle", "StemV", "MissingWidth"):
+            value = font["desc"][key]
+            if key == "Flags":
+                value = (value | 4) & ~32  # non-symbolic
+            self._out(" /%s %s" % (key, value))
+        self._out("/FontFile2 " + str(self.n + 2) + " 0 R>>")
+        self._out("endobj")
+        # CIDToGIDMap and the font file, as PDF streams of binary data
+        for data, extra in ((compiled["cid_to_gid"], ""), (compiled["stream"], " /Length1 " + str(compiled["length1"]))):
+            self._newobj()
+            self._out("<</Length " + str(len(data)) + " /Filter /FlateDecode" + extra + ">>")
+            self._putstream(data)
+            self._out("endobj")
+
+
+def _font_file() -> str:
+    """Path of the Unicode font, or None when it is not installed."""
+    path = os.path.join(PDF_FONT_DIR, PDF_FONT)
+    return path if os.path.exists(path) else None
+
+
+def _in_subset(text: str) -> str:
+    """Replace characters the fixed subset lacks; whitespace is kept for wrapping."""
+    text = text or ""
+    if all(ord(char) in SUBSET_CODES or char.isspace() for char in text):
+        return text
+    return "".join(char if ord(char) in SUBSET_CODES or char.isspace() else SUBSET_FALLBACK_CHAR for char in text)
+
+
+def _latin1(text: str) -> str:
+    """Core-font fallback: typographic punctuation to ASCII, the rest to latin-1."""
+    text = (text or "").replace("“", '"').replace("”", '"').replace("‘", "'").replace("’", "'")
+    text = text.replace("–", "-").replace("—", "-").replace("•", "-")
+    return text.encode("latin-1", "replace").decode("latin-1")
+
+
+def _wrap(text: str, max_width: float, measure) -> list[str]:
+    """Greedy word wrap; words wider than a line are split between characters."""
+    lines, line, line_width = [], "", 0.0
+    space = measure(" ")
+    for word in text.split():
+        width = measure(word)
+        if width > max_width:
+            if line:
+                lines.append(line)
+            line, line_width = "", 0.0
+            for char in word:
+                char_width = measure(char)
+                if line and line_width + char_width > max_width:
+                    lines.append(line)
+                    line, line_width = "", 0.0
+                line += char
+                line_width += char_width
+            continue
+        if line and line_width + space + width > max_width:
+            lines.append(line)
+            line, line_width = "", 0.0
+        line_width += (space if line else 0) + width
+        line = f"{line} {word}" if line else word
+    if line:
+        lines.append(line)
+    return lines or [""]
+
+
+def _layout(pdf: FPDF, risks: list[dict], clean) -> list[dict]:
+    """Wrap every risk into lines and compute its height, in one pass over the report."""
+    widths = {}
+
+    def measure(word):
+        width = widths.get(word)
+        if width is None:
+            width = widths[word] = pdf.get_string_width(word)
+        return width
+
+    content_width = pdf.w - 2 * PAGE_MARGIN
+    blocks = []
+    for r in risks:
+        severity = str(r.get("severity", "medium")).lower()
+        clause_lines = _wrap(clean(f"Clause: {r.get('clause', '')}"), content_width - BADGE_WIDTH, measure)
+        detail_lines = []
+        for field, label in DETAIL_FIELDS:
+            if r.get(field):
+                detail_lines.extend(_wrap(clean(f"{label}: {r[field]}"), content_width, measure))
+        blocks.append({
+            "severity": severity,
+            "clause_lines": clause_lines,
+            "detail_lines": detail_lines,
+            "height": HEADER_LINE_HEIGHT + LINE_HEIGHT * (len(clause_lines) - 1 + len(detail_lines)) + RISK_GAP,
+        })
+    return blocks
+
+
+def render_risk_report(risks: list[dict], target_language: str = "English") -> bytes:
+    """Render the risks report PDF and return its bytes."""
+    if not supports_language(target_language):
+        script = SHAPED_SCRIPT_LANGUAGES[target_language.strip().lower()]
+        raise ReportLanguageUnsupported(
+            f"PDF reports are not available in {target_language.strip()}: {script} text cannot be "
+            f"rendered correctly. Use the HTML or CSV export instead."
+        )
+    font_file = _font_file()
+
+    pdf = _ReportPDF(unit="pt", format="A4")
+    pdf.set_margins(PAGE_MARGIN, PAGE_MARGIN)
+    pdf.set_auto_page_break(auto=True, margin=PAGE_MARGIN)
+    pdf.set_title(TITLE)
+    if font_file:
+        pdf.add_report_font("report", font_file)
+        family, title_style, clean = "report", "", _in_subset
+    else:
+        family, title_style, clean = "Helvetica", "B", _latin1
+    pdf.add_page()
+
+    pdf.set_font(family, title_style, 16)
+    pdf.cell(0, 22, TITLE, ln=1)
+    pdf.set_font(family, "", 11)
+    pdf.set_text_color(40, 40, 40)
+
+    if not risks:
+        pdf.cell(0, 16, clean("No obvious risks detected."), ln=1)
+    for block in _layout(pdf, risks, clean):
+        # Keep a risk on one page when it fits on one
+        if pdf.get_y() + block["height"] > pdf.page_break_trigger and block["height"] < pdf.h - 2 * PAGE_MARGIN:
+            pdf.add_page()
+        pdf.set_fill_color(*SEVERITY_COLORS.get(block["severity"], (200, 200, 200)))
+        pdf.set_text_color(0, 0, 0)
+        pdf.cell(BADGE_WIDTH, HEADER_LINE_HEIGHT, clean(block["severity"].capitalize()), align="C", fill=True)
+        pdf.cell(0, HEADER_LINE_HEIGHT, block["clause_lines"][0], ln=1)
+        for line in block["clause_lines"][1:]:
+            pdf.set_x(PAGE_MARGIN + BADGE_WIDTH)
+            pdf.cell(0, LINE_HEIGHT, line, ln=1)
+        pdf.set_text_color(60, 60, 60)
+        for line in block["detail_lines"]:
+            pdf.cell(0, LINE_HEIGHT, line, ln=1)
+        pdf.ln(RISK_GAP)
+    return pdf.output(dest="S").encode("latin-1")
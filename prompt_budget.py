@@ -0,0 +1,163 @@
+"""
+Token budgets for every LLM prompt.
+
+Prompt templates are rendered through build_prompt, which estimates the
+template's own size, then fits the document into what is left of the
+operation's budget. Documents are cut at paragraph/sentence boundaries, never
+mid-clause. Short classifiers keep the opening of the document. The
+authenticity check and the risk retry keep the highest-signal sections.
+"""
+import math
+import re
+
+from text_normalizer import estimate_tokens
+
+# --- CONFIGURATION ---
+# Whole-prompt token budgets (template + document) per operation
+PROMPT_TOKEN_BUDGETS = {
+    "summarize_text": 200_000,
+    "analyze_risks": 200_000,
+    "analyze_document_fused": 200_000,
+    "get_chatbot_response": 120_000,
+    "analyze_risks.retry": 4_500,
+    "check_document_authenticity": 5_000,
+    "rewrite_clause": 4_000,
+    "detect_document_type": 1_200,
+    "is_legal_document": 650,
+}
+DEFAULT_PROMPT_TOKEN_BUDGET = 8_000
+# Chat history beyond this is dropped, oldest messages first
+CHAT_HISTORY_TOKEN_BUDGET = 8_000
+
+# How to shrink a document that does not fit: "head" keeps the opening,
+# a signal name keeps the sections with the most matching terms
+PROMPT_TRUNCATION = {
+    "is_legal_document": "head",
+    "detect_document_type": "head",
+    "check_document_authenticity": "authenticity",
+    "analyze_risks.retry": "risk",
+}
+SIGNAL_TERMS = {
+    "risk": [
+        "indemn", "liabil", "terminat", "penalt", "breach", "waive", "exclusive",
+        "arbitrat", "governing law", "warrant", "damages", "interest", "renew",
+        "non-compete", "confidential", "assign", "forfeit", "without notice",
+    ],
+    "authenticity": [
+        "signed", "signature", "witness", "notary", "seal", "stamp", "registered",
+        "dated", "between", "party", "parties", "hereby", "executed", "whereas",
+        "registration no", "reg. no", "address",
+    ],
+}
+
+MAX_SECTION_CHARS = 2000
+OMISSION_MARKER = "\n[...]\n"
+PARAGRAPH_BREAK = re.compile(r'\n\s*\n')
+SENTENCE_BREAK = re.compile(r'(?<=[.;:])\s+(?=[A-Z0-9(\["])')
+
+
+def split_sections(text: str) -> list[str]:
+    """Paragraphs, with over-long ones split at sentence boundaries."""
+    sections = []
+    for paragraph in PARAGRAPH_BREAK.split(text):
+        if not paragraph.strip():
+            continue
+        if len(paragraph) <= MAX_SECTION_CHARS:
+            sections.append(paragraph)
+            continue
+        chunk = ""
+        for sentence in SENTENCE_BREAK.split(paragraph):
+            if chunk and len(chunk) + len(sentence) + 1 > MAX_SECTION_CHARS:
+                sections.append(chunk)
+                chunk = ""
+            chunk = f"{chunk} {sentence}" if chunk else sentence
+        if chunk:
+            sections.append(chunk)
+    return sections
+
+
+def _cut_at_whitespace(text: str, max_tokens: int) -> str:
+    """Last resort for a single section larger than the whole budget."""
+    cut = text[:max(0, max_tokens) * 4]
+    space = cut.rfind(" ")
+    return cut[:space] if space > len(cut) // 2 else cut
+
+
+def _signal_score(section: str, terms: list[str]) -> float:
+    lowered = section.lower()
+    hits = sum(lowered.count(term) for term in terms)
+    # Density, so one long section cannot win on length alone
+    return hits / math.sqrt(max(len(section), 1))
+
+
+def fit_text(text: str, max_tokens: int, strategy: str = "head") -> tuple[str, bool]:
+    """Return (text fitted to max_tokens, whether anything was dropped)."""
+    if estimate_tokens(text) <= max_tokens:
+        return text, False
+    sections = split_sections(text)
+    if not sections or max_tokens <= 0:
+        return "", True
+
+    costs = [estimate_tokens(section) + 1 for section in sections]
+    marker_cost = estimate_tokens(OMISSION_MARKER)
+    chosen = set()
+    remaining = max_tokens - marker_cost  # room for at least one omission marker
+
+    if strategy in SIGNAL_TERMS:
+        terms = SIGNAL_TERMS[strategy]
+        # The opening (title, parties) and the end (signature block) always count
+        edges = [0, len(sections) - 1]
+        ranked = sorted(range(1, len(sections) - 1), key=lambda i: _signal_score(sections[i], terms), reverse=True)
+        for i in edges + ranked:
+            if i not in chosen and costs[i] + marker_cost <= remaining:
+                chosen.add(i)
+                remaining -= costs[i] + marker_cost
+    else:
+        for i, cost in enumerate(costs):
+            if cost > remaining:
+                break
+            chosen.add(i)
+            remaining -= cost
+
+    if not chosen:
+        return _cut_at_whitespace(sections[0], max_tokens - marker_cost) + OMISSION_MARKER, True
+
+    parts = []
+    previous = -1
+    for i in sorted(chosen):
+        if i != previous + 1:
+            parts.append(OMISSION_MARKER.strip())
+        parts.append(sections[i])
+        previous = i
+    if previous != len(sections) - 1:
+        parts.append(OMISSION_MARKER.strip())
+    return "\n\n".join(parts), True
+
+
+def fit_history(lines: list[str], max_tokens: int = CHAT_HISTORY_TOKEN_BUDGET) -> list[str]:
+    """Keep the most recent chat lines that fit in max_tokens."""
+    kept = []
+    for line in reversed(lines):
+        max_tokens -= estimate_tokens(line) + 1
+        if max_tokens < 0:
+            break
+        kept.append(line)
+    return kept[::-1]
+
+
+def build_prompt(operation: str, text: str, render) -> tuple[str, dict]:
+    """
+    render(document) -> prompt. Fits text into the operation's budget minus the
+    template's own size and returns (prompt, accounting dict).
+    """
+    budget = PROMPT_TOKEN_BUDGETS.get(operation, DEFAULT_PROMPT_TOKEN_BUDGET)
+    overhead = estimate_tokens(render(""))
+    document, truncated = fit_text(text or "", budget - overhead, PROMPT_TRUNCATION.get(operation, "head"))
+    prompt = render(document)
+    return prompt, {
+        "operation": operation,
+        "budget": budget,
+        "estimated_tokens": estimate_tokens(prompt),
+        "document_tokens": estimate_tokens(document),
+        "truncated": truncated,
+    }
@@ -0,0 +1,93 @@
+"""
+Single-flight coalescing for identical in-flight work.
+
+Double-clicked "Analyze" buttons, the page firing /check-authenticity and / for
+the same upload, and shared links all produce concurrent identical calls. The
+first caller for a key runs the function; callers arriving while it is in
+flight wait for that result instead of issuing their own Google API calls.
+Nothing is cached once the call finishes.
+"""
+import copy
+import functools
+import hashlib
+import inspect
+import threading
+
+
+class _Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+_flights: dict[str, _Flight] = {}
+_flights_lock = threading.Lock()
+_stats = {"leaders": 0, "joined": 0}
+
+
+def flight_stats() -> dict:
+    """Return how many calls ran (leaders) and how many waited on one (joined)."""
+    with _flights_lock:
+        return dict(_stats, in_flight=len(_flights))
+
+
+def make_key(operation: str, *parts) -> str:
+    """Key from the operation name and a hash of the arguments (str/bytes hashed by content)."""
+    digest = hashlib.sha256(operation.encode("utf-8"))
+    for part in parts:
+        if isinstance(part, str):
+            part = part.encode("utf-8")
+        elif not isinstance(part, (bytes, bytearray, memoryview)):
+            part = repr(part).encode("utf-8")
+        digest.update(len(part).to_bytes(8, "big"))
+        digest.update(part)
+    return f"{operation}:{digest.hexdigest()}"
+
+
+def do(key: str, fn, *args, **kwargs):
+    """Run fn(*args, **kwargs), or wait for the identical call already in flight under key."""
+    with _flights_lock:
+        flight = _flights.get(key)
+        leader = flight is None
+        if leader:
+            flight = _flights[key] = _Flight()
+            _stats["leaders"] += 1
+        else:
+            _stats["joined"] += 1
+
+    if not leader:
+        flight.done.wait()
+        if flight.error is not None:
+            raise flight.error
+        # Each caller gets its own copy so one request cannot mutate another's result
+        return copy.deepcopy(flight.result)
+
+    try:
+        result = fn(*args, **kwargs)
+        # Followers copy from a snapshot the leader's caller cannot mutate
+        flight.result = copy.deepcopy(result)
+        return result
+    except BaseException as e:
+        flight.error = e
+        raise
+    finally:
+        with _flights_lock:
+            del _flights[key]
+        flight.done.set()
+
+
+def coalesce(operation: str):
+    """Decorator: coalesce concurrent calls with the same operation and arguments."""
+    def decorator(fn):
+        signature = inspect.signature(fn)
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            # Bind with defaults so f(text) and f(text, "English") share a key
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            key = make_key(operation, *bound.arguments.values())
+            return do(key, fn, *args, **kwargs)
+        return wrapper
+    return decorator
@@ -544,6 +544,35 @@ function displayPageLimitModal(report) {
         }
     }
 
+    /**
+     * Poll for analysis stages that missed the server's time budget and
+     * swap their placeholders for the finished content.
+     */
+    function initializePendingStages() {
+        document.querySelectorAll('.stage-pending[data-stage-url]').forEach(placeholder => {
+            const url = placeholder.getAttribute('data-stage-url');
+            let attempts = 0;
+
+            const poll = async () => {
+                attempts += 1;
+                try {
+                    const response = await fetch(url);
+                    const data = await response.json();
+                    if (data.status === 'pending' && attempts < 100) {
+                        setTimeout(poll, 3000);
+                        return;
+                    }
+                    placeholder.outerHTML = data.html || '<p style="color: #ff6b6b;"><b>Error:</b> This part of the analysis is no longer available. Please analyze the document again.</p>';
+                    if (url.endsWith('/risks')) initializeRiskAccordion();
+                } catch (error) {
+                    console.error('Failed to fetch analysis stage:', error);
+                    if (attempts < 100) setTimeout(poll, 5000);
+                }
+            };
+            setTimeout(poll, 2000);
+        });
+    }
+
     // --- Initialization logic ---
     // Check if the results div exists by checking the flask variable
     const hasResult = document.querySelector('.main-content.container');
@@ -551,6 +580,7 @@ function displayPageLimitModal(report) {
         initializeRiskAccordion();
         initializeRiskFiltering();
         initializeSummaryFeatures();
+        initializePendingStages();
     }
 
 });
@@ -0,0 +1,48 @@
+import io
+
+import numpy as np
+from PIL import Image
+
+import cpu_pool
+
+
+def _encode(image, fmt):
+    buffer = io.BytesIO()
+    image.save(buffer, format=fmt)
+    return buffer.getvalue()
+
+
+def _noisy_image(width=160, height=120):
+    rng = np.random.default_rng(0)
+    return Image.fromarray(rng.integers(0, 256, (height, width, 3), dtype=np.uint8), "RGB")
+
+
+def test_image_opencv_cannot_decode_is_still_processed():
+    import cv2
+    for fmt in ("TGA", "PCX"):
+        data = _encode(_noisy_image(), fmt)
+        assert cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_UNCHANGED) is None
+
+        prepared = cpu_pool.prepare_logo_image(data)
+        assert prepared is not None
+        decoded = Image.open(io.BytesIO(prepared))
+        assert decoded.format == "PNG"
+        assert decoded.size == (160, 120)
+
+
+def test_image_opencv_cannot_decode_still_goes_through_candidate_filters():
+    tiny = _encode(_noisy_image(width=16, height=16), "TGA")
+    flat = _encode(Image.new("RGB", (160, 120), (255, 255, 255)), "PCX")
+    assert cpu_pool.prepare_logo_image(tiny) is None
+    assert cpu_pool.prepare_logo_image(flat) is None
+
+
+def test_large_image_opencv_cannot_decode_is_downscaled():
+    data = _encode(_noisy_image(width=2048, height=1024), "TGA")
+    prepared = cpu_pool.prepare_logo_image(data)
+    assert Image.open(io.BytesIO(prepared)).size == (cpu_pool.LOGO_MAX_SIDE_PX, cpu_pool.LOGO_MAX_SIDE_PX // 2)
+
+
+def test_bytes_nothing_can_decode_are_passed_through():
+    data = b"not an image at all" * 10
+    assert cpu_pool.prepare_logo_image(data) == data
@@ -0,0 +1,134 @@
+"""
+OCR text normalization before LLM calls.
+
+Document AI output for scanned contracts repeats page headers, footers, page
+numbers and Bates stamps on every page and keeps hyphenated line breaks. All of
+it is pasted into the summary, risk, chat and authenticity prompts.
+normalize_ocr_text strips that noise while leaving the wording of the document
+unchanged, and reports what it saved.
+"""
+import re
+from collections import Counter
+
+# --- CONFIGURATION ---
+PAGE_SEPARATOR = "\f"          # process_document_with_docai joins pages with form feeds
+EDGE_LINES = 3                 # lines at the top/bottom of a page checked for headers/footers
+MIN_PAGES_FOR_REPEATS = 3      # need this many pages before calling a line "repeated"
+REPEATED_LINE_PAGE_RATIO = 0.5 # a header/footer shows up on at least this share of pages
+MAX_BOILERPLATE_LINE_CHARS = 120
+DIGIT_INSENSITIVE_MAX_CHARS = 40
+CHARS_PER_TOKEN = 4            # rough English average for Gemini tokenizers
+
+# Lines that are nothing but a page marker
+PAGE_NUMBER_LINE = re.compile(
+    r'^\s*(?:page\s+\d+(?:\s*(?:of|/)\s*\d+)?|-\s*\d+\s*-|\d+\s*(?:of|/)\s*\d+|\[?\d{1,4}\]?)\s*$',
+    re.IGNORECASE,
+)
+# Unambiguous anywhere, even without page boundaries
+PAGE_OF_LINE = re.compile(r'^page\s+\d+\s*(?:of|/)\s*\d+$', re.IGNORECASE)
+# Bates stamps: a short uppercase prefix followed by a long zero-padded number
+BATES_LINE = re.compile(r'^\s*[A-Z]{2,10}[\s_-]?\d{5,10}\s*$')
+# Page number at the end or start of a running header/footer:
+# "Lease Agreement - Page 3", "Confidential | 4 of 12", "7 | Acme Corp"
+RUNNING_PAGE_MARKER = re.compile(
+    r'(?:\bpage\s+\d+(?:\s*(?:of|/)\s*\d+)?|\b\d+\s*(?:of|/)\s*\d+|[|•·–—-]\s*\d{1,4})\s*$|^\s*\d{1,4}\s*[|•·–—-]',
+    re.IGNORECASE,
+)
+# Hyphen at end of line followed by a lowercase continuation: "termi-\nnation".
+# The hyphen is kept, since "non-\ncompete" is a real hyphenated word.
+HYPHENATED_BREAK = re.compile(r'(\w)-[ \t]*\n[ \t]*([a-z])')
+INLINE_WHITESPACE = re.compile(r'[ \t ]+')
+EXTRA_BLANK_LINES = re.compile(r'\n{3,}')
+DIGITS = re.compile(r'\d+')
+
+
+def estimate_tokens(text: str) -> int:
+    """Cheap token estimate used for reporting and budgeting."""
+    return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+
+def _line_signature(line: str) -> str:
+    """
+    Normalize a line so "Page 3 of 10" and "Page 4 of 10" compare equal. Only
+    short page markers and running headers with a page number ignore digits;
+    other lines must repeat exactly, so "ARTICLE 3" or "Section 12" starting
+    a page is kept.
+    """
+    line = INLINE_WHITESPACE.sub(" ", line.strip().lower())
+    if len(line) <= DIGIT_INSENSITIVE_MAX_CHARS and (PAGE_NUMBER_LINE.match(line) or RUNNING_PAGE_MARKER.search(line)):
+        return DIGITS.sub("#", line)
+    return line
+
+
+def _content_indexes(lines: list[str]) -> list[int]:
+    return [i for i, line in enumerate(lines) if line.strip()]
+
+
+def _edge_indexes(content_idx: list[int]) -> set:
+    """Header/footer zone: first and last EDGE_LINES content lines, at most a third of the page each."""
+    zone = min(EDGE_LINES, max(1, len(content_idx) // 3))
+    return set(content_idx[:zone] + content_idx[-zone:])
+
+
+def _repeated_edge_lines(pages: list[list[str]]) -> set:
+    """Signatures of lines that recur in the header/footer zone of many pages."""
+    if len(pages) < MIN_PAGES_FOR_REPEATS:
+        return set()
+    counts = Counter()
+    for lines in pages:
+        content_idx = _content_indexes(lines)
+        edges = [lines[i] for i in _edge_indexes(content_idx)]
+        counts.update({_line_signature(line) for line in edges if len(line.strip()) <= MAX_BOILERPLATE_LINE_CHARS})
+    threshold = max(MIN_PAGES_FOR_REPEATS, REPEATED_LINE_PAGE_RATIO * len(pages))
+    return {signature for signature, count in counts.items() if count >= threshold and signature}
+
+
+def normalize_ocr_text(text: str) -> dict:
+    """
+    Remove repeated headers/footers, page numbers and Bates stamps, rejoin
+    hyphenated line breaks and collapse whitespace. Page-level cleanup needs
+    form-feed page separators; pasted text only gets the line-level fixes.
+    Returns {"text": normalized_text, "stats": {...}}.
+    """
+    text = text or ""
+    pages = [page.split("\n") for page in text.split(PAGE_SEPARATOR)]
+    has_pages = len(pages) > 1
+    repeated = _repeated_edge_lines(pages) if has_pages else set()
+
+    lines_removed = 0
+    kept_pages = []
+    for lines in pages:
+        edge_idx = _edge_indexes(_content_indexes(lines))
+        kept = []
+        for i, line in enumerate(lines):
+            stripped = line.strip()
+            if stripped and i in edge_idx and (
+                _line_signature(line) in repeated
+                # Bare numbers are only page numbers when we know where the page edge is
+                or (has_pages and PAGE_NUMBER_LINE.match(stripped))
+                or BATES_LINE.match(stripped)
+            ):
+                lines_removed += 1
+                continue
+            if stripped and not has_pages and PAGE_OF_LINE.match(stripped):
+                lines_removed += 1
+                continue
+            kept.append(line)
+        kept_pages.append("\n".join(kept))
+
+    normalized = "\n\n".join(page.strip("\n") for page in kept_pages)
+    normalized, hyphenations = HYPHENATED_BREAK.subn(r'\1-\2', normalized)
+    normalized = "\n".join(INLINE_WHITESPACE.sub(" ", line).strip() for line in normalized.split("\n"))
+    normalized = EXTRA_BLANK_LINES.sub("\n\n", normalized).strip()
+
+    return {
+        "text": normalized,
+        "stats": {
+            "chars_before": len(text),
+            "chars_after": len(normalized),
+            "chars_saved": len(text) - len(normalized),
+            "tokens_saved_est": estimate_tokens(text) - estimate_tokens(normalized),
+            "lines_removed": lines_removed,
+            "hyphenations_joined": hyphenations,
+        },
+    }
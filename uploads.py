@@ -0,0 +1,187 @@
+"""
+Bounded, disk-spooled uploads.
+
+Request bodies over MAX_UPLOAD_BYTES are rejected with 413 before they are
+parsed. Uploaded files are streamed by the form parser straight into named
+temporary files, and code that needs the file gets its path, never the bytes:
+the CPU pool parses PDFs from a memory map and pdf2image rasterizes from the
+file. Only a Document AI request, which has to carry the document inline,
+holds a whole file in memory, and those reads share UPLOAD_MEMORY_BUDGET_BYTES
+so a few concurrent large uploads cannot exhaust the worker.
+
+Photographed documents (image/* uploads) are normalized once, after the blur
+check: EXIF orientation applied, the page cropped and straightened, downscaled
+to OCR resolution and re-encoded, so OCR and Vision get a smaller file.
+"""
+import contextlib
+import hashlib
+import os
+import resource
+import shutil
+import tempfile
+import threading
+
+from flask import Request
+
+import cpu_pool
+
+# --- CONFIGURATION ---
+MAX_UPLOAD_BYTES = int(float(os.getenv("MAX_UPLOAD_MB", "20")) * 1024 * 1024)
+# Whole-file reads (Document AI) held in memory at once, across all requests
+UPLOAD_MEMORY_BUDGET_BYTES = int(float(os.getenv("UPLOAD_MEMORY_BUDGET_MB", "64")) * 1024 * 1024)
+UPLOAD_MEMORY_WAIT_SECONDS = float(os.getenv("UPLOAD_MEMORY_WAIT_SECONDS", "30"))
+UPLOAD_SPOOL_DIR = os.getenv("UPLOAD_SPOOL_DIR") or None  # None = system temp dir
+SPOOL_CHUNK_BYTES = 1024 * 1024
+NORMALIZE_IMAGES = os.getenv("NORMALIZE_IMAGES", "1") == "1"
+
+
+class UploadMemoryBusy(RuntimeError):
+    """Raised when a whole-file read cannot fit in the memory budget in time."""
+
+
+_memory = threading.Condition()
+_stats = {
+    "spooled": 0,
+    "spooled_bytes": 0,
+    "rejected_too_large": 0,
+    "in_memory_bytes": 0,
+    "peak_in_memory_bytes": 0,
+    "memory_waits": 0,
+    "memory_rejected": 0,
+    "images_normalized": 0,
+    "images_unchanged": 0,
+    "image_bytes_in": 0,
+    "image_bytes_saved": 0,
+}
+
+
+def upload_stats() -> dict:
+    """Spooling counters, whole-file bytes in memory (current and peak) and process peak RSS."""
+    with _memory:
+        stats = dict(_stats)
+    # ru_maxrss is in kilobytes on Linux
+    stats["max_rss_mb"] = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+    stats["max_upload_bytes"] = MAX_UPLOAD_BYTES
+    stats["memory_budget_bytes"] = UPLOAD_MEMORY_BUDGET_BYTES
+    return stats
+
+
+def record_rejected() -> None:
+    with _memory:
+        _stats["rejected_too_large"] += 1
+
+
+class SpoolingRequest(Request):
+    """Flask request whose uploaded files are always named temporary files on disk."""
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return tempfile.NamedTemporaryFile("wb+", prefix="upload-", dir=UPLOAD_SPOOL_DIR)
+
+
+class SpooledUpload:
+    """An uploaded file on disk: path, size, mime type and content hash."""
+
+    def __init__(self, path: str, size: int, sha256: str, mime_type: str, filename: str = ""):
+        self.path = path
+        self.size = size
+        self.sha256 = sha256
+        self.mime_type = mime_type
+        self.filename = filename
+
+    def __repr__(self):
+        # Content-based, so single-flight keys match for the same file across requests
+        return f"SpooledUpload({self.sha256}, {self.mime_type})"
+
+    @contextlib.contextmanager
+    def in_memory(self):
+        """Yield the file's bytes, counted against UPLOAD_MEMORY_BUDGET_BYTES while held."""
+        # A file larger than the whole budget still runs, once nothing else is held
+        reserved = min(self.size, UPLOAD_MEMORY_BUDGET_BYTES)
+        with _memory:
+            if _stats["in_memory_bytes"] + reserved > UPLOAD_MEMORY_BUDGET_BYTES:
+                _stats["memory_waits"] += 1
+                if not _memory.wait_for(
+                    lambda: _stats["in_memory_bytes"] + reserved <= UPLOAD_MEMORY_BUDGET_BYTES,
+                    timeout=UPLOAD_MEMORY_WAIT_SECONDS,
+                ):
+                    _stats["memory_rejected"] += 1
+                    raise UploadMemoryBusy("Too many large uploads are being processed; try again shortly.")
+            _stats["in_memory_bytes"] += reserved
+            _stats["peak_in_memory_bytes"] = max(_stats["peak_in_memory_bytes"], _stats["in_memory_bytes"])
+        try:
+            with open(self.path, "rb") as f:
+                yield f.read()
+        finally:
+            with _memory:
+                _stats["in_memory_bytes"] -= reserved
+                _memory.notify_all()
+
+
+def hash_file(path: str) -> tuple:
+    """(size, sha256 hex digest) of a file, read in chunks."""
+    digest = hashlib.sha256()
+    size = 0
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(SPOOL_CHUNK_BYTES), b""):
+            digest.update(chunk)
+            size += len(chunk)
+    return size, digest.hexdigest()
+
+
+def from_file_storage(file_storage) -> SpooledUpload:
+    """
+    Describe an uploaded werkzeug FileStorage as a SpooledUpload, hashing it in
+    chunks. Streams that are not already named files are copied to one first.
+    The file lives as long as the request.
+    """
+    stream = file_storage.stream
+    path = getattr(stream, "name", None)
+    if not isinstance(path, str) or not os.path.exists(path):
+        spooled = tempfile.NamedTemporaryFile("wb+", prefix="upload-", dir=UPLOAD_SPOOL_DIR)
+        shutil.copyfileobj(stream, spooled, SPOOL_CHUNK_BYTES)
+        # Closed (and deleted) with the request's other files
+        file_storage.stream = stream = spooled
+        path = spooled.name
+    stream.flush()
+
+    size, sha256 = hash_file(path)
+    with _memory:
+        _stats["spooled"] += 1
+        _stats["spooled_bytes"] += size
+    return SpooledUpload(path, size, sha256, file_storage.mimetype, file_storage.filename or "")
+
+
+def normalize_image(file_storage, upload: SpooledUpload) -> SpooledUpload:
+    """
+    Normalize a photographed document (see cpu_pool.normalize_document_image)
+    and return it as a new SpooledUpload, replacing the request's spooled copy.
+    Non-image uploads, and images normalization cannot improve, come back unchanged.
+    """
+    if not NORMALIZE_IMAGES or not (upload.mime_type or "").startswith("image/"):
+        return upload
+    spooled = tempfile.NamedTemporaryFile("wb+", prefix="upload-", suffix=".jpg", dir=UPLOAD_SPOOL_DIR)
+    try:
+        result = cpu_pool.run(cpu_pool.normalize_document_image, upload.path, spooled.name)
+    except Exception as e:
+        print(f"Error normalizing image upload: {e}")
+        result = {"written": False}
+    if not result["written"]:
+        spooled.close()
+        with _memory:
+            _stats["images_unchanged"] += 1
+        return upload
+
+    # Closed (and deleted) with the request's other files; the original goes now
+    file_storage.stream.close()
+    file_storage.stream = spooled
+    size, sha256 = hash_file(spooled.name)
+    saved = result["input_bytes"] - result["output_bytes"]
+    with _memory:
+        _stats["images_normalized"] += 1
+        _stats["image_bytes_in"] += result["input_bytes"]
+        _stats["image_bytes_saved"] += saved
+    print(
+        f"Normalized {upload.filename or 'image'}: {result['original_size']} -> {result['output_size']}, "
+        f"rotated={result['rotated']}, cropped={result['cropped']}, saved {saved / 1024:.0f} KB"
+    )
+    return SpooledUpload(spooled.name, size, sha256, "image/jpeg", upload.filename)